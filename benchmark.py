@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# Benchmark parser.py on synthetic assessment logs
+#
+# Generates cached history pages for a fake project in a scratch workspace,
+# then times parse() end to end and each of its stages on its own. Every
+# stage runs in a fresh process so peak RSS is measured per stage.
+#
+# Usage: python benchmark.py [small|medium|large] [--save]
+#   --save stores the results as the baseline later runs are compared to
+
+import calendar
+import json
+from multiprocessing import Pool
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import crawler
+import projects
+
+# Config
+baseline_file = "output/benchmark_baseline.json"
+# Slower than baseline by more than this fraction is reported as a regression
+tolerance = 0.10
+bench_project = "Benchmark"
+scales = {
+    "small": {"pages": 50, "days_per_page": 3, "entries_per_day": 20},
+    "medium": {"pages": 500, "days_per_page": 3, "entries_per_day": 40},
+    "large": {"pages": 2000, "days_per_page": 4, "entries_per_day": 60},
+}
+# Share of pages that continue the previous day or are too huge to upload
+contd_rate = 0.05
+huge_rate = 0.02
+# Relative frequency of each log format
+format_mix = {
+    "assessed": 30,
+    "reassessed": 30,
+    "reassessed_simple": 5,
+    "renamed": 10,
+    "removed": 10,
+    "added": 10,
+    "moved": 3,
+    "skip": 2,
+}
+
+months = [
+    "January", "February", "March", "April", "May", "June", "July",
+    "August", "September", "October", "November", "December"]
+classes = ["Stub-Class", "Start-Class", "C-Class", "B-Class", "GA-Class", "FA-Class"]
+importances = ["Low-Class", "Mid-Class", "High-Class", "Top-Class"]
+
+def article_link(name):
+    return '<a href="/wiki/%s">%s</a>' % (name.replace(" ", "_"), name)
+
+def talk_link(name):
+    return '(<a href="/wiki/Talk:%s">talk</a>)' % name.replace(" ", "_")
+
+def rev_links():
+    return '(<a href="/w/index.php?oldid=1">rev</a> · <a href="/w/index.php?oldid=2">t</a>)'
+
+def make_entry_html(kind, rng):
+    '''Return one log line of the given format as an <li>.'''
+    name = "Article %d" % rng.randint(0, 100000)
+    q1, q2 = rng.choice(classes), rng.choice(classes)
+    i1, i2 = rng.choice(importances), rng.choice(importances)
+    if kind == "assessed":
+        text = "%s %s assessed. Quality assessed as %s %s. Importance assessed as %s %s." % (
+            article_link(name), talk_link(name), q1, rev_links(), i1, rev_links())
+    elif kind == "reassessed":
+        text = "%s %s reassessed. Quality rating changed from %s to %s %s." % (
+            article_link(name), talk_link(name), q1, q2, rev_links())
+    elif kind == "reassessed_simple":
+        text = "%s reassessed from %s (%s) to %s (%s)" % (
+            article_link(name), q1, i1, q2, i2)
+    elif kind == "renamed":
+        text = "%s %s %s (%s) renamed to %s." % (
+            article_link(name), talk_link(name), q1, i1, article_link(name + " (film)"))
+    elif kind == "removed":
+        text = "%s %s %s (%s) removed." % (article_link(name), talk_link(name), q1, i1)
+    elif kind == "added":
+        text = "%s %s %s (%s) added." % (article_link(name), talk_link(name), q1, i1)
+    elif kind == "moved":
+        text = "%s moved from %s (%s) to %s (%s)" % (article_link(name), q1, i1, q2, i2)
+    else:
+        text = "(No changes today)"
+    return "<li>%s</li>" % text
+
+def date_header(t):
+    d = time.gmtime(t)
+    month = months[d.tm_mon - 1]
+    return '<h3><span class="mw-headline" id="%s_%d.2C_%d">%s %d, %d</span></h3>' % (
+        month, d.tm_mday, d.tm_year, month, d.tm_mday, d.tm_year)
+
+def make_page(days, entries_per_day, contd, huge, rng, kinds):
+    '''Return the html of one cached log page covering days (newest first).'''
+    body = []
+    if contd:
+        body.append("<p>This log entry was truncated because it was too long. "
+                    "This entry is a continuation of the entry in the next "
+                    "revision of this log page.</p>")
+        body.append("<ul>%s</ul>" % "".join(
+            make_entry_html(rng.choice(kinds), rng) for i in range(entries_per_day)))
+    for day in days:
+        body.append(date_header(day))
+        if huge:
+            body.append("<p>The log for today is too huge to upload to the wiki.</p>")
+            continue
+        body.append('<h4><span class="mw-headline" id="Reassessed">Reassessed</span></h4>')
+        body.append("<ul>%s</ul>" % "".join(
+            make_entry_html(rng.choice(kinds), rng) for i in range(entries_per_day)))
+    return (
+        '<!DOCTYPE html><html><head><meta charset="UTF-8"/></head><body>'
+        '<div id="mw-content-text"><div id="toc"><ul>'
+        '<li class="toclevel-1"><a href="#x">Contents</a></li></ul></div>\n%s\n'
+        '</div></body></html>' % "\n".join(body))
+
+def generate_corpus(root, project_name, pages, days_per_page, entries_per_day, seed=0):
+    '''Write a synthetic cache for project_name under the workspace root.
+
+    Pages are written to the project's cache dir and packed into its cache
+    tar, the same layout the crawler leaves behind. Returns the page count.
+    '''
+    rng = random.Random(seed)
+    kinds = []
+    for kind, weight in sorted(format_mix.items()):
+        kinds.extend([kind] * weight)
+    clean_name = projects.clean_name(project_name)
+    cache = os.path.join("output", "projects", clean_name, "cache")
+    os.makedirs(os.path.join(root, cache))
+    # Newest page covers the most recent days
+    day = calendar.timegm((2015, 11, 30, 0, 0, 0))
+    oldid = 700000000
+    for i in range(pages):
+        days = [day - 86400 * d for d in range(days_per_page)]
+        day -= 86400 * days_per_page
+        contd = i > 0 and rng.random() < contd_rate
+        huge = rng.random() < huge_rate
+        html = make_page(days, entries_per_day, contd, huge, rng, kinds)
+        with open(os.path.join(root, cache, "oldid=%d.html" % oldid), "wb") as f:
+            f.write(html)
+        oldid -= rng.randint(1, 1000)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        crawler.write_cache_tar(clean_name)
+    finally:
+        os.chdir(cwd)
+    return pages
+
+def make_workspace():
+    root = tempfile.mkdtemp(prefix="wikiproject-bench-")
+    for d in ["projects", "projects_crawled", "assessments"]:
+        os.makedirs(os.path.join(root, "output", d))
+    return root
+
+def peak_rss():
+    '''Peak resident set size of this process in MB.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def load_pages(parser):
+    page_ids, read_page = parser.open_cache_dir(bench_project)
+    return [read_page(page) for page in page_ids]
+
+def extract_all(parser, pages):
+    extract_page = parser.page_backends[parser.page_backend]
+    return [extract_page(html) for html in pages]
+
+def stage_extract(parser):
+    pages = load_pages(parser)
+    start = time.time()
+    extract_all(parser, pages)
+    return time.time() - start, len(pages), "pages"
+
+def stage_get_entry(parser):
+    lines = []
+    for contd, blocks, huge in extract_all(parser, load_pages(parser)):
+        for kind, value in blocks or []:
+            if kind == "ul":
+                lines.extend(value)
+    logger = parser.logging.getLogger("benchmark")
+    start = time.time()
+    for text, links in lines:
+        try:
+            parser.get_entry(bench_project, 0, text, links, logger)
+        except StopIteration:
+            pass
+    return time.time() - start, len(lines), "lines"
+
+def stage_parse_date(parser):
+    dates = []
+    for contd, blocks, huge in extract_all(parser, load_pages(parser)):
+        for kind, value in blocks or []:
+            if kind == "date":
+                dates.append(value)
+    start = time.time()
+    for date in dates:
+        parser.parse_date(date)
+    return time.time() - start, len(dates), "dates"
+
+def stage_write(parser):
+    logger = parser.logging.getLogger("benchmark")
+    stats = {}
+    page_ids, read_page = parser.open_cache_dir(bench_project)
+    entries = parser.parse_pages(bench_project, page_ids, read_page, logger, stats)
+    rows = [entries[k] for k in sorted(entries.keys())]
+    start = time.time()
+    parser.write_assessments(bench_project, rows, logger)
+    return time.time() - start, len(rows), "rows"
+
+def stage_end_to_end(parser):
+    start = time.time()
+    parser.parse(bench_project, from_tar=True)
+    stats = parser.metrics.read_latest(parser.metrics.parse_metrics % bench_project)
+    return time.time() - start, stats["pages"], "pages"
+
+stages = [
+    ("extract", stage_extract),
+    ("get_entry", stage_get_entry),
+    ("parse_date", stage_parse_date),
+    ("write", stage_write),
+    ("end_to_end", stage_end_to_end),
+]
+
+def run_stage(name):
+    '''Run one stage in a pool worker, returning (seconds, count, unit, peak MB).'''
+    import parser
+    # Keep log output from the benchmark out of the way
+    parser.logging.getLogger(bench_project).disabled = True
+    parser.logging.getLogger("benchmark").addHandler(parser.logging.NullHandler())
+    stage = dict(stages)[name]
+    seconds, count, unit = stage(parser)
+    return seconds, count, unit, peak_rss()
+
+def compare(results, baseline):
+    '''Return descriptions of stages that got slower than the baseline.'''
+    regressions = []
+    for name, result in sorted(results.items()):
+        try:
+            base = baseline[name]
+        except KeyError:
+            continue
+        if result["rate"] < base["rate"] * (1 - tolerance):
+            regressions.append("%s: %.1f %s/s, baseline %.1f" % (
+                name, result["rate"], result["unit"], base["rate"]))
+        if result["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+            regressions.append("%s: peak %.1f MB, baseline %.1f MB" % (
+                name, result["peak_mb"], base["peak_mb"]))
+    return regressions
+
+def main():
+    args = sys.argv[1:]
+    save = "--save" in args
+    args = [a for a in args if a != "--save"]
+    scale = args[0] if args else "small"
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+    baseline_path = os.path.join(repo_dir, baseline_file)
+
+    root = make_workspace()
+    try:
+        os.chdir(root)
+        print "Generating %s corpus in %s" % (scale, root)
+        generate_corpus(root, bench_project, **scales[scale])
+        results = {}
+        for name, stage in stages:
+            # One process per stage so each gets its own peak RSS
+            pool = Pool(1, maxtasksperchild=1)
+            seconds, count, unit, peak_mb = pool.apply(run_stage, (name,))
+            pool.close()
+            pool.join()
+            rate = count / seconds if seconds > 0 else 0.0
+            results[name] = {
+                "seconds": seconds, "count": count, "unit": unit,
+                "rate": rate, "peak_mb": peak_mb}
+            print "%-12s %8.3fs %10.1f %s/s  peak %.1f MB" % (
+                name, seconds, rate, unit, peak_mb)
+    finally:
+        os.chdir(repo_dir)
+        shutil.rmtree(root)
+
+    baseline = {}
+    try:
+        with open(baseline_path, "rb") as f:
+            baseline = json.load(f).get(scale, {})
+    except IOError:
+        pass
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print "REGRESSION %s" % regression
+    if save:
+        try:
+            with open(baseline_path, "rb") as f:
+                saved = json.load(f)
+        except IOError:
+            saved = {}
+        saved[scale] = results
+        with open(baseline_path, "wb") as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        print "Saved baseline to %s" % baseline_path
+    if regressions and not save:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
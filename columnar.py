@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Compact columnar copy of a project's assessment table
+#
+# Each project gets a directory of .npy files, one per column, that can be
+# memory-mapped instead of re-parsing the utf-8 TSV:
+#   date.npy                  int32 UTC timestamps
+#   action.npy                small-integer codes into meta["action"]
+#   old_qual.npy, new_qual.npy  codes into meta["qual"]
+#   old_imp.npy, new_imp.npy    codes into meta["imp"]
+#   article.npy, new_article.npy, old_article_link.npy, old_talk_link.npy
+#                             int32 ids into the deduplicated string table
+#   string_offsets.npy, string_data.npy
+#                             string table, string i is the utf-8 bytes
+#                             string_data[offsets[i]:offsets[i + 1]]
+#   meta.json                 project name, row count and code vocabularies
+# Code and string id 0 is always the empty string.
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+import projects
+
+# Config
+columnar_dir = "output/assessments_columnar/%s"
+
+# Columns of the TSV entry rows, see config.columns
+category_columns = [
+    ("action", 2, "action"),
+    ("old_qual", 4, "qual"),
+    ("new_qual", 5, "qual"),
+    ("old_imp", 6, "imp"),
+    ("new_imp", 7, "imp"),
+]
+string_columns = [
+    ("article", 3),
+    ("new_article", 8),
+    ("old_article_link", 9),
+    ("old_talk_link", 10),
+]
+
+def project_path(project_name):
+    return columnar_dir % projects.quoted_name(project_name)
+
+def code_dtype(vocab):
+    if len(vocab) <= 256:
+        return np.uint8
+    return np.uint16
+
+def write_columnar(project_name, rows):
+    '''Write entry rows (as produced by parser.get_entry) for a project.
+
+    The table is written to a temporary directory and moved into place, so
+    readers never see a partial table. Returns the table's path.
+    '''
+    vocabs = {"action": {u"": 0}, "qual": {u"": 0}, "imp": {u"": 0}}
+    strings = {u"": 0}
+    dates = []
+    codes = dict((name, []) for name, i, vocab in category_columns)
+    ids = dict((name, []) for name, i in string_columns)
+    for row in rows:
+        dates.append(row[1])
+        for name, i, vocab in category_columns:
+            value = unicode(row[i])
+            codes[name].append(vocabs[vocab].setdefault(value, len(vocabs[vocab])))
+        for name, i in string_columns:
+            value = unicode(row[i])
+            ids[name].append(strings.setdefault(value, len(strings)))
+
+    path = project_path(project_name)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "date.npy"), np.array(dates, dtype=np.int32))
+    vocab_lists = {}
+    for vocab, values in vocabs.items():
+        vocab_lists[vocab] = sorted(values, key=values.get)
+    for name, i, vocab in category_columns:
+        dtype = code_dtype(vocab_lists[vocab])
+        np.save(os.path.join(tmp_path, "%s.npy" % name), np.array(codes[name], dtype=dtype))
+    for name, i in string_columns:
+        np.save(os.path.join(tmp_path, "%s.npy" % name), np.array(ids[name], dtype=np.int32))
+
+    encoded = [s.encode('utf-8') for s in sorted(strings, key=strings.get)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    data = np.array(bytearray("".join(encoded)), dtype=np.uint8)
+    np.save(os.path.join(tmp_path, "string_offsets.npy"), offsets)
+    np.save(os.path.join(tmp_path, "string_data.npy"), data)
+
+    meta = {"project": project_name, "rows": len(dates)}
+    meta.update(vocab_lists)
+    with open(os.path.join(tmp_path, "meta.json"), "wb") as f:
+        json.dump(meta, f, sort_keys=True)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return path
+
+def read_columnar(project_name, mmap_mode='r'):
+    '''Return (meta, columns) for a project, columns maps name to array.
+
+    Arrays are memory-mapped read-only unless mmap_mode is None.
+    '''
+    path = project_path(project_name)
+    with open(os.path.join(path, "meta.json"), "rb") as f:
+        meta = json.load(f)
+    columns = {}
+    names = (
+        ["date", "string_offsets", "string_data"]
+        + [name for name, i, vocab in category_columns]
+        + [name for name, i in string_columns])
+    for name in names:
+        column_path = os.path.join(path, "%s.npy" % name)
+        try:
+            columns[name] = np.load(column_path, mmap_mode=mmap_mode)
+        except ValueError:
+            # Empty arrays can't be memory-mapped
+            columns[name] = np.load(column_path)
+    return meta, columns
+
+def get_string(columns, string_id):
+    '''Decode string string_id from the string table.'''
+    offsets = columns["string_offsets"]
+    start, end = offsets[string_id], offsets[string_id + 1]
+    return columns["string_data"][start:end].tostring().decode('utf-8')
+
+def iter_rows(project_name):
+    '''Yield rows in the same form as the TSV, for checking and export.'''
+    meta, columns = read_columnar(project_name)
+    for r in xrange(meta["rows"]):
+        row = [meta["project"], int(columns["date"][r])]
+        row.extend([u""] * 9)
+        for name, i, vocab in category_columns:
+            row[i] = meta[vocab][columns[name][r]]
+        for name, i in string_columns:
+            row[i] = get_string(columns, columns[name][r])
+        yield row
@@ -9,97 +9,525 @@ import codecs
 from collections import OrderedDict
 import datetime
 from dateutil.parser import parse
+import heapq
+import httplib
+import json
 import logging
-from multiprocessing import Pool, Process, Queue
+from multiprocessing import Pool, Process, Queue, Value
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
 from Queue import Empty
 import re
 import shutil
+import socket
 import sys
 import subprocess
+import tarfile
+import threading
 import time
 import traceback
+import zlib
 
 from bs4 import BeautifulSoup
 import urllib
+import urlparse
+
+import metrics
+import pagestore
+import projects
+import registry
 
 # Config
 num_workers = 25
-project_tsv = "data/projects-2016-10-12.utf-16-le.tsv"
+# Revisions fetched at once by each worker
+fetch_threads = 4
+# Requests per second across all workers, 0 for no limit
+max_request_rate = 10.0
+fetch_timeout = 60
+# Sent with every request. Wikimedia throttles or blocks clients without a
+# descriptive User-Agent, and asks for a way to contact whoever runs them.
+user_agent = "WikiProjectShocks/1.0 (University of Michigan research on WikiProject assessment logs)"
 output_dir = "output/projects/%s"
 project_log = "output/projects/%s/project.log"
-to_crawl = "output/to_crawl/%s"
-to_parse = "output/to_parse/%s"
 cache_dir = "output/projects/%s/cache"
 cache_tar = "output/projects_crawled/%s-cache.tgz"
+# Keep pages in the deduplicated page store, see pagestore.py, instead of
+# the cache dir and cache tar. Tars from earlier crawls are moved into it.
+cache_store = True
 base_url = "https://en.wikipedia.org/"
 assessment_history_url = (
     "https://en.wikipedia.org/w/index.php?title=Wikipedia:Version_1.0_Editorial_Team/%s_articles_by_quality_log&offset=%s&limit=500&action=history"
 )
+# Failed crawls are retried this many times, the first retry after
+# retry_backoff seconds and each one after that twice as long as the last
+crawl_retries = 2
+retry_backoff = 60
+# Seconds between checks on the workers
+poll_interval = 1
+# Projects are crawled largest first. Those never crawled get their size
+# from their log's info page, one request each, if this is set.
+size_prepass = True
+assessment_info_url = (
+    "https://en.wikipedia.org/w/index.php?title=Wikipedia:Version_1.0_Editorial_Team/%s_articles_by_quality_log&action=info"
+)
+# Revision listing backend, "html" scrapes action=history pages and "api"
+# pages through a MediaWiki API revisions query
+revision_backend = "html"
+api_batch_size = 500
+assessment_api_url = (
+    "https://en.wikipedia.org/w/api.php?action=query&format=json&formatversion=2&prop=revisions&rvprop=ids&titles=Wikipedia:Version_1.0_Editorial_Team/%s_articles_by_quality_log&rvlimit=%d"
+)
+assessment_revision_url = (
+    "https://en.wikipedia.org/w/index.php?title=Wikipedia:Version_1.0_Editorial_Team/%s_articles_by_quality_log&oldid=%d"
+)
+# Recorded API responses, one per line, used instead of the API if present
+revision_dump = "output/projects/%s/revisions.jsonl"
+# Main log, main() sets up its handler
 logger = logging.getLogger('crawler_main')
-handler = logging.FileHandler('output/main.log')
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
 
-def crawl_worker(project_q, logger):
-    while not project_q.empty():
+cache_re = re.compile(r"oldid=(\d+)\.html$")
+oldid_re = re.compile(r"oldid=(\d+)")
+# Edit count row of an action=info page
+info_edits_re = re.compile(
+    r'id="mw-pageinfo-edits".*?</td>\s*<td[^>]*>([\d,.\s]+)</td>', re.S)
+
+# Earliest time the next request may start, shared by all workers
+next_request_time = Value('d', 0.0)
+# Keep-alive connections, one per host for each fetching thread
+connections = threading.local()
+
+def wait_for_request_slot():
+    '''Block until a request can be made without going over max_request_rate.'''
+    if max_request_rate <= 0:
+        return
+    with next_request_time.get_lock():
+        now = time.time()
+        slot = max(now, next_request_time.value)
+        next_request_time.value = slot + 1.0 / max_request_rate
+    if slot > now:
+        time.sleep(slot - now)
+
+def get_connection(scheme, host):
+    '''Return this thread's connection to host, opening it if necessary.'''
+    try:
+        pool = connections.pool
+    except AttributeError:
+        pool = connections.pool = {}
+    try:
+        return pool[(scheme, host)]
+    except KeyError:
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, timeout=fetch_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=fetch_timeout)
+        pool[(scheme, host)] = conn
+        return conn
+
+def close_connection(scheme, host):
+    try:
+        conn = connections.pool.pop((scheme, host))
+    except (AttributeError, KeyError):
+        return
+    conn.close()
+
+def fetch(url):
+    '''GET url over a reused connection, returning (status, body).
+
+    A request that fails on a connection the server has since closed is
+    retried once on a new connection.
+    '''
+    parts = urlparse.urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    for attempt in range(2):
+        wait_for_request_slot()
+        conn = get_connection(parts.scheme, parts.netloc)
         try:
-            project_name = project_q.get(1)
-        except Empty:
-            pass
+            conn.request("GET", path, headers={
+                "Accept-Encoding": "gzip", "User-Agent": user_agent})
+            response = conn.getresponse()
+            body = response.read()
+            break
+        except (httplib.HTTPException, socket.error):
+            close_connection(parts.scheme, parts.netloc)
+            if attempt > 0:
+                raise IOError("Unable to fetch: %s" % url)
+    if response.getheader("content-encoding") == "gzip":
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if response.getheader("connection", "").lower() == "close":
+        close_connection(parts.scheme, parts.netloc)
+    return response.status, body
+
+def crawl_worker(task_q, result_q, worker_id):
+    '''Crawl each project sent on task_q until it sends None.
+
+    Puts (worker_id, project, status) on result_q after each project.
+    '''
+    # Connections copied from the parent would be shared with it
+    connections.pool = {}
+    while True:
+        project_name = task_q.get()
+        if project_name is None:
+            break
         logger.info("Starting: %s" % project_name)
         try:
-            crawl(project_name)
+            status = crawl(project_name)
         except:
             logger.error("Error: %s" % str(sys.exc_info()))
-            raise
+            registry.fail(project_name, "crawl", traceback.format_exc())
+            status = "failed"
         logger.info("Finished: %s" % project_name)
+        result_q.put((worker_id, project_name, status))
+
+def start_worker(worker_id, result_q):
+    '''Start a worker process, returning it and the queue for its projects.'''
+    task_q = Queue()
+    p = Process(target=crawl_worker, args=(task_q, result_q, worker_id))
+    p.start()
+    return p, task_q
+
+def run_workers(project_names):
+    '''Crawl project_names, in order, with num_workers worker processes.
+
+    A worker is sent the next project whenever it becomes idle, so the
+    first projects run in parallel and the small ones at the end fill in
+    around the long crawls. Projects that fail, or whose worker dies, are
+    retried after a backoff. Returns the projects that still failed.
+    '''
+    # Next project at the end
+    queued = list(reversed(project_names))
+    # (time, project) for failed projects waiting to be retried
+    retries = []
+    attempts = {}
+    failed = []
+    result_q = Queue()
+    workers = {}
+    # Worker id to the project it's crawling
+    assigned = {}
+
+    def project_failed(project_name):
+        attempts[project_name] = attempts.get(project_name, 0) + 1
+        if attempts[project_name] > crawl_retries:
+            logger.error("Giving up on: %s" % project_name)
+            failed.append(project_name)
+            return
+        delay = retry_backoff * 2 ** (attempts[project_name] - 1)
+        logger.info("Retrying in %ds: %s" % (delay, project_name))
+        heapq.heappush(retries, (time.time() + delay, project_name))
+
+    try:
+        logger.info("Creating workers")
+        for i in range(min(num_workers, len(project_names))):
+            workers[i] = start_worker(i, result_q)
+        while queued or retries or assigned:
+            now = time.time()
+            while retries and retries[0][0] <= now:
+                queued.append(heapq.heappop(retries)[1])
+            for worker_id in sorted(workers):
+                if not queued:
+                    break
+                if worker_id not in assigned:
+                    assigned[worker_id] = queued.pop()
+                    workers[worker_id][1].put(assigned[worker_id])
+
+            try:
+                worker_id, project_name, status = result_q.get(timeout=poll_interval)
+            except Empty:
+                pass
+            else:
+                # A worker that was replaced may still report its last project
+                if assigned.get(worker_id) == project_name:
+                    del assigned[worker_id]
+                    if status == "failed":
+                        project_failed(project_name)
+
+            # Replace workers that died, failing the project they had
+            for worker_id, (p, task_q) in workers.items():
+                if p.is_alive():
+                    continue
+                p.join()
+                project_name = assigned.pop(worker_id, None)
+                logger.error("Worker %d exited with code %s" % (worker_id, p.exitcode))
+                if project_name is not None:
+                    registry.fail(project_name, "crawl",
+                                  "Worker exited with code %s" % p.exitcode)
+                    project_failed(project_name)
+                workers[worker_id] = start_worker(worker_id, result_q)
+    except:
+        logger.error("Exception: %s" % str(sys.exc_info()))
+        logger.info("Stopping workers")
+        for p, task_q in workers.values():
+            p.terminate()
+        raise
+
+    logger.info("Stopping workers")
+    for p, task_q in workers.values():
+        task_q.put(None)
+    for p, task_q in workers.values():
+        p.join()
+    return failed
+
+def get_info_revisions(project_name):
+    '''Number of edits to the project's log from its info page, or None.'''
+    url = assessment_info_url % urllib.quote(project_name.encode('utf-8'))
+    try:
+        status, body = fetch(url)
+    except IOError:
+        return None
+    if status != 200:
+        return None
+    m = info_edits_re.search(body)
+    if m is None:
+        return None
+    digits = re.sub(r"\D", "", m.group(1))
+    if not digits:
+        return None
+    return int(digits)
+
+def get_expected_sizes(project_names):
+    '''Return a dict from project name to its expected number of revisions.
+
+    Sizes are the revisions cached by the last crawl, or for projects never
+    crawled the edits on their log's info page if size_prepass is set.
+    Projects with neither are left out.
+    '''
+    known = {}
+    for row in registry.get_status():
+        if row["Stage"] == "crawl" and row["Rows"] is not None:
+            known[row["Project"]] = row["Rows"]
+    sizes = dict((p, known[p]) for p in project_names if p in known)
+    unknown = [p for p in project_names if p not in sizes]
+    if size_prepass and unknown:
+        logger.info("Getting the size of %d projects" % len(unknown))
+        pool = ThreadPool(fetch_threads)
+        try:
+            counts = pool.map(get_info_revisions, unknown)
+        finally:
+            pool.close()
+            pool.join()
+        for project_name, count in zip(unknown, counts):
+            if count is not None:
+                sizes[project_name] = count
+    return sizes
+
+def order_by_size(project_names, sizes):
+    '''Largest projects first, so the longest crawls don't start last.
+
+    Projects of unknown size could be the largest and go before the rest.
+    '''
+    return sorted(project_names, key=lambda p: (p in sizes, -sizes.get(p, 0), p))
 
 def crawl(project_name):
-    
+    '''Crawl a project, returning "complete", "unchanged", "failed" or "skipped".'''
+    # Make sure project hasn't already been crawled and no other worker has
+    # it. Claim before creating the folder, a project without one is new.
+    claimed = registry.claim(project_name, "crawl")
+
     # Create project folder and log
-    clean_name = project_name.replace("/", "_")
+    clean_name = projects.clean_name(project_name)
     project_dir = output_dir % clean_name
     try:
         os.stat(project_dir)
     except OSError:
         os.mkdir(project_dir)
-        with open(to_crawl % clean_name, "wb") as f:
-            f.write(project_name.encode('utf-8'))
-        with open(to_parse % clean_name, "wb") as f:
-            f.write(project_name.encode('utf-8'))
     logger = logging.getLogger(project_name)
     fh = logging.FileHandler(project_log % clean_name)
     logger.addHandler(fh)
     logger.setLevel(logging.DEBUG)
-    
-    # Make sure project hasn't already been crawled
+    store_conn = None
+    # Workers crawl many projects, each one's log and store are closed
     try:
-        os.stat(to_crawl % clean_name)
-    except OSError:
-        logger.info("Already crawled, skipping")
-        return
+        if not claimed:
+            logger.info("Already crawled, skipping")
+            return "skipped"
+        if cache_store:
+            store_conn = pagestore.connect(clean_name)
+        return crawl_claimed(project_name, logger, store_conn)
+    finally:
+        if store_conn is not None:
+            store_conn.close()
+        logger.removeHandler(fh)
+        fh.close()
+
+def crawl_claimed(project_name, logger, store_conn):
+    '''Crawl a project claimed by crawl(), into store_conn if cache_store is set.'''
+    clean_name = projects.clean_name(project_name)
+    stats = {"project": project_name}
+    start = time.time()
     
+    # Only fetch revisions that aren't cached yet. The tar is only written
+    # once a crawl is complete, so listing can stop at its newest revision.
+    # The store records the newest revision of its last complete crawl.
+    if cache_store:
+        import_cache(clean_name, store_conn, logger)
+        dir_oldids, tar_oldids = pagestore.get_oldids(store_conn), set()
+        stop_oldid = pagestore.get_meta(store_conn, "crawled_to")
+    else:
+        dir_oldids, tar_oldids = get_cached_oldids(clean_name)
+        if tar_oldids:
+            stop_oldid = max(tar_oldids)
+        else:
+            stop_oldid = None
     try:
-        revision_urls = get_assessment_revisions(project_name, logger)
+        if revision_backend == "api":
+            revision_urls = get_api_revisions(project_name, logger, stop_oldid)
+        else:
+            revision_urls = get_assessment_revisions(project_name, logger, stop_oldid)
+        metrics.add_time(stats, "list_time", start)
+        stats["revisions_listed"] = len(revision_urls)
+        listed_oldids = set(int(oldid_re.search(url).groups()[0]) for url in revision_urls)
+        cached_oldids = dir_oldids | tar_oldids
+        new_urls = [url for url in revision_urls
+                    if int(oldid_re.search(url).groups()[0]) not in cached_oldids]
+        # Size of the project for scheduling the next run
+        revisions = len(listed_oldids | cached_oldids)
+        logger.info("%d revisions already cached, %d to fetch" % (
+            len(revision_urls) - len(new_urls), len(new_urls)))
+        crawl_revisions(project_name, new_urls, logger, stats, store_conn)
     except IOError:
-        # Unable to get urls, return without marking finished
-        return
-    crawl_revisions(project_name, revision_urls, logger)
-    
-    # Mark finished
-    os.remove(to_crawl % clean_name)
-    logger.info("Compressing results")
+        # Unable to get all pages, return without marking finished
+        registry.fail(project_name, "crawl", traceback.format_exc())
+        if stats.get("pages_fetched"):
+            # The pages that were stored need parsing once the crawl is done
+            registry.reset([project_name], "parse")
+        stats["status"] = "failed"
+        stats["elapsed"] = time.time() - start
+        metrics.write_metrics(metrics.crawl_metrics % clean_name, stats)
+        return "failed"
+
+    # New revisions need parsing along with the old ones. Parsing waits for
+    # the crawl to be done, see parser.parse_project().
+    if stats.get("pages_fetched"):
+        registry.reset([project_name], "parse")
+
+    if cache_store:
+        if listed_oldids:
+            pagestore.set_meta(store_conn, "crawled_to", max(listed_oldids))
+        if stop_oldid is not None:
+            if not new_urls:
+                logger.info("No new revisions")
+                registry.finish(project_name, "crawl", revisions)
+                stats["status"] = "unchanged"
+                stats["elapsed"] = time.time() - start
+                metrics.write_metrics(metrics.crawl_metrics % clean_name, stats)
+                return "unchanged"
+        registry.finish(project_name, "crawl", revisions)
+        stats["status"] = "complete"
+        stats["elapsed"] = time.time() - start
+        metrics.write_metrics(metrics.crawl_metrics % clean_name, stats)
+        logger.info("Crawling complete")
+        return "complete"
+
     project_cache_tar = cache_tar % clean_name
     project_cache_dir = cache_dir % clean_name
-    subprocess.call(["tar", "-czf", project_cache_tar, project_cache_dir])
+    if tar_oldids:
+        if len(os.listdir(project_cache_dir)) == 0:
+            logger.info("No new revisions")
+            shutil.rmtree(project_cache_dir)
+            registry.finish(project_name, "crawl", revisions)
+            stats["status"] = "unchanged"
+            stats["elapsed"] = time.time() - start
+            metrics.write_metrics(metrics.crawl_metrics % clean_name, stats)
+            return "unchanged"
+        logger.info("Merging previous results")
+        subprocess.call(["tar", "-xzf", project_cache_tar])
+    logger.info("Compressing results")
+    t = time.time()
+    write_cache_tar(clean_name)
+    metrics.add_time(stats, "tar_time", t)
     logger.info("Removing uncompressed results")
     shutil.rmtree(project_cache_dir)
+    # Mark finished
+    registry.finish(project_name, "crawl", revisions)
+    stats["status"] = "complete"
+    stats["elapsed"] = time.time() - start
+    metrics.write_metrics(metrics.crawl_metrics % clean_name, stats)
     logger.info("Crawling complete")
-    return project_name
+    return "complete"
 
-def get_assessment_revisions(project, logger):
+def write_cache_tar(clean_name):
+    '''Write a project's cache dir to its cache tar, newest page first.
+
+    parser.open_cache_tar() asks for pages newest first, so it reads a tar in
+    this order in one streaming pass without deferring any of them.
+    '''
+    project_cache_dir = cache_dir % clean_name
+    project_cache_tar = cache_tar % clean_name
+    names = [name for name in os.listdir(project_cache_dir) if cache_re.search(name)]
+    names.sort(key=lambda name: int(cache_re.search(name).group(1)), reverse=True)
+    # Same compression as the gzip tool, and written under another name so
+    # a crash never leaves a partial tar
+    tar = tarfile.open(project_cache_tar + ".part", "w:gz", compresslevel=6)
+    try:
+        for name in names:
+            tar.add(os.path.join(project_cache_dir, name))
+    finally:
+        tar.close()
+    os.rename(project_cache_tar + ".part", project_cache_tar)
+
+def import_cache(clean_name, conn, logger):
+    '''Move the pages in a project's cache tar and cache dir into its store.
+
+    A tar is only written by a complete crawl, so its newest page is where
+    the store's crawled_to starts.
+    '''
+    project_cache_tar = cache_tar % clean_name
+    if os.path.exists(project_cache_tar):
+        logger.info("Moving %s into the page store" % project_cache_tar)
+        tar_oldids = set()
+        tar = tarfile.open(project_cache_tar, "r|gz")
+        try:
+            for member in tar:
+                m = re.match(cache_re, os.path.basename(member.name))
+                if member.isfile() and m:
+                    oldid = int(m.groups()[0])
+                    pagestore.put_page(conn, oldid, tar.extractfile(member).read())
+                    tar_oldids.add(oldid)
+        finally:
+            tar.close()
+        if tar_oldids and max(tar_oldids) > pagestore.get_meta(conn, "crawled_to", 0):
+            pagestore.set_meta(conn, "crawled_to", max(tar_oldids))
+        os.remove(project_cache_tar)
+    project_cache_dir = cache_dir % clean_name
+    if os.path.exists(project_cache_dir):
+        logger.info("Moving %s into the page store" % project_cache_dir)
+        for name in os.listdir(project_cache_dir):
+            m = re.match(cache_re, name)
+            if m:
+                with open(os.path.join(project_cache_dir, name), "rb") as f:
+                    pagestore.put_page(conn, int(m.groups()[0]), f.read())
+        shutil.rmtree(project_cache_dir)
+
+def get_cached_oldids(clean_name):
+    '''Return the oldids in the cache dir and in the cache tar, as two sets.'''
+    dir_oldids = set()
+    try:
+        for name in os.listdir(cache_dir % clean_name):
+            m = re.match(cache_re, name)
+            if m:
+                dir_oldids.add(int(m.groups()[0]))
+    except OSError:
+        pass
+    tar_oldids = set()
+    if not os.path.exists(cache_tar % clean_name):
+        return dir_oldids, tar_oldids
+    tar = tarfile.open(cache_tar % clean_name, "r|gz")
+    try:
+        for member in tar:
+            m = re.match(cache_re, os.path.basename(member.name))
+            if m:
+                tar_oldids.add(int(m.groups()[0]))
+    finally:
+        tar.close()
+    return dir_oldids, tar_oldids
+
+def get_assessment_revisions(project, logger, stop_oldid=None):
+    '''List revision urls newest first.
+
+    If stop_oldid is given, stop paging after the page that reaches it.
+    '''
     
     logger.info("Getting assessment revision urls")
     assessment_urls = []
@@ -108,73 +536,191 @@ def get_assessment_revisions(project, logger):
     while next_url is not None:
         # Request next page of history and parse
         logger.info("Requesting: %s" % next_url)
-        handle = urllib.urlopen(next_url)
-        if handle.getcode() != 200:
-            logger.error("HTTP %d when fetching: %s" % (handle.getcode(), next_url))
+        status, gunk_bytes = fetch(next_url)
+        if status != 200:
+            logger.error("HTTP %d when fetching: %s" % (status, next_url))
             raise IOError
-        gunk_bytes = handle.read()
         soup = BeautifulSoup(gunk_bytes, 'html.parser')
 
         # Add url for each revision
         revisions = soup.findAll("a", {"class": "mw-changeslist-date"})
+        reached_stop = False
         for rev in revisions:
-            assessment_urls.append("%s%s" % (base_url, rev.get('href')))
+            url = "%s%s" % (base_url, rev.get('href'))
+            assessment_urls.append(url)
+            if (
+                stop_oldid is not None
+                and int(oldid_re.search(url).groups()[0]) <= stop_oldid
+            ):
+                reached_stop = True
         
         # Get next page url
         try:
             next_url = base_url + soup.find("a", {"class": "mw-nextlink"}).get('href')
         except AttributeError:
             next_url = None
+        if reached_stop:
+            logger.info("Reached cached revisions, stopping")
+            next_url = None
 
     logger.info("Parsed %d assessment revision urls" % len(assessment_urls))
     
     return assessment_urls
 
-def crawl_revisions(project_name, revision_urls, logging):
+def get_api_responses(project, logger):
+    '''Yield decoded revisions query responses, following continuation.
+
+    Responses come from the project's revision_dump if there is one.
+    '''
+    dump_path = revision_dump % projects.clean_name(project)
+    if os.path.exists(dump_path):
+        logger.info("Reading revisions from: %s" % dump_path)
+        with open(dump_path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    enc_project = urllib.quote(project.encode('utf-8'))
+    base_query = assessment_api_url % (enc_project, api_batch_size)
+    next_url = base_query + "&continue="
+    while next_url is not None:
+        logger.info("Requesting: %s" % next_url)
+        status, body = fetch(next_url)
+        if status != 200:
+            logger.error("HTTP %d when fetching: %s" % (status, next_url))
+            raise IOError
+        try:
+            response = json.loads(body)
+        except ValueError:
+            logger.error("Invalid JSON from: %s" % next_url)
+            raise IOError
+        if "error" in response:
+            logger.error("API error %s from: %s" % (response["error"], next_url))
+            raise IOError
+        yield response
+        try:
+            next_url = base_query + "&" + urllib.urlencode(
+                [(k, v.encode('utf-8')) for k, v in sorted(response["continue"].items())])
+        except KeyError:
+            next_url = None
+
+def get_api_revisions(project, logger, stop_oldid=None):
+    '''List revision urls newest first from revisions query responses.
+
+    Same as get_assessment_revisions(), without any HTML to parse.
+    '''
+    logger.info("Getting assessment revision ids")
+    assessment_urls = []
+    enc_project = urllib.quote(project.encode('utf-8'))
+    for response in get_api_responses(project, logger):
+        pages = response.get("query", {}).get("pages", [])
+        # formatversion=1 responses key pages by page id
+        if isinstance(pages, dict):
+            pages = pages.values()
+        reached_stop = False
+        for page in pages:
+            for rev in page.get("revisions", []):
+                oldid = int(rev["revid"])
+                assessment_urls.append(assessment_revision_url % (enc_project, oldid))
+                if stop_oldid is not None and oldid <= stop_oldid:
+                    reached_stop = True
+        if reached_stop:
+            logger.info("Reached cached revisions, stopping")
+            break
+
+    logger.info("Listed %d assessment revision urls" % len(assessment_urls))
+
+    return assessment_urls
+
+def crawl_revision(url, project_cache_dir, logging, store_conn=None):
+    '''Fetch one revision into the cache, or into the page store if given.
+
+    Returns (bytes, seconds) for the fetch, or None if it failed.
+    '''
+    logging.info("Crawling: %s" % url)
+    oldid = oldid_re.search(url).group()
+    output_file = os.path.join(project_cache_dir, "%s.html" % oldid)
+    start = time.time()
+    try:
+        status, body = fetch(url)
+    except IOError:
+        logging.error("Unable to fetch: %s" % url)
+        return None
+    latency = time.time() - start
+    if status != 200:
+        logging.error("HTTP %d when fetching: %s" % (status, url))
+        return None
+    if store_conn is not None:
+        # One transaction, so a crash never leaves a partial page
+        pagestore.put_page(store_conn, int(oldid_re.search(url).groups()[0]), body)
+        logging.info("Cached: %s" % url)
+        return len(body), latency
+    # Write to a temporary name so a crash never leaves a partial page
+    with open(output_file + ".part", "wb") as f:
+        f.write(body)
+    os.rename(output_file + ".part", output_file)
+    logging.info("Cached: %s" % url)
+    return len(body), latency
+
+def crawl_revisions(project_name, revision_urls, logging, stats=None, store_conn=None):
+    '''Fetch revision_urls into the cache, adding fetch counts to stats.
+
+    Pages go into the page store instead if store_conn is given.
+    '''
+    if stats is None:
+        stats = {}
     logging.info("Crawling revisions")
     # Create dir if necessary
-    clean_name = project_name.replace('/', '_')
+    clean_name = projects.clean_name(project_name)
+    project_cache_dir = cache_dir % clean_name
+    if store_conn is None:
+        try:
+            os.stat(project_cache_dir)
+        except OSError:
+            os.mkdir(project_cache_dir)
+        # Remove pages left half written by an earlier run
+        for name in os.listdir(project_cache_dir):
+            if name.endswith(".part"):
+                os.remove(os.path.join(project_cache_dir, name))
+    start = time.time()
+    pool = ThreadPool(fetch_threads)
     try:
-        os.stat(cache_dir % clean_name)
-    except OSError:
-        os.mkdir(cache_dir % clean_name)
-    for url in revision_urls:
-        logging.info("Crawling: %s" % url)
-        oldid = re.search(r'oldid=(\d+)', url).group()
-        output_file = os.path.join(cache_dir % clean_name, "%s.html" % oldid)
-        urllib.urlretrieve(url, output_file)
-        logging.info("Cached: %s" % url)
+        results = pool.map(
+            lambda url: crawl_revision(url, project_cache_dir, logging, store_conn),
+            revision_urls, 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+    metrics.add_time(stats, "fetch_time", start)
+    fetched = [r for r in results if r is not None]
+    failed = len(results) - len(fetched)
+    stats["pages_fetched"] = len(fetched)
+    stats["pages_failed"] = failed
+    stats["bytes"] = sum(size for size, latency in fetched)
+    stats["latency"] = metrics.latency_summary([latency for size, latency in fetched])
+    if failed > 0:
+        logging.error("Failed to fetch %d of %d revisions" % (failed, len(revision_urls)))
+        raise IOError
 
-# Load project names, ignore duplicates
-project_names = []
-unique_names = set()
-with open(project_tsv, "rb") as f:
-    lines = enumerate(f.read().decode('utf-16-le').split(u"\n"))
-    lines.next()
-    for i, line in lines:
-        if len(line) == 0:
-            continue
-        name, unique = line.split(u"\t")
-        if unique not in unique_names:
-            unique_names.add(unique)
-            project_names.append(name)
-
-# Create pool and start crawling
-project_q = Queue()
-for project_name in sorted(project_names):
-    project_q.put(project_name)
-try:
-    logger.info("Creating workers")
-    workers = []
-    for i in range(num_workers):
-        p = Process(target=crawl_worker, args=(project_q, logger))
-        p.start()
-        workers.append(p)
-    while not project_q.empty():
-        time.sleep(1)
-except:
-    logger.error("Exception: %s" % str(sys.exc_info()))
-    logger.info("Stopping workers")
-    for p in workers:
-        p.terminate()
-    raise
+def main(args=None):
+    handler = logging.FileHandler('output/main.log')
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
+    # Load project names
+    project_names = projects.load_project_names()
+    registry.add_projects(project_names)
+    states = registry.get_states("crawl")
+    to_crawl = [p for p in project_names if states.get(p) != registry.done]
+
+    sizes = get_expected_sizes(to_crawl)
+    to_crawl = order_by_size(to_crawl, sizes)
+    logger.info("Crawling %d projects, %d of known size" % (len(to_crawl), len(sizes)))
+    failed = run_workers(to_crawl)
+    if failed:
+        logger.error("Failed to crawl %d projects: %s" % (len(failed), u", ".join(failed)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Where a project's assessment data can't be trusted
+#
+# Finds two things, for shock detection to skip or discount:
+#   gaps      days missing between the log's date headers, and days whose
+#             log says it was too huge to upload, as intervals
+#   repeats   the same event (article, action and assessments) logged again
+#             within repeat_days of the time before, which parse() can't
+#             drop since the dates differ
+# Gaps come from one streaming pass over the project's cached pages, only
+# looking for date headers and the huge log message instead of parsing
+# them. Repeats come from sorting the project's TSV rows as arrays.
+#
+# Usage: python gaps.py [project ...]
+
+import calendar
+from datetime import datetime
+import os
+import re
+import sys
+import tarfile
+import zlib
+
+import numpy as np
+
+import config
+import pagestore
+import projects
+import store
+
+# Config
+cache_dir = "output/projects/%s/cache"
+cache_tar = "output/projects_crawled/%s-cache.tgz"
+assessment_file = "output/assessments/%s.utf8.tsv"
+gap_file = os.path.join(config.GapFileSystem, "%s.tsv")
+repeat_file = os.path.join(config.RepeatFileSystem, "%s.tsv")
+# Same as parser.end_timestamp, later days aren't parsed
+end_timestamp = 1449100800 # 2015-12-03T00:00:00Z
+# Missing days in a row that make a gap
+min_gap_days = 1
+# Events logged again within this many days are repeats
+repeat_days = 7
+
+huge_text = "The log for today is too huge to upload to the wiki."
+# Date header anchors, see parser.date_pattern
+header_re = re.compile(
+    r'id="((?:January|February|March|April|May|June|July|August|September|'
+    r'October|November|December)_\d{1,2}\.2C_\d{4})"')
+cache_re = re.compile(r"oldid=(\d+)\.html$")
+
+day = 86400
+
+def iter_pages(clean_name):
+    '''Yield the html of every cached page in the page store, tar or cache dir.
+
+    Pages come in stored order, one at a time.
+    '''
+    if pagestore.exists(clean_name):
+        conn = pagestore.connect(clean_name)
+        try:
+            for oldid in sorted(pagestore.get_oldids(conn)):
+                yield pagestore.get_page(conn, oldid)
+        finally:
+            conn.close()
+        return
+    if os.path.exists(cache_tar % clean_name):
+        tar = tarfile.open(cache_tar % clean_name, "r|gz")
+        try:
+            for member in tar:
+                if member.isfile() and cache_re.search(member.name):
+                    yield tar.extractfile(member).read()
+        finally:
+            tar.close()
+        return
+    for name in os.listdir(cache_dir % clean_name):
+        if cache_re.search(name):
+            with open(os.path.join(cache_dir % clean_name, name), "rb") as f:
+                yield f.read()
+
+def header_timestamp(anchor):
+    '''Convert a header anchor like February_26.2C_2010 to a UTC timestamp.'''
+    return calendar.timegm(datetime.strptime(anchor, "%B_%d.2C_%Y").timetuple())
+
+def scan_page(html, days, huge_days):
+    '''Add the days of a page's date headers and of its huge logs to the lists.
+
+    A huge log message belongs to the header before it. Returns False if
+    the page had a message before any header, which can't be placed.
+    '''
+    headers = [(m.start(), m.group(1)) for m in header_re.finditer(html)]
+    for position, anchor in headers:
+        days.append(header_timestamp(anchor))
+    placed = True
+    position = html.find(huge_text)
+    while position >= 0:
+        before = [anchor for start, anchor in headers if start < position]
+        if before:
+            huge_days.append(header_timestamp(before[-1]))
+        else:
+            placed = False
+        position = html.find(huge_text, position + 1)
+    return placed
+
+def get_intervals(days):
+    '''Return (start, end) arrays of the runs of consecutive days in a sorted array.'''
+    if len(days) == 0:
+        return days, days
+    breaks = np.nonzero(np.diff(days) > day)[0]
+    starts = np.concatenate([days[:1], days[breaks + 1]])
+    ends = np.concatenate([days[breaks], days[-1:]])
+    return starts, ends
+
+def find_gaps(clean_name):
+    '''Return (gaps, stats) for a project's pages.
+
+    gaps is a list of (kind, start, end) with kind "missing" or "huge" and
+    start and end the first and last day of the interval.
+    '''
+    days = []
+    huge_days = []
+    stats = {"pages": 0, "unplaced_huge": 0}
+    for html in iter_pages(clean_name):
+        stats["pages"] += 1
+        if not scan_page(html, days, huge_days):
+            stats["unplaced_huge"] += 1
+    days = np.unique(np.array(days, dtype=np.int64))
+    days = days[days <= end_timestamp]
+    huge_days = np.unique(np.array(huge_days, dtype=np.int64))
+    huge_days = huge_days[huge_days <= end_timestamp]
+    stats["days"] = len(days)
+    gaps = []
+    # Missing days are the spaces between runs of days with headers
+    starts, ends = get_intervals(days)
+    missing = (starts[1:] - ends[:-1]) // day - 1
+    for i in np.nonzero(missing >= min_gap_days)[0]:
+        gaps.append(("missing", int(ends[i] + day), int(starts[i + 1] - day)))
+    starts, ends = get_intervals(huge_days)
+    for start, end in zip(starts, ends):
+        gaps.append(("huge", int(start), int(end)))
+    gaps.sort(key=lambda gap: gap[1])
+    return gaps, stats
+
+def find_repeats(project_name):
+    '''Return the rows of a project's TSV that repeat an earlier row.
+
+    Rows are the same event if all but their dates and links match, and a
+    row repeats the one before it if it's within repeat_days. Each is (row,
+    first_date), first_date being the date of the first row in its chain of
+    repeats, so A on days 0, 3 and 6 gives both later rows day 0.
+    '''
+    rows = list(store.read_tsv(assessment_file % projects.quoted_name(project_name)))
+    if len(rows) == 0:
+        return []
+    events = {}
+    codes = np.empty(len(rows), dtype=np.int64)
+    dates = np.empty(len(rows), dtype=np.int64)
+    for i, row in enumerate(rows):
+        codes[i] = events.setdefault(tuple(row[2:9]), len(events))
+        dates[i] = int(row[1])
+    # Same events next to each other, in date order
+    order = np.lexsort((dates, codes))
+    codes = codes[order]
+    dates = dates[order]
+    chained = (codes[1:] == codes[:-1]) & (dates[1:] - dates[:-1] <= repeat_days * day)
+    # Also different dates, same dates are already one entry
+    repeated = chained & (dates[1:] != dates[:-1])
+    # Index of the row each chain starts at
+    starts = np.concatenate([[True], ~chained])
+    first = np.maximum.accumulate(np.where(starts, np.arange(len(dates)), 0))
+    return [
+        (rows[order[i + 1]], int(dates[first[i]]))
+        for i in np.nonzero(repeated)[0]]
+
+def format_day(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+def write_tsv(path, header, lines):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + ".tmp", "wb") as f:
+        f.write(u"\t".join(header).encode('utf-8') + "\n")
+        for line in lines:
+            f.write((u"\t".join([unicode(x) for x in line]) + u"\n").encode('utf-8'))
+    os.rename(path + ".tmp", path)
+
+def get_missing(project_name):
+    '''Return what a project still needs before it can be checked, or None.'''
+    clean_name = projects.clean_name(project_name)
+    if not (pagestore.exists(clean_name) or os.path.exists(cache_tar % clean_name)
+            or os.path.isdir(cache_dir % clean_name)):
+        return "not crawled"
+    if not os.path.exists(assessment_file % projects.quoted_name(project_name)):
+        return "not parsed"
+    return None
+
+def check_project(project_name):
+    '''Write a project's gap and repeat files, returning (gaps, repeats, stats).'''
+    quoted_name = projects.quoted_name(project_name)
+    gaps, stats = find_gaps(projects.clean_name(project_name))
+    write_tsv(
+        gap_file % quoted_name, [u"Project", u"Kind", u"Start", u"End", u"Days"],
+        [[project_name, kind, format_day(start), format_day(end), (end - start) // day + 1]
+         for kind, start, end in gaps])
+    repeats = find_repeats(project_name)
+    write_tsv(
+        repeat_file % quoted_name,
+        [u"Project", u"Date", u"FirstDate", u"Action", u"ArticleName",
+         u"OldQual", u"NewQual", u"OldImp", u"NewImp", u"NewArticleName"],
+        [[project_name, format_day(int(row[1])), format_day(first_date)] + row[2:9]
+         for row, first_date in repeats])
+    return gaps, repeats, stats
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    project_names = args or projects.load_project_names()
+    failed = 0
+    for i, project_name in enumerate(project_names):
+        if not isinstance(project_name, unicode):
+            project_name = project_name.decode('utf-8')
+        missing = get_missing(project_name)
+        if missing is not None:
+            print "%d/%d: %s (%s)" % (i + 1, len(project_names), project_name, missing)
+            continue
+        # Inputs are there, so anything else is a corrupt input or a
+        # failed write
+        try:
+            gaps, repeats, stats = check_project(project_name)
+        except (IOError, OSError, tarfile.TarError, zlib.error) as e:
+            print "%d/%d: %s failed: %r" % (i + 1, len(project_names), project_name, e)
+            failed += 1
+            continue
+        print "%d/%d: %s, %d pages, %d days, %d gaps, %d repeats" % (
+            i + 1, len(project_names), project_name, stats["pages"], stats["days"],
+            len(gaps), len(repeats))
+    if failed:
+        print "%d projects failed" % failed
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
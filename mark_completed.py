@@ -4,66 +4,41 @@
 # Affiliation: Industrial and Operations Engineering, University of Michigan, Ann Arbor
 # File Name: crawler
 # Date: 11/10/16
+#
+# Usage: python mark_completed.py (--all | project ...)
+#   --all marks every crawled project that isn't parsed yet
 
-import codecs
-from collections import OrderedDict
-import datetime
-from dateutil.parser import parse
-import logging
-from multiprocessing import Pool, Process, Queue
-import os
-import os.path
-from Queue import Empty
-import re
-import shutil
 import sys
-import subprocess
-import time
-import traceback
 
-from bs4 import BeautifulSoup
-import urllib
+import registry
 
-# Config
-num_workers = 25
-project_tsv = "data/projects-2016-10-12.utf-16-le.tsv"
-output_dir = "output/projects/%s"
-project_log = "output/projects/%s/project.log"
-to_crawl = "output/to_crawl/%s"
-to_parse = "output/to_parse/%s"
-done_parse = "output/done_parse/%s"
-cache_dir = "output/projects/%s/cache"
-cache_tar = "output/projects_crawled/%s-cache.tgz"
-base_url = "https://en.wikipedia.org/"
-assessment_history_url = (
-    "https://en.wikipedia.org/w/index.php?title=Wikipedia:Version_1.0_Editorial_Team/%s_articles_by_quality_log&offset=%s&limit=500&action=history"
-)
+def get_crawled_unparsed():
+    '''Return the projects whose crawl is done and parse isn't, from the registry.'''
+    crawl_states = registry.get_states("crawl")
+    parse_states = registry.get_states("parse")
+    return sorted(
+        project_name for project_name, state in crawl_states.items()
+        if state == registry.done and parse_states.get(project_name) != registry.done)
 
-# Load project names, ignore duplicates
-project_names = []
-unique_names = set()
-with open(project_tsv, "rb") as f:
-    lines = enumerate(f.read().decode('utf-16-le').split(u"\n"))
-    lines.next()
-    for i, line in lines:
-        if len(line) == 0:
-            continue
-        name, unique = line.split(u"\t")
-        if unique not in unique_names:
-            unique_names.add(unique)
-            project_names.append(name)
+def mark_completed(project_names):
+    '''Mark projects parsed.'''
+    registry.set_state(project_names, "parse", registry.done)
 
-for project_name in sorted(project_names):
-    clean_name = project_name.replace('/', '_')
-    # Try to open file in to_parse
-    try:
-        os.stat(to_parse % clean_name)
-    except OSError:
-        # File is complete, write to done_parse
-        with open(done_parse % clean_name, "wb") as f:
-            print project_name
-            f.write(project_name.encode('utf-8'))
-        try:
-            f.close()
-        except:
-            pass
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    # Projects are only marked if they're named or --all is given, parse()
+    # marks the projects it parses itself
+    if args == ["--all"]:
+        names = get_crawled_unparsed()
+    elif args and "--all" not in args:
+        names = [arg.decode('utf-8') for arg in args]
+    else:
+        print "Usage: python mark_completed.py (--all | project ...)"
+        return 2
+    for project_name in names:
+        print project_name
+    mark_completed(names)
+
+if __name__ == "__main__":
+    sys.exit(main())
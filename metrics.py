@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Per-project timing and throughput metrics for crawl and parse runs
+#
+# Each run appends one JSON record to the project's metrics file, next to
+# project.log and parse.log. Running this script rolls the latest record of
+# every project up into a single TSV summary.
+
+import glob
+import json
+import os
+import time
+
+# Config
+crawl_metrics = "output/projects/%s/crawl_metrics.jsonl"
+parse_metrics = "output/projects/%s/parse_metrics.jsonl"
+summary_file = "output/metrics_summary.tsv"
+
+def add_time(metrics, key, start):
+    '''Add the seconds since start to metrics[key], returning the current time.'''
+    now = time.time()
+    metrics[key] = metrics.get(key, 0.0) + now - start
+    return now
+
+def merge_metrics(total, metrics):
+    '''Add the numbers in metrics into total.'''
+    for key, value in metrics.iteritems():
+        total[key] = total.get(key, 0) + value
+    return total
+
+def percentile(values, p):
+    '''Nearest-rank percentile of values, None if there are none.'''
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+def latency_summary(latencies):
+    return {
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": percentile(latencies, 100),
+    }
+
+def write_metrics(path, record):
+    '''Append record to the JSON lines file at path.'''
+    record = dict(record)
+    record["time"] = int(time.time())
+    with open(path, "ab") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+def read_latest(path):
+    '''Return the last record in a metrics file, or None.'''
+    latest = None
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    latest = json.loads(line)
+    except IOError:
+        pass
+    return latest
+
+# Summary columns, (stage, key)
+summary_columns = [
+    ("crawl", "elapsed"), ("crawl", "revisions_listed"), ("crawl", "pages_fetched"),
+    ("crawl", "pages_failed"), ("crawl", "bytes"), ("crawl", "list_time"),
+    ("crawl", "fetch_time"), ("crawl", "latency_p50"), ("crawl", "latency_p99"),
+    ("crawl", "tar_time"),
+    ("parse", "elapsed"), ("parse", "pages"), ("parse", "entries"),
+    ("parse", "duplicates"), ("parse", "skipped"), ("parse", "read_time"),
+    ("parse", "extract_time"), ("parse", "entry_time"), ("parse", "sort_time"),
+    ("parse", "write_time"),
+]
+
+def summarize():
+    '''Write the latest crawl and parse record of every project to summary_file.'''
+    project_dirs = sorted(glob.glob(os.path.dirname(crawl_metrics % "*")))
+    totals = {}
+    with open(summary_file, "wb") as f:
+        header = ["Project"] + ["%s_%s" % c for c in summary_columns]
+        f.write("\t".join(header) + "\n")
+        for project_dir in project_dirs:
+            clean_name = os.path.basename(project_dir)
+            latest = {
+                "crawl": read_latest(crawl_metrics % clean_name),
+                "parse": read_latest(parse_metrics % clean_name),
+            }
+            if latest["crawl"] is None and latest["parse"] is None:
+                continue
+            row = [clean_name]
+            for stage, key in summary_columns:
+                record = latest[stage] or {}
+                if key.startswith("latency_"):
+                    value = (record.get("latency") or {}).get(key[len("latency_"):])
+                else:
+                    value = record.get(key)
+                if value is None:
+                    row.append("")
+                    continue
+                if not key.startswith("latency_"):
+                    totals[(stage, key)] = totals.get((stage, key), 0) + value
+                if isinstance(value, float):
+                    row.append("%.3f" % value)
+                else:
+                    row.append(str(value))
+            f.write("\t".join(row) + "\n")
+        row = ["TOTAL"]
+        for column in summary_columns:
+            value = totals.get(column)
+            if value is None:
+                row.append("")
+            elif isinstance(value, float):
+                row.append("%.3f" % value)
+            else:
+                row.append(str(value))
+        f.write("\t".join(row) + "\n")
+    print "Wrote %s" % summary_file
+
+if __name__ == "__main__":
+    summarize()
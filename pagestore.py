@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Deduplicated store of a project's crawled pages
+#
+# Successive revisions of a log page are nearly the same: the page chrome,
+# navigation and most of the days repeat from one revision to the next. Each
+# page is split into chunks of lines, with boundaries chosen by the content
+# of the lines so an insertion only changes the chunks around it, and each
+# distinct chunk is kept once, compressed, under its sha1. A page is its
+# list of chunk hashes, so any page can be read back by oldid without
+# decompressing the rest, unlike the gzipped tar.
+#
+# One SQLite file per project, in the same directory as the cache tars:
+#   chunks   Hash, Data      zlib-compressed chunk by sha1 digest
+#   pages    OldId, Size, Chunks
+#                            Chunks is the page's chunk digests concatenated
+#   meta     Key, Value      crawled_to, the newest oldid of the last
+#                            complete crawl
+
+from contextlib import contextmanager
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+
+# Config
+page_store = "output/projects_crawled/%s-pages.sqlite"
+# A line ends a chunk if its hash is 0 modulo this, so chunks average this
+# many lines. Must be a power of 2.
+chunk_lines = 32
+# Limits on the lines in a chunk
+min_chunk_lines = 4
+max_chunk_lines = 256
+compress_level = 6
+# Seconds to wait for another process holding the write lock
+lock_timeout = 300
+
+digest_size = 20
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS chunks (
+        Hash BLOB PRIMARY KEY,
+        Data BLOB NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS pages (
+        OldId INTEGER PRIMARY KEY,
+        Size INTEGER NOT NULL,
+        Chunks BLOB NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS meta (
+        Key TEXT PRIMARY KEY,
+        Value
+    )''',
+]
+
+# Connections are shared by a crawler's fetching threads
+store_lock = threading.Lock()
+
+def store_path(clean_name):
+    return page_store % clean_name
+
+def exists(clean_name):
+    return os.path.exists(store_path(clean_name))
+
+def connect(clean_name):
+    '''Open a project's store, creating it if needed.'''
+    conn = sqlite3.connect(
+        store_path(clean_name), timeout=lock_timeout, isolation_level=None,
+        check_same_thread=False)
+    conn.text_factory = str
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+@contextmanager
+def transaction(conn):
+    '''Hold the write lock on conn, committing if the block succeeds.'''
+    with store_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+def split_chunks(html):
+    '''Split a page into chunks of whole lines, at boundaries set by their content.'''
+    chunks = []
+    current = []
+    mask = chunk_lines - 1
+    for line in html.splitlines(True):
+        current.append(line)
+        if len(current) >= max_chunk_lines or (
+            len(current) >= min_chunk_lines and zlib.crc32(line) & mask == 0
+        ):
+            chunks.append("".join(current))
+            current = []
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def put_page(conn, oldid, html):
+    '''Add a page, storing only the chunks the store doesn't have yet.'''
+    chunks = split_chunks(html)
+    digests = [hashlib.sha1(chunk).digest() for chunk in chunks]
+    with transaction(conn):
+        for digest, chunk in zip(digests, chunks):
+            if conn.execute(
+                "SELECT 1 FROM chunks WHERE Hash = ?", (buffer(digest),)
+            ).fetchone() is None:
+                conn.execute(
+                    "INSERT INTO chunks VALUES (?, ?)",
+                    (buffer(digest), buffer(zlib.compress(chunk, compress_level))))
+        conn.execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?)",
+            (oldid, len(html), buffer("".join(digests))))
+
+def get_page(conn, oldid):
+    '''Return a page by oldid, raising KeyError if it isn't stored.'''
+    with store_lock:
+        row = conn.execute(
+            "SELECT Size, Chunks FROM pages WHERE OldId = ?", (oldid,)).fetchone()
+        if row is None:
+            raise KeyError(oldid)
+        size, blob = row[0], str(row[1])
+        digests = [blob[i:i + digest_size] for i in range(0, len(blob), digest_size)]
+        data = {}
+        distinct = list(set(digests))
+        # Stay under SQLite's limit on query parameters
+        for i in range(0, len(distinct), 500):
+            batch = distinct[i:i + 500]
+            query = "SELECT Hash, Data FROM chunks WHERE Hash IN (%s)" % ", ".join(["?"] * len(batch))
+            for digest, chunk in conn.execute(query, [buffer(d) for d in batch]):
+                data[str(digest)] = chunk
+    html = "".join(zlib.decompress(str(data[digest])) for digest in digests)
+    if len(html) != size:
+        raise IOError("Page %d is corrupt" % oldid)
+    return html
+
+def get_oldids(conn):
+    '''Return the oldids of every stored page, as a set.'''
+    with store_lock:
+        return set(row[0] for row in conn.execute("SELECT OldId FROM pages"))
+
+def get_meta(conn, key, default=None):
+    with store_lock:
+        row = conn.execute("SELECT Value FROM meta WHERE Key = ?", (key,)).fetchone()
+    if row is None:
+        return default
+    return row[0]
+
+def set_meta(conn, key, value):
+    with transaction(conn):
+        conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+def get_stats(conn):
+    '''Return the pages, their total size and the chunks and bytes stored.'''
+    with store_lock:
+        pages, size = conn.execute("SELECT COUNT(*), IFNULL(SUM(Size), 0) FROM pages").fetchone()
+        chunks, stored = conn.execute(
+            "SELECT COUNT(*), IFNULL(SUM(LENGTH(Data)), 0) FROM chunks").fetchone()
+    return {"pages": pages, "bytes": size, "chunks": chunks, "stored_bytes": stored}
+
+def open_store(clean_name):
+    '''Return page ids (newest first) and a page reader, like parser.open_cache_tar().
+
+    Each page is read once, and the connection is closed after the last one
+    so it isn't inherited by processes forked after that.
+    '''
+    conn = connect(clean_name)
+    page_ids = sorted(get_oldids(conn), reverse=True)
+    left = set(page_ids)
+    if not left:
+        conn.close()
+    def read_page(page_id):
+        html = get_page(conn, page_id)
+        left.discard(page_id)
+        if not left:
+            conn.close()
+        return html
+    return page_ids, read_page
@@ -2,49 +2,103 @@
 # Parse cached Wikipedia assesment logs, output utf-8 encoded TSV
 
 import calendar
+from collections import deque
+from collections import namedtuple
+from collections import OrderedDict
+import cPickle
 from datetime import datetime
 from dateutil.parser import parse
+import heapq
 import logging
+from multiprocessing import Pool
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+import time
 import traceback
-import urllib
 
 from bs4 import BeautifulSoup
 from bs4 import element
+try:
+    import lxml.html
+except ImportError:
+    # Only needed for page_backend = "lxml"
+    lxml = None
+
+try:
+    import columnar
+except ImportError:
+    # Only needed for columnar_output, needs numpy
+    columnar = None
+try:
+    import renames
+except ImportError:
+    # Only needed for renames_output, needs numpy
+    renames = None
+import config
+import metrics
+import pagestore
+import projects
+import registry
+import store
 
 # Config
-project_tsv = "data/projects-2016-10-12.utf-16-le.tsv"
 project_log = "output/projects/%s/parse.log"
 cache_dir = "output/projects/%s/cache"
 cache_tar = "output/projects_crawled/%s-cache.tgz"
-to_parse = "output/to_parse/%s"
-done_parse = "output/done_parse/%s"
 assessment_file = "output/assessments/%s.utf8.tsv"
 end_timestamp = 1449100800 # 2015-12-03T00:00:00Z
+# Read cached pages straight out of cache_tar instead of extracting to disk
+stream_tar = True
+# Pages streamed from cache_tar before they're needed are held in memory up
+# to this many bytes, and written to tar_spill_dir past that. Only tars
+# written before the crawler wrote them in page order have such pages.
+tar_buffer_size = 64 * 1024 * 1024
+tar_spill_dir = "output/projects/%s/tar_spill"
+# Number of projects to parse at once, 1 parses serially in this process
+num_workers = 1
+# Projects whose cache_tar is at least split_min_size bytes, or whose page
+# store holds at least split_min_page_bytes of pages, are parsed by the main
+# process with their pages split into chunks across page_workers processes.
+# Pages are counted uncompressed, a store's file is deduplicated and smaller
+# than the tar.
+page_workers = 1
+split_min_size = 500 * 1024 * 1024
+split_min_page_bytes = 4 * split_min_size
+split_chunk_size = 200
+# Chunks read and queued per page worker, beyond these the pages wait
+split_read_ahead = 2
+# Page extractor, "bs4" (reference) or "lxml"
+page_backend = "bs4"
+# Also write a memory-mappable columnar copy of each table, see columnar.py
+columnar_output = False
+# Load each finished project into the consolidated store, see store.py
+store_output = False
+# Add each finished project's renames to the canonical article ids, see
+# renames.py
+renames_output = False
+# Bound memory by spilling sorted runs of this many entries to files in
+# spill_dir and merging them on output, 0 keeps every entry in memory
+spill_entries = 0
+spill_dir = "output/projects/%s/spill"
 
 # Test config
 test_only = False
 test_project = "test"
 
-# Main log
+# Main log, main() sets up its handler
 logger = logging.getLogger('parser_main')
-handler = logging.FileHandler('output/parser_%s.log' % datetime.now().strftime("%m%dT%H%M"))
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
-
-# Fields
-columns = [
-    'Project', 'Date', 'Action', 'ArticleName', 'OldQual',
-    'NewQual', 'OldImp', 'NewImp', 'NewArticleName', 'OldArticleLink',
-    'OldTalkLink'
-]
+
+# Fields, the TSV columns
+columns = config.columns
 
 # Continuation message
 contd_text = "This log entry was truncated because it was too long. This entry is a continuation of the entry in the next revision of this log page."
+huge_text = "The log for today is too huge to upload to the wiki."
 
 # Regular expressions
 date_pattern = re.compile(
@@ -189,333 +243,291 @@ to_skip = set([
     , "Hong Kong (talk) Should be either Top or High (Hong Kong has approx. 7 million people and Asia's World City"
     , "Hong Kong (talk) Should be either Top or High (Hong Kong has approx. 7 million people and China's World City"
 ])
-def get_entry(project_name, date, item, logger):
-    text = item.get_text()
-    action = ""
-    old_qual = ""
-    new_qual = ""
-    old_imp = ""
-    new_imp = ""
-    article_name = ""
-    article_new_name = ""
+
+# One row of the assessment table. A tuple has no per-instance dict or
+# spare capacity, and rows still index like the lists they replaced.
+Entry = namedtuple("Entry", columns)
+
+# Shared copy of each value in a project's entries. Projects, dates,
+# actions, qualities and importances come from a few thousand distinct
+# values and most articles have several entries, so one copy per value
+# instead of one per entry is most of an entry's memory. parse() clears
+# this for each project.
+entry_values = {}
+
+def intern_value(value):
+    if not value:
+        return value
+    return entry_values.setdefault(value, value)
+
+def make_entry(project_name, date, action, article_name, old_qual="",
+               new_qual="", old_imp="", new_imp="", article_new_name=""):
+    # Revision and talk links aren't parsed yet, see entry_reassessed()
     article_old_link = ""
     talk_old_link = ""
-    
-    m = re.match(reassessed_re, text)
+    return Entry(
+        intern_value(project_name), intern_value(date), intern_value(action),
+        intern_value(article_name), intern_value(old_qual),
+        intern_value(new_qual), intern_value(old_imp), intern_value(new_imp),
+        intern_value(article_new_name), article_old_link, talk_old_link)
+
+# Each entry_* function handles one log format. It's given the match object
+# for its pattern and returns the entry, None to fall through to the next
+# format, or raises StopIteration to skip the line.
+
+def entry_reassessed(m, project_name, date, text, links, logger):
+    old_qual = new_qual = old_imp = new_imp = ""
+    article_name, = m.groups()
+    m = re.search(reassessed_qual_re, text)
     if m:
-        action = "Reassessed"
-        article_name, = m.groups()
-        m = re.search(reassessed_qual_re, text)
-        if m:
-            old_qual, new_qual = m.groups()
-        m = re.search(reassessed_imp_re, text)
-        if m:
-            old_imp, new_imp = m.groups()
-            
-        # Get old revision link
-        # Below code still has quoting errors
-        # Example from oldid=397973473
-        # "Gypsy" in Jazz (Teddy Wilson album) (talk) reassessed. Importance rating changed from Unknown-Class to Mid-Class ("Gypsy"%20in%20Jazz%20%28Teddy%20Wilson%20album%29&oldid=392798701 rev · "Gypsy"%20in%20Jazz%20%28Teddy%20Wilson%20album%29&oldid=397522420 t).
-        #try:
-        #    rev = item.find('a', text="rev")
-        #    article_old_link = rev.get('href').split("?")[1]
-        #except AttributeError:
-        #    # Couldn't parse, check whether it's a quoting problem
-        #    try:
-        #        rev = item.find('a', text=reassessed_quote_rev_re)
-        #        text_part = re.match(reassessed_quote_rev_re, rev.get_text()).groups()[0]
-        #        href_part = rev.get('href').split("?")[1]
-        #        article_old_link = href_part + text_part.replace('"', "%22")
-        #    except AttributeError:
-        #        logger.error("  Couldn't parse: %s" % item.get_text())
-        #        raise AssertionError
-        # Get old talk link
-        #try:
-        #    t = item.find('a', text="t")
-        #    talk_old_link = t.get('href').split("?")[1]
-        #except AttributeError:
-        #    # Couldn't parse, check whether it's a quoting problem
-        #    try:
-        #        t = item.find('a', text=reassessed_quote_t_re)
-        #        text_part = re.match(reassessed_quote_t_re, t.get_text()).groups()[0]
-        #        href_part = t.get('href').split("?")[1]
-        #        talk_old_link = href_part + text_part.replace('"', "%22")
-        #    except AttributeError:
-        #        logger.error("  Couldn't parse: %s" % item.get_text())
-        #        raise AssertionError
+        old_qual, new_qual = m.groups()
+    m = re.search(reassessed_imp_re, text)
+    if m:
+        old_imp, new_imp = m.groups()
         
-        # We made it, somehow
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
+    # Get old revision link
+    # Below code still has quoting errors
+    # Example from oldid=397973473
+    # "Gypsy" in Jazz (Teddy Wilson album) (talk) reassessed. Importance rating changed from Unknown-Class to Mid-Class ("Gypsy"%20in%20Jazz%20%28Teddy%20Wilson%20album%29&oldid=392798701 rev · "Gypsy"%20in%20Jazz%20%28Teddy%20Wilson%20album%29&oldid=397522420 t).
+    #try:
+    #    rev = item.find('a', text="rev")
+    #    article_old_link = rev.get('href').split("?")[1]
+    #except AttributeError:
+    #    # Couldn't parse, check whether it's a quoting problem
+    #    try:
+    #        rev = item.find('a', text=reassessed_quote_rev_re)
+    #        text_part = re.match(reassessed_quote_rev_re, rev.get_text()).groups()[0]
+    #        href_part = rev.get('href').split("?")[1]
+    #        article_old_link = href_part + text_part.replace('"', "%22")
+    #    except AttributeError:
+    #        logger.error("  Couldn't parse: %s" % item.get_text())
+    #        raise AssertionError
+    # Get old talk link
+    #try:
+    #    t = item.find('a', text="t")
+    #    talk_old_link = t.get('href').split("?")[1]
+    #except AttributeError:
+    #    # Couldn't parse, check whether it's a quoting problem
+    #    try:
+    #        t = item.find('a', text=reassessed_quote_t_re)
+    #        text_part = re.match(reassessed_quote_t_re, t.get_text()).groups()[0]
+    #        href_part = t.get('href').split("?")[1]
+    #        talk_old_link = href_part + text_part.replace('"', "%22")
+    #    except AttributeError:
+    #        logger.error("  Couldn't parse: %s" % item.get_text())
+    #        raise AssertionError
     
-    m = re.match(reassessed_notalk_re, text)
+    # We made it, somehow
+    return make_entry(
+        project_name, date, "Reassessed", article_name,
+        old_qual=old_qual, new_qual=new_qual, old_imp=old_imp, new_imp=new_imp)
+
+def entry_reassessed_notalk(m, project_name, date, text, links, logger):
+    old_qual = new_qual = old_imp = new_imp = ""
+    article_name, = m.groups()
+    m = re.search(reassessed_qual_re, text)
     if m:
-        action = "Reassessed"
-        article_name, = m.groups()
-        m = re.search(reassessed_qual_re, text)
-        if m:
-            old_qual, new_qual = m.groups()
-        m = re.search(reassessed_imp_re, text)
-        if m:
-            old_imp, new_imp = m.groups()
-        # Should also get revision and talk link but don't need it now
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(reassessed_simple_re, text)
+        old_qual, new_qual = m.groups()
+    m = re.search(reassessed_imp_re, text)
     if m:
-        action = "Reassessed"
-        text.replace("start-class(", "Start-Class (")
-        article_name, old_qual, old_imp, new_qual, new_imp = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
+        old_imp, new_imp = m.groups()
+    # Should also get revision and talk link but don't need it now
+    return make_entry(
+        project_name, date, "Reassessed", article_name,
+        old_qual=old_qual, new_qual=new_qual, old_imp=old_imp, new_imp=new_imp)
+
+def entry_reassessed_simple(m, project_name, date, text, links, logger):
+    article_name, old_qual, old_imp, new_qual, new_imp = m.groups()
+    return make_entry(
+        project_name, date, "Reassessed", article_name,
+        old_qual=old_qual, new_qual=new_qual, old_imp=old_imp, new_imp=new_imp)
+
+def entry_assessed(m, project_name, date, text, links, logger):
+    new_qual = new_imp = ""
     try:
-        m = re.match(assessed_re, text)
-        if m:
-            action = "Assessed"
-            links = item.find_all('a')
-            article_name = links[0].get_text()
-            qual_m = re.search(assessed_qual_re, text)
-            if qual_m:
-                new_qual, = qual_m.groups()
-            imp_m = re.search(assessed_imp_re, text)
-            if imp_m:
-                new_imp, = imp_m.groups()
-            # There will be data for revision and talk links
-            # but this part of the parser hasn't been implemented yet
-            return [
-                project_name, date, action, article_name, old_qual, new_qual,
-                old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
+        article_name = links[0]
     except IndexError:
-        pass
-    
-    m = re.match(assessed_talkafter_re, text)
-    if m:
-        action = "Assessed"
-        links = item.find_all('a')
-        article_name = links[0].get_text()
-        text.replace("Stub -Class", "Stub-Class")
-        qual_m = re.search(assessed_qual_re, text)
-        if qual_m:
-            new_qual, = qual_m.groups()
-        imp_m = re.search(assessed_imp_re, text)
-        if imp_m:
-            new_imp, = imp_m.groups()
-        # There will be data for revision and talk links
-        # but this part of the parser hasn't been implemented yet
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(renamed_talk_re, text)
-    if m:
-        action = "Renamed"
-        article_name, old_class, old_imp, article_new_name = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-        
-    m = re.match(renamed_talk_notalk_re, text)
-    if m:
-        action = "Renamed"
-        article_name, old_class, old_imp, article_new_name = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(renamed_re, text)
-    if m:
-        links = item.find_all('a')
-        # Get article names and talk link
-        # Can't trust regex because of nested parentheses
-        # Instead trim links from ends of string
-        action = "Renamed"
-        article_name = links[0].get_text()
-        if len(links) == 2:
-            article_new_name = links[1].get_text()
-            if re.match(talk_re, article_new_name):
-                logger.error("Unable to find new name: %s" % text)
-                raise ValueError
-        elif len(links) > 2:
-            article_new_name = links[2].get_text()
-            if re.match(talk_re, article_new_name):
-                logger.error("Unable to find new name: %s" % text)
-                raise ValueError
-            # Was attempt to capture assessment
-            # Ignore for now since this is a rename
-            #front = len(article_name) + len(talk_text) + len(" () ")
-            #back = len(article_new_name) + len(" ")
-            #assessment_part = text[front:-back]
-            #try:
-            #    old_class, old_imp = re.match(renamed_assessment_re, assessment_part).groups()
-            #except AttributeError:
-            #    logger.error("  Unable to parse old assessment: %s" % assessment_part)
-            #    raise ValueError
-        else:
-            logger.error("renamed_re unrecognized link count")
+        # No links, try the other formats
+        return None
+    qual_m = re.search(assessed_qual_re, text)
+    if qual_m:
+        new_qual, = qual_m.groups()
+    imp_m = re.search(assessed_imp_re, text)
+    if imp_m:
+        new_imp, = imp_m.groups()
+    # There will be data for revision and talk links
+    # but this part of the parser hasn't been implemented yet
+    return make_entry(
+        project_name, date, "Assessed", article_name,
+        new_qual=new_qual, new_imp=new_imp)
+
+def entry_assessed_talkafter(m, project_name, date, text, links, logger):
+    new_qual = new_imp = ""
+    article_name = links[0]
+    qual_m = re.search(assessed_qual_re, text)
+    if qual_m:
+        new_qual, = qual_m.groups()
+    imp_m = re.search(assessed_imp_re, text)
+    if imp_m:
+        new_imp, = imp_m.groups()
+    # There will be data for revision and talk links
+    # but this part of the parser hasn't been implemented yet
+    return make_entry(
+        project_name, date, "Assessed", article_name,
+        new_qual=new_qual, new_imp=new_imp)
+
+def entry_renamed_talk(m, project_name, date, text, links, logger):
+    article_name, old_class, old_imp, article_new_name = m.groups()
+    return make_entry(
+        project_name, date, "Renamed", article_name,
+        old_imp=old_imp, article_new_name=article_new_name)
+
+def entry_renamed(m, project_name, date, text, links, logger):
+    # Get article names and talk link
+    # Can't trust regex because of nested parentheses
+    # Instead trim links from ends of string
+    article_name = links[0]
+    if len(links) == 2:
+        article_new_name = links[1]
+        if re.match(talk_re, article_new_name):
+            logger.error("Unable to find new name: %s" % text)
             raise ValueError
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(renamed_simple_talk_re, text)
-    if m:
-        action = "Renamed"
-        article_name, article_new_name = m.groups()
-        # We should capture talk, ignoring for now
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]    
-    
-    m = re.match(renamed_simple_re, text)
-    if m:
-        action = "Renamed"
-        article_name, article_new_name = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(renamed_moved_talk_re, text)
-    if m:
-        action = "Renamed"
-        article_name, article_new_name = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(added_re, text)
-    if m:
-        action = "Assessed"
-        article_name, new_qual, new_imp = m.groups()
-        # Some articles have leftover wiki markup around the title, remove
-        article_name = article_name.strip("[]")
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(added_simple_re, text)
-    if m:
-        action = "Assessed"
-        article_name, = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(created_re, text)
-    if m:
-        action = "Assessed"
-        article_name, = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(recreated_re, text)
-    if m:
-        action = "Assessed"
-        article_name, new_qual = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(removed_re, text)
-    if m:
-        action = "Removed"
-        article_name, = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(removed_simple_re, text)
-    if m:
-        action = "Removed"
-        article_name, old_class, old_imp = m.groups()
-        if article_name == "":
-            # Some entries have no article name, weird. Skip them.
-            raise StopIteration
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(removed_notalk_assessment_re, text)
-    if m:
-        action = "Removed"
-        article_name, old_class, old_imp = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
+    elif len(links) > 2:
+        article_new_name = links[2]
+        if re.match(talk_re, article_new_name):
+            logger.error("Unable to find new name: %s" % text)
+            raise ValueError
+        # Was attempt to capture assessment
+        # Ignore for now since this is a rename
+        #front = len(article_name) + len(talk_text) + len(" () ")
+        #back = len(article_new_name) + len(" ")
+        #assessment_part = text[front:-back]
+        #try:
+        #    old_class, old_imp = re.match(renamed_assessment_re, assessment_part).groups()
+        #except AttributeError:
+        #    logger.error("  Unable to parse old assessment: %s" % assessment_part)
+        #    raise ValueError
+    else:
+        logger.error("renamed_re unrecognized link count")
+        raise ValueError
+    return make_entry(
+        project_name, date, "Renamed", article_name,
+        article_new_name=article_new_name)
 
-    m = re.match(removed_paren_re, text)
-    if m:
-        action = "Removed"
-        article_name, = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
+def entry_renamed_simple(m, project_name, date, text, links, logger):
+    # We should capture talk, ignoring for now
+    article_name, article_new_name = m.groups()
+    return make_entry(
+        project_name, date, "Renamed", article_name,
+        article_new_name=article_new_name)
 
-    m = re.match(removed_notalk_re, text)
-    if m:
-        action = "Removed"
-        article_name, = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-    
-    m = re.match(removed_pertalk_re, text)
-    if m:
-        action = "Removed"
-        article_name, = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
+def entry_added(m, project_name, date, text, links, logger):
+    article_name, new_qual, new_imp = m.groups()
+    # Some articles have leftover wiki markup around the title, remove
+    article_name = article_name.strip("[]")
+    return make_entry(
+        project_name, date, "Assessed", article_name,
+        new_qual=new_qual, new_imp=new_imp)
 
-    m = re.match(reassessed_moved_re, text)
-    if m:
-        action = "Reassessed"
-        article_name, old_qual, old_imp, new_qual, new_imp = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
+def entry_added_simple(m, project_name, date, text, links, logger):
+    article_name, = m.groups()
+    return make_entry(project_name, date, "Assessed", article_name)
 
-    m = re.match(reassessed_moved_simple_re, text)
-    if m:
-        action = "Reassessed"
-        article_name, old_qual, new_qual = m.groups()
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
+def entry_recreated(m, project_name, date, text, links, logger):
+    article_name, new_qual = m.groups()
+    return make_entry(
+        project_name, date, "Assessed", article_name, new_qual=new_qual)
 
-    m = re.match(reassessed_ga_re, text)
-    if m:
-        action = "Reassessed"
-        article_name, = m.groups()
-        new_qual = "GA-Class"
-        return [
-            project_name, date, action, article_name, old_qual, new_qual,
-            old_imp, new_imp, article_new_name, article_old_link, talk_old_link]
-
-    m = re.match(testing_re, text)
-    if m:
-        # We've found testing code, ignore it
-        raise StopIteration
+def entry_removed(m, project_name, date, text, links, logger):
+    article_name, = m.groups()
+    return make_entry(project_name, date, "Removed", article_name)
 
-    m = re.match(noaction_re, text)
-    if m:
-        # Some entries have no action, probably bug in bot
+def entry_removed_assessment(m, project_name, date, text, links, logger):
+    article_name, old_class, old_imp = m.groups()
+    if article_name == "":
+        # Some entries have no article name, weird. Skip them.
         raise StopIteration
+    return make_entry(
+        project_name, date, "Removed", article_name, old_imp=old_imp)
 
-    m = re.match(noname_re, text)
-    if m:
-        # No article name, probably bug in bot, skip
-        raise StopIteration
+def entry_reassessed_moved(m, project_name, date, text, links, logger):
+    article_name, old_qual, old_imp, new_qual, new_imp = m.groups()
+    return make_entry(
+        project_name, date, "Reassessed", article_name,
+        old_qual=old_qual, new_qual=new_qual, old_imp=old_imp, new_imp=new_imp)
 
-    m = re.match(nochange_re, text)
-    if m:
-        # No change, skip
-        raise StopIteration
+def entry_reassessed_moved_simple(m, project_name, date, text, links, logger):
+    article_name, old_qual, new_qual = m.groups()
+    return make_entry(
+        project_name, date, "Reassessed", article_name,
+        old_qual=old_qual, new_qual=new_qual)
+
+def entry_reassessed_ga(m, project_name, date, text, links, logger):
+    article_name, = m.groups()
+    return make_entry(
+        project_name, date, "Reassessed", article_name, new_qual="GA-Class")
+
+def entry_skip(m, project_name, date, text, links, logger):
+    # Testing code, entries without an action or article name (probably bugs
+    # in the bot) and days without changes
+    raise StopIteration
+
+# Log formats in order of precedence, as (keyword, pattern, handler). A line
+# is only tried against a pattern if it contains the pattern's keyword, so
+# each keyword must be a literal that every match of the pattern contains.
+entry_formats = [
+    ("reassessed", reassessed_re, entry_reassessed),
+    ("reassessed", reassessed_notalk_re, entry_reassessed_notalk),
+    ("reassessed", reassessed_simple_re, entry_reassessed_simple),
+    (" assessed", assessed_re, entry_assessed),
+    (" assessed", assessed_talkafter_re, entry_assessed_talkafter),
+    ("renamed to ", renamed_talk_re, entry_renamed_talk),
+    ("renamed to ", renamed_talk_notalk_re, entry_renamed_talk),
+    ("renamed to ", renamed_re, entry_renamed),
+    ("renamed to ", renamed_simple_talk_re, entry_renamed_simple),
+    ("renamed to ", renamed_simple_re, entry_renamed_simple),
+    (" moved to ", renamed_moved_talk_re, entry_renamed_simple),
+    (") added", added_re, entry_added),
+    (") added", added_simple_re, entry_added_simple),
+    (") Created", created_re, entry_added_simple),
+    (" recreated", recreated_re, entry_recreated),
+    ("removed", removed_re, entry_removed),
+    ("removed", removed_simple_re, entry_removed_assessment),
+    ("removed", removed_notalk_assessment_re, entry_removed_assessment),
+    ("removed", removed_paren_re, entry_removed),
+    ("removed", removed_notalk_re, entry_removed),
+    ("Removed per talk", removed_pertalk_re, entry_removed),
+    (" moved from ", reassessed_moved_re, entry_reassessed_moved),
+    (" moved from ", reassessed_moved_simple_re, entry_reassessed_moved_simple),
+    ("upgraded to good article", reassessed_ga_re, entry_reassessed_ga),
+    ("Temp bot", testing_re, entry_skip),
+    ("talk", noaction_re, entry_skip),
+    ("(", noname_re, entry_skip),
+    ("(No changes today)", nochange_re, entry_skip),
+]
+entry_keywords = sorted(set(keyword for keyword, pattern, handler in entry_formats))
+
+# Candidate formats for each combination of keywords seen so far
+entry_candidates = {}
+
+def get_entry_candidates(text):
+    '''Return the formats that could match text, in order of precedence.'''
+    present = tuple(keyword for keyword in entry_keywords if keyword in text)
+    try:
+        return entry_candidates[present]
+    except KeyError:
+        candidates = [f for f in entry_formats if f[0] in present]
+        entry_candidates[present] = candidates
+        return candidates
+
+def get_entry(project_name, date, text, links, logger):
+    '''Parse one log line, links holds the text of each link in the line.'''
+    for keyword, pattern, handler in get_entry_candidates(text):
+        m = pattern.match(text)
+        if m:
+            entry = handler(m, project_name, date, text, links, logger)
+            if entry is not None:
+                return entry
 
     if text[0] == "^":
         # Weirdness in project: New York City
@@ -526,14 +538,29 @@ def get_entry(project_name, date, item, logger):
         raise StopIteration
 
     # Check for entries that are just an article name, skip
-    links = item.find_all('a')
-    if len(links) == 1 and links[0].get_text() == text:
+    if len(links) == 1 and links[0] == text:
         raise StopIteration
 
     logger.error("Unrecognized format: <<%s>>" % text)
     raise ValueError
 
+# Recently parsed dates, least recently used first. The same few thousand
+# dates come up in every project.
+date_cache = OrderedDict()
+date_cache_size = 10000
+
 def parse_date(date_string):
+    '''Convert date_string (assumed UTC) to UTC timestamp, cached.'''
+    try:
+        timestamp = date_cache.pop(date_string)
+    except KeyError:
+        timestamp = parse_date_uncached(date_string)
+        if len(date_cache) >= date_cache_size:
+            date_cache.popitem(last=False)
+    date_cache[date_string] = timestamp
+    return timestamp
+
+def parse_date_uncached(date_string):
     '''Convert date_string (assumed UTC) to UTC timestamp.'''
     fmt1 = "%B %d, %Y"
     fmt2 = "%Y-%m-%d"    
@@ -550,164 +577,452 @@ def parse_date(date_string):
         raise ValueError
     return timestamp
 
-def parse(project_name):
-    clean_name = project_name.replace("/", "_")
-    logger = logging.getLogger(project_name)
-    fh = logging.FileHandler(project_log % clean_name)
-    logger.addHandler(fh)
-    logger.setLevel(logging.DEBUG)
-    logger.info("Beggining parse")
-    
-    entries = {}
-    
-    # Loop through cached history pages
-    # Go newest to oldest for correct order in multi-page entries
-    pages = os.listdir(cache_dir % clean_name)    
-    pages = sorted(os.listdir(cache_dir % clean_name), reverse=True)
+def open_cache_dir(clean_name):
+    '''Return page ids (newest first) and a page reader for an extracted cache.'''
+    pages = os.listdir(cache_dir % clean_name)
     page_ids = [int(re.match(cache_re, page).groups()[0]) for page in pages]
     page_ids = sorted(page_ids, reverse=True)
+    def read_page(page_id):
+        with open(os.path.join(cache_dir % clean_name, "oldid=%d.html" % page_id)) as f:
+            return f.read()
+    return page_ids, read_page
+
+def get_member_page_id(member):
+    '''Return the page id of a cache tar member, None if it isn't a page.'''
+    if not member.isfile():
+        return None
+    m = re.match(cache_re, os.path.basename(member.name))
+    if m is None:
+        return None
+    return int(m.groups()[0])
+
+def list_cache_tar(path):
+    '''Return the page ids in a cache tar, keeping none of the pages.'''
+    page_ids = set()
+    tar = tarfile.open(path, "r|gz")
+    try:
+        for member in tar:
+            page_id = get_member_page_id(member)
+            if page_id is not None:
+                page_ids.add(page_id)
+    finally:
+        tar.close()
+    return page_ids
+
+def open_cache_tar(clean_name):
+    '''Return page ids (newest first) and a page reader for cache_tar.
+
+    Nothing is written to disk up front. The archive is listed in one
+    streaming pass and read in a second one as pages are asked for. The
+    crawler writes tars newest page first, see crawler.write_cache_tar(),
+    so each page is the next member. Tars from before that are in the order
+    their cache dir was listed in, and pages that come before the one asked
+    for are deferred: kept in memory while they total under tar_buffer_size,
+    and written to tar_spill_dir after that, so large old tars still go
+    through the disk. The tar is closed and the spill dir removed once every
+    page has been read.
+    '''
+    path = cache_tar % clean_name
+    page_ids = sorted(list_cache_tar(path), reverse=True)
+    spill_path = tar_spill_dir % clean_name
+    # Left behind by a failed parse
+    if os.path.exists(spill_path):
+        shutil.rmtree(spill_path)
+    tar = tarfile.open(path, "r|gz")
+    members = iter(tar)
+    # Deferred pages by id, None for the ones in spill_path
+    deferred = {}
+    state = {"buffered": 0, "left": len(page_ids)}
+    def read_deferred(page_id):
+        html = deferred.pop(page_id)
+        if html is not None:
+            state["buffered"] -= len(html)
+            return html
+        page_path = os.path.join(spill_path, "%d.html" % page_id)
+        with open(page_path, "rb") as f:
+            html = f.read()
+        os.remove(page_path)
+        return html
+    def defer(page_id, html):
+        if state["buffered"] + len(html) <= tar_buffer_size:
+            deferred[page_id] = html
+            state["buffered"] += len(html)
+            return
+        if not os.path.exists(spill_path):
+            os.makedirs(spill_path)
+        with open(os.path.join(spill_path, "%d.html" % page_id), "wb") as f:
+            f.write(html)
+        deferred[page_id] = None
+    def read_page(page_id):
+        if page_id in deferred:
+            html = read_deferred(page_id)
+        else:
+            while True:
+                member = next(members, None)
+                if member is None:
+                    raise KeyError(page_id)
+                member_id = get_member_page_id(member)
+                if member_id is None:
+                    continue
+                html = tar.extractfile(member).read()
+                if member_id == page_id:
+                    break
+                defer(member_id, html)
+        state["left"] -= 1
+        if state["left"] == 0:
+            tar.close()
+            if os.path.exists(spill_path):
+                shutil.rmtree(spill_path)
+        return html
+    return page_ids, read_page
+
+def add_entry(entries, k, entry, logger):
+    '''Add entry under k unless already present, first entry wins.
+
+    Returns True if the entry was added.
+    '''
+    try:
+        prev = entries[k]
+        if prev != entry:
+            logger.error("  Contradictory entries:")
+            logger.error("    Keeping: " + str(list(prev)))
+            logger.error("    Discarding: " + str(list(entry)))
+        return False
+    except KeyError:
+        entries[k] = entry
+        return True
+
+def spill_run(entries, run_dir):
+    '''Write (key, entry) pairs to a new run file in run_dir, returning its path.
+
+    The sort is stable, so repeats of a key stay in page order.
+    '''
+    entries.sort(key=lambda pair: pair[0])
+    fd, path = tempfile.mkstemp(suffix=".run", dir=run_dir)
+    with os.fdopen(fd, "wb") as f:
+        for pair in entries:
+            cPickle.dump(pair, f, 2)
+    return path
+
+def read_run(path, i):
+    '''Yield (key, run index, position, entry) from a run file for merging.'''
+    with open(path, "rb") as f:
+        j = 0
+        while True:
+            try:
+                k, entry = cPickle.load(f)
+            except EOFError:
+                return
+            yield k, i, j, entry
+            j += 1
+
+def merge_runs(runs, logger=None, stats=None):
+    '''K-way merge run files in page order into deduplicated entries in key order.
+
+    The first entry for a key wins and contradictions are logged as in
+    add_entry(). Duplicates and entries are counted in stats if given.
+    '''
+    prev_k = None
+    prev = None
+    for k, i, j, entry in heapq.merge(*[read_run(path, i) for i, path in enumerate(runs)]):
+        if prev is not None and k == prev_k:
+            if logger is not None and prev != entry:
+                logger.error("  Contradictory entries:")
+                logger.error("    Keeping: " + str(list(prev)))
+                logger.error("    Discarding: " + str(list(entry)))
+            if stats is not None:
+                stats["duplicates"] = stats.get("duplicates", 0) + 1
+            continue
+        prev_k = k
+        prev = entry
+        if stats is not None:
+            stats["entries"] = stats.get("entries", 0) + 1
+        yield entry
+
+def get_date_headers_bs4(page_tree):
+    '''Find the date headers in one pass.
+
+    Returns the header tags in page order and a dict from id(tag) to the
+    header text, so the sibling walk doesn't have to classify them again.
+    '''
+    date_tags = []
+    date_texts = {}
+    for x in page_tree.find_all("h3"):
+        span = x.span
+        if (
+            span
+            and span.get('class') == ["mw-headline"]
+            and 'id' in span.attrs
+            and date_pattern.match(span.get('id'))
+        ):
+            date_tags.append(x)
+            date_texts[id(x)] = span.get_text()
+    return date_tags, date_texts
+
+def extract_page_bs4(html):
+    '''Extract the log from a history page using a BeautifulSoup tree.
+
+    This is the reference extractor. Returns (contd, blocks, huge), where
+    contd is whether the page continues the previous page's log, huge is
+    whether the page says the log was too huge to upload, and blocks is a
+    list of ("date", header_text) and ("ul", [(li_text, li_links), ...])
+    in page order. Blocks start at the first date header, or at the first
+    list for continuation pages. blocks is None if a page that isn't a
+    continuation has no date header.
+    '''
+    page_tree = BeautifulSoup(html, 'html.parser')
+    huge = page_tree.find(text=huge_text) is not None
+    date_tags, date_texts = get_date_headers_bs4(page_tree)
+    if page_tree.find(text=contd_text) is not None:
+        contd = True
+        current_tag = page_tree.find(id="mw-content-text").find('ul')
+    else:
+        contd = False
+        if len(date_tags) == 0:
+            return contd, None, huge
+        current_tag = date_tags[0]
+    blocks = []
+    while current_tag is not None:
+        if id(current_tag) in date_texts:
+            blocks.append(("date", date_texts[id(current_tag)]))
+        elif current_tag.name == "ul":
+            items = []
+            for item in current_tag.find_all('li'):
+                # Skip table of contents
+                c = item.get('class')
+                if c and 'toclevel-1' in c:
+                    continue
+                links = [a.get_text() for a in item.find_all('a')]
+                items.append((item.get_text(), links))
+            blocks.append(("ul", items))
+        current_tag = current_tag.next_sibling
+    return contd, blocks, huge
+
+def get_date_headers_lxml(page_tree):
+    '''Same as get_date_headers_bs4() for an lxml tree.'''
+    date_tags = []
+    date_texts = {}
+    for x in page_tree.iter("h3"):
+        span = x.find('.//span')
+        if (
+            span is not None
+            and span.get('class', '').split() == ["mw-headline"]
+            and span.get('id') is not None
+            and date_pattern.match(span.get('id'))
+        ):
+            date_tags.append(x)
+            date_texts[id(x)] = unicode(span.text_content())
+    return date_tags, date_texts
+
+def extract_page_lxml(html):
+    '''Same as extract_page_bs4() using an lxml tree, which is much cheaper to build.'''
+    parser = lxml.html.HTMLParser(encoding='utf-8')
+    page_tree = lxml.html.document_fromstring(html, parser=parser)
+    huge = len(page_tree.xpath("//text()[. = $t]", t=huge_text)) > 0
+    date_tags, date_texts = get_date_headers_lxml(page_tree)
+    if len(page_tree.xpath("//text()[. = $t]", t=contd_text)) > 0:
+        contd = True
+        content = page_tree.get_element_by_id("mw-content-text")
+        current_tag = next(content.iter('ul'), None)
+    else:
+        contd = False
+        if len(date_tags) == 0:
+            return contd, None, huge
+        current_tag = date_tags[0]
+    blocks = []
+    while current_tag is not None:
+        if id(current_tag) in date_texts:
+            blocks.append(("date", date_texts[id(current_tag)]))
+        elif current_tag.tag == "ul":
+            items = []
+            for item in current_tag.iter('li'):
+                # Skip table of contents
+                if 'toclevel-1' in item.get('class', '').split():
+                    continue
+                links = [unicode(a.text_content()) for a in item.iter('a')]
+                items.append((unicode(item.text_content()), links))
+            blocks.append(("ul", items))
+        current_tag = current_tag.getnext()
+    return contd, blocks, huge
+
+page_backends = {
+    "bs4": extract_page_bs4,
+    "lxml": extract_page_lxml,
+}
+
+def parse_pages(project_name, page_ids, read_page, logger, stats, runs=None):
+    '''Parse pages newest to oldest, returning entries keyed by (date, article, action).
+
+    Page, line and timing counts are added to the stats dict. If runs is a
+    list, (key, entry) pairs are instead collected undeduplicated and every
+    spill_entries of them are spilled to a run file whose path is appended
+    to runs, the pairs since the last spill are returned.
+    '''
+    extract_page = page_backends[page_backend]
+    if runs is None:
+        entries = {}
+    else:
+        entries = []
     for i, page in enumerate(page_ids):
         if i > 0 and i % 100 == 0:
-            print "%d: %2.2f%%" % (i, (float(100*i) / float(len(pages))))
-        # Load html into beautifulsoup
-        with open(os.path.join(cache_dir % clean_name, "oldid=%d.html" % page)) as f:
-            page_tree = BeautifulSoup(f.read(), 'html.parser')
-        try:
-            # Prevent running out of filehandlers if python procrastinates
-            f.close()
-        except:
-            pass
+            print "%d: %2.2f%%" % (i, (float(100*i) / float(len(page_ids))))
+        t = time.time()
+        html = read_page(page)
+        t = metrics.add_time(stats, "read_time", t)
+        contd, blocks, huge = extract_page(html)
+        metrics.add_time(stats, "extract_time", t)
+        stats["pages"] = stats.get("pages", 0) + 1
         
-        # Check whether this page is a continuation
-        p = page_tree.find(text=contd_text)
-        # If not, find the first date header
-        if p is None:
-            contd = False
-            try:
-                header_tags = page_tree.find_all("h3")
-                date_tags = [x for x in header_tags
-                                if x.span and x.span.get('class') == ["mw-headline"]
-                                    and 'id' in x.span.attrs
-                                    and date_pattern.match(x.span.get('id'))]
-                try:
-                    current_tag = date_tags[0]
-                except IndexError:
-                    logger.info("No headers match pattern: %s" % page)
-                    continue
-            except Exception as TagNotFoundException:
-                logger.info("No headers found: %s" % page)
-                continue
-            try:
-                date_text = current_tag.span.get_text()
-                current_date = parse_date(date_text)
-            except ValueError:
-                logger.error("Unable to parse date: %s" % str(current_tag))
-                raise
-        else:
-            contd = True
+        # Continuation pages pick up the date from the previous page
+        if contd:
             try:
                 logger.info("  Continuing date: %d" % current_date)
             except UnboundLocalError:
                 # Crawl stopped in the middle of multi-page entry
                 # Just skip to the first full entry
                 continue
-            current_tag = page_tree.find(id="mw-content-text").find('ul')
+        elif blocks is None:
+            logger.info("No headers match pattern: %s" % page)
+            continue
 
         entry_count = 0
         skip_count = 0
-        while True:
-            # Move to next tag
-            # If we're continuing from the last page, we're already on the right
-            # tag so we don't go to the next one.
-            if contd:
-                contd = False
-            else:
+        for kind, value in blocks:
+            if kind == "date":
                 try:
-                    current_tag = current_tag.next_sibling
-                    current_tag.name
-                except AttributeError:
-                    if entry_count == 0 and skip_count == 0:
-                        huge = page_tree.find(text="The log for today is too huge to upload to the wiki.")
-                        if huge is None:
-                            logger.error("Found no entries in: %s" % page)
-                        else:
-                            logger.warning("Log too large to upload: %s" % page)
-                    #logger.info("  Parsed(skipped) %d(%d) counts in %s" % (entry_count, skip_count, page))
-                    break
-            
-            if (
-                current_tag.name == "h3"
-                and current_tag.span
-                and current_tag.span.get('class') == ["mw-headline"]
-                and 'id' in current_tag.span.attrs
-                and date_pattern.match(current_tag.span.get('id'))
-            ):
-                date_text = current_tag.span.get_text()
-                try:
-                    current_date = parse_date(date_text)
+                    current_date = parse_date(value)
                 except ValueError:
-                    logger.error("Unable to parse date: %s" % str(current_tag))
+                    logger.error("Unable to parse date: %s" % value)
                     logger.error("    page_id: %d" % page)
                     raise
-            elif current_tag.name == "ul":
+            elif kind == "ul":
                 if current_date > end_timestamp:
                     continue
-                for item in current_tag.find_all('li'):
-                    # Skip table of contents
-                    c = item.get('class')
-                    if c and 'toclevel-1' in c:
-                        continue
+                for text, links in value:
                     # Parse the entry
+                    stats["lines"] = stats.get("lines", 0) + 1
+                    t = time.time()
                     try:
-                        entry = get_entry(project_name, current_date, item, logger)
+                        entry = get_entry(project_name, current_date, text, links, logger)
                     except ValueError:
-                        logger.error("  Error parsing: %s" % item.get_text())
+                        logger.error("  Error parsing: %s" % text)
                         logger.error("    page_id: %d" % page)
                         raise
                     except AssertionError:
                         raise
                     except StopIteration:
                         # Probably testing code to skip
+                        metrics.add_time(stats, "entry_time", t)
+                        stats["skipped"] = stats.get("skipped", 0) + 1
                         continue
                     except UnboundLocalError:
                         # Crawl stopped in the middle of multi-page entry
                         # Just skip to the first full entry
                         break
                     except:
-                        logger.error("  Error parsing: %s" % item.get_text())
+                        logger.error("  Error parsing: %s" % text)
                         logger.error("    page_id: %d" % page)
                         raise
+                    metrics.add_time(stats, "entry_time", t)
                     if entry[2] == 0:
                         logger.error("  get_entry() returned without action")
                         logger.error("    page_id: %d" % page)
                         raise AssertionError
                     k = (entry[1], entry[3], entry[2])
-                    try:
-                        prev = entries[k]
-                        if prev != entry:
-                            logger.error("  Contradictory entries:")
-                            logger.error("    Keeping: " + str(prev))
-                            logger.error("    Discarding: " + str(entry))
-                        skip_count += 1
-                    except KeyError:
-                        entries[k] = entry
+                    if runs is not None:
+                        # Duplicates are dropped when the runs are merged
+                        entries.append((k, entry))
                         entry_count += 1
-    logger.info("Parse complete")
-    logger.info("Sortintg results")
-    sorted_keys = sorted(entries.keys())
-    logger.info("Writing results")
-    quoted_name = urllib.quote(project_name.replace(" ", "_").encode('utf-8'), safe="")
-    assessment_path = os.path.join(assessment_file % quoted_name)
+                        if len(entries) >= spill_entries:
+                            t = time.time()
+                            clean_name = projects.clean_name(project_name)
+                            runs.append(spill_run(entries, spill_dir % clean_name))
+                            entries = []
+                            metrics.add_time(stats, "spill_time", t)
+                    elif add_entry(entries, k, entry, logger):
+                        entry_count += 1
+                    else:
+                        skip_count += 1
+                        stats["duplicates"] = stats.get("duplicates", 0) + 1
+        if entry_count == 0 and skip_count == 0:
+            if huge:
+                logger.warning("Log too large to upload: %s" % page)
+            else:
+                logger.error("Found no entries in: %s" % page)
+    return entries
+
+def starts_log(html):
+    '''Whether a page has a date header of its own and doesn't continue the page before.
+
+    Uses the page extractor, so it agrees with parse_pages() on which pages
+    set the date.
+    '''
+    contd, blocks, huge = page_backends[page_backend](html)
+    return not contd and blocks is not None
+
+def split_pages(pages, chunk_size):
+    '''Yield chunks of at least chunk_size pages from (page_id, html) pairs.
+
+    Continuation pages take their date from the page before them, so a new
+    chunk only starts on a page that has its own date header. Only pages
+    that could start one are extracted to check. Pages are only taken from
+    the iterable as each chunk is filled.
+    '''
+    chunk = []
+    for page, html in pages:
+        if (
+            len(chunk) >= chunk_size
+            and contd_text not in html
+            and date_pattern.search(html)
+            and starts_log(html)
+        ):
+            yield chunk
+            chunk = []
+        chunk.append((page, html))
+    if chunk:
+        yield chunk
+
+def parse_chunk(args):
+    '''Pool worker, parse one chunk of (page_id, html) pairs from split_pages().
+
+    Returns (runs, entries, stats), when spilling entries is None and
+    everything is in runs.
+    '''
+    project_name, chunk, spill = args
+    logger = logging.getLogger(project_name)
+    pages = dict(chunk)
+    page_ids = [page for page, html in chunk]
+    stats = {}
+    if not spill:
+        entries = parse_pages(project_name, page_ids, pages.pop, logger, stats)
+        return [], entries, stats
+    runs = []
+    entries = parse_pages(project_name, page_ids, pages.pop, logger, stats, runs)
+    if entries:
+        clean_name = projects.clean_name(project_name)
+        runs.append(spill_run(entries, spill_dir % clean_name))
+    return runs, None, stats
+
+def merge_entries(chunk_entries, logger):
+    '''Merge per-chunk entries in page order, first entry wins as in parse_pages().'''
+    entries = {}
+    for chunk in chunk_entries:
+        for k, entry in chunk.iteritems():
+            add_entry(entries, k, entry, logger)
+    return entries
+
+def write_assessments(project_name, rows, logger):
+    '''Write entry rows for a project to its utf-8 assessment TSV.'''
+    assessment_path = assessment_file % projects.quoted_name(project_name)
     try:
         with open(assessment_path, "wb") as f:
             try:
                 f.write((u"\t".join(columns) + u"\n").encode('utf-8'))
-                for k in sorted_keys:
-                    entry = entries[k]
+                for entry in rows:
                     row = u"\t".join([unicode(x) for x in entry]) + u"\n"
                     f.write(row.encode('utf-8'))
             except IOError:
-                logger.error("Error writing: %s" % str(entry))
+                logger.error("Error writing: %s" % str(list(entry)))
                 raise ValueError
     except IOError:
         logger.error("Error opening: %s" % assessment_path)
@@ -717,81 +1032,293 @@ def parse(project_name):
         f.close()
     except:
         pass
-    logger.info("Marking complete")
-    with open(done_parse % clean_name, "wb") as f:
-        f.write(project_name.encode('utf-8'))
+    return assessment_path
+
+def check_config():
+    '''Raise ImportError if an output option is set without the module it needs.'''
+    if columnar_output and columnar is None:
+        raise ImportError("columnar_output needs numpy, which can't be imported")
+    if renames_output and renames is None:
+        raise ImportError("renames_output needs numpy, which can't be imported")
+
+def open_pages(clean_name, from_tar=False):
+    '''Return page ids (newest first) and a page reader from the store, tar or cache dir.'''
+    if pagestore.exists(clean_name):
+        return pagestore.open_store(clean_name)
+    if from_tar:
+        return open_cache_tar(clean_name)
+    return open_cache_dir(clean_name)
+
+def parse(project_name, from_tar=False, page_workers=1):
+    check_config()
+    clean_name = projects.clean_name(project_name)
+    logger = logging.getLogger(project_name)
+    fh = logging.FileHandler(project_log % clean_name)
+    logger.addHandler(fh)
+    logger.setLevel(logging.DEBUG)
+    logger.info("Beggining parse")
+    entry_values.clear()
+    stats = {}
+    start = time.time()
+    
+    spill = spill_entries > 0
+    project_spill_dir = spill_dir % clean_name
+    if spill:
+        # Runs left behind by a failed parse are stale
+        if os.path.exists(project_spill_dir):
+            shutil.rmtree(project_spill_dir)
+        os.makedirs(project_spill_dir)
+    # Forked before the pages are opened, so the workers don't inherit the
+    # page store's connection or the tar
+    if page_workers > 1:
+        pool = Pool(page_workers)
+    # Loop through cached history pages
+    # Go newest to oldest for correct order in multi-page entries
+    t = time.time()
     try:
-        f.close()
+        page_ids, read_page = open_pages(clean_name, from_tar)
     except:
-        pass
+        if page_workers > 1:
+            pool.terminate()
+        raise
+    metrics.add_time(stats, "read_time", t)
+    runs = []
+    if page_workers > 1:
+        # Pages are read as chunks are sent, at most split_read_ahead chunks
+        # per worker ahead of the ones finished
+        pages = ((page, read_page(page)) for page in page_ids)
+        queued = deque()
+        results = []
+        try:
+            for chunk in split_pages(pages, split_chunk_size):
+                while len(queued) >= split_read_ahead * page_workers:
+                    results.append(queued.popleft().get())
+                queued.append(pool.apply_async(parse_chunk, [(project_name, chunk, spill)]))
+            while queued:
+                results.append(queued.popleft().get())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+        logger.info("Parsed %d pages in %d chunks" % (len(page_ids), len(results)))
+        for chunk_runs, chunk_entries, chunk_stats in results:
+            runs.extend(chunk_runs)
+            metrics.merge_metrics(stats, chunk_stats)
+        if not spill:
+            entries = merge_entries([r[1] for r in results], logger)
+            # Entries repeated across chunks
+            stats["duplicates"] = stats.get("duplicates", 0) + (
+                sum(len(r[1]) for r in results) - len(entries))
+    elif spill:
+        entries = parse_pages(project_name, page_ids, read_page, logger, stats, runs)
+        if entries:
+            runs.append(spill_run(entries, project_spill_dir))
+    else:
+        entries = parse_pages(project_name, page_ids, read_page, logger, stats)
+    logger.info("Parse complete")
+    if spill:
+        logger.info("Merging %d runs" % len(runs))
+        stats["runs"] = len(runs)
+        stats["entries"] = 0
+        # Only the first pass logs contradictions and counts entries
+        rows = merge_runs(runs, logger, stats)
+        get_rows = lambda: merge_runs(runs)
+        t = time.time()
+    else:
+        logger.info("Sortintg results")
+        t = time.time()
+        sorted_keys = sorted(entries.keys())
+        t = metrics.add_time(stats, "sort_time", t)
+        stats["entries"] = len(entries)
+        get_rows = lambda: (entries[k] for k in sorted_keys)
+        rows = get_rows()
+    logger.info("Writing results")
+    assessment_path = write_assessments(project_name, rows, logger)
+    t = metrics.add_time(stats, "write_time", t)
+    if columnar_output:
+        logger.info("Writing columnar results")
+        columnar.write_columnar(project_name, get_rows())
+        t = metrics.add_time(stats, "columnar_time", t)
+    if store_output:
+        logger.info("Loading results into store")
+        conn = store.connect()
+        try:
+            store.load_project(
+                conn, project_name, get_rows(), os.path.getmtime(assessment_path))
+        finally:
+            conn.close()
+        t = metrics.add_time(stats, "store_time", t)
+    if renames_output:
+        logger.info("Resolving renames")
+        conn = renames.connect()
+        try:
+            renames.load_project(conn, project_name, get_rows(), os.path.getmtime(assessment_path))
+        finally:
+            conn.close()
+        metrics.add_time(stats, "renames_time", t)
+    if spill:
+        shutil.rmtree(project_spill_dir)
+    stats["elapsed"] = time.time() - start
+    stats["project"] = project_name
+    stats["backend"] = page_backend
+    metrics.write_metrics(metrics.parse_metrics % clean_name, stats)
+    logger.info("Marking complete")
+    registry.finish(project_name, "parse", stats["entries"])
     logger.info("Project %s complete" % project_name)
     handlers = logger.handlers[:]
     for handler in handlers:
         handler.close()
         logger.removeHandler(handler)
-    
-# Load project names, ignore duplicates
-project_names = []
-unique_names = set()
-with open(project_tsv, "rb") as f:
-    lines = enumerate(f.read().decode('utf-16-le').split(u"\n"))
-    lines.next()
-    for i, line in lines:
-        if len(line) == 0:
-            continue
-        name, unique = line.split(u"\t")
-        if unique not in unique_names:
-            unique_names.add(unique) 
-            project_names.append(name)
-try:
-    # Prevent running out of filehandlers if python procrastinates
-    f.close()
-except:
-    pass
-
-# Only run testing project (should usually be commented out)
-if test_only:
-    parse(test_project)
-    sys.exit()
-
-# Parse all projects
-for project_name in sorted(project_names):
-    clean_name = clean_name = project_name.replace("/", "_")
-    # If the first arg is a project name, skip to that arg
-    try:
-        if sys.argv[1] > project_name:
-            logger.info("Skipping from arg: %s" % project_name)
-            continue
-    except IndexError:
-        pass
-    try:
-        if sys.argv[2] <= project_name:
-            logger.info("Skipping from arg: %s" % project_name)
-            break
-    except IndexError:
-        pass
-    # Make sure project hasn't already been crawled
-    try:
-        os.stat(done_parse % clean_name)
-        logger.info("Skipping complete: %s" % project_name)
-        continue
-    except OSError:
-        pass
+
+def parse_project(project_name, page_workers=1):
+    '''Parse one project, returning (project_name, traceback or None).'''
+    clean_name = projects.clean_name(project_name)
+    # A crawl that isn't done may have stored only some of the pages, or be
+    # storing them now
+    if registry.get_state(project_name, "crawl") != registry.done:
+        logger.info("Skipping uncrawled: %s" % project_name)
+        return project_name, None
+    # Another worker may have taken or finished it since the queue was made
+    if not registry.claim(project_name, "parse"):
+        logger.info("Skipping claimed: %s" % project_name)
+        return project_name, None
     logger.info("Beginning %s" % project_name)
-    logger.info("  Decompressing cache")
     project_cache_tar = cache_tar % clean_name
     project_cache_dir = cache_dir % clean_name
-    subprocess.call(["tar", "-xzf", project_cache_tar])
+    # Pages in the page store are read from it directly
+    extract = not stream_tar and not pagestore.exists(clean_name)
+    if extract:
+        logger.info("  Decompressing cache")
+        subprocess.call(["tar", "-xzf", project_cache_tar])
     logger.info("  Beginning parse")
+    error = None
     try:
-        parse(project_name)
+        parse(project_name, from_tar=stream_tar, page_workers=page_workers)
         logger.info("  Parsed successfully")
     except:
-        logger.error(traceback.format_exc())
-    logger.info("  Cleaning up")
-    try:
-       shutil.rmtree(project_cache_dir)
-    except:
-        # Will error if we were unable to successfully decompress
-        pass
+        error = traceback.format_exc()
+        logger.error(error)
+        registry.fail(project_name, "parse", error)
+    if extract:
+        logger.info("  Cleaning up")
+        try:
+           shutil.rmtree(project_cache_dir)
+        except:
+            # Will error if we were unable to successfully decompress
+            pass
+    return project_name, error
+
+def main(args=None):
+    '''Parse every project not parsed yet.
+
+    args may give the first project name to parse and the name to stop
+    before, by default they come from the command line.
+    '''
+    if args is None:
+        args = sys.argv[1:]
+    # Before any project is claimed
+    check_config()
+    handler = logging.FileHandler('output/parser_%s.log' % datetime.now().strftime("%m%dT%H%M"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
+    # Load project names
+    project_names = projects.load_project_names()
+
+    # Only run testing project (should usually be commented out)
+    if test_only:
+        parse(test_project)
+        return
+
+    # Parse all projects
+    registry.add_projects(project_names)
+    parse_states = registry.get_states("parse")
+    crawl_states = registry.get_states("crawl")
+    project_queue = []
+    for project_name in sorted(project_names):
+        clean_name = projects.clean_name(project_name)
+        # If the first arg is a project name, skip to that arg
+        try:
+            if args[0] > project_name:
+                logger.info("Skipping from arg: %s" % project_name)
+                continue
+        except IndexError:
+            pass
+        try:
+            if args[1] <= project_name:
+                logger.info("Skipping from arg: %s" % project_name)
+                break
+        except IndexError:
+            pass
+        # Make sure project hasn't already been parsed
+        if parse_states.get(project_name) == registry.done:
+            logger.info("Skipping complete: %s" % project_name)
+            continue
+        # Only projects with all their pages
+        if crawl_states.get(project_name) != registry.done:
+            logger.info("Skipping uncrawled: %s" % project_name)
+            continue
+        project_queue.append(project_name)
+
+    # Huge projects are split across page workers, pool workers can't do that
+    # since they aren't allowed children of their own
+    large_projects = []
+    if page_workers > 1:
+        for project_name in project_queue:
+            clean_name = projects.clean_name(project_name)
+            if pagestore.exists(clean_name):
+                conn = pagestore.connect(clean_name)
+                try:
+                    if pagestore.get_stats(conn)["bytes"] >= split_min_page_bytes:
+                        large_projects.append(project_name)
+                finally:
+                    conn.close()
+                continue
+            try:
+                if os.path.getsize(cache_tar % clean_name) >= split_min_size:
+                    large_projects.append(project_name)
+            except OSError:
+                pass
+        large_set = set(large_projects)
+        project_queue = [p for p in project_queue if p not in large_set]
+
+    failures = []
+    if num_workers > 1:
+        logger.info("Creating %d workers" % num_workers)
+        pool = Pool(num_workers)
+        try:
+            results = pool.imap_unordered(parse_project, project_queue)
+            # Parse huge projects here while the pool works through the rest
+            for project_name in large_projects:
+                project_name, error = parse_project(project_name, page_workers)
+                if error is not None:
+                    failures.append((project_name, error))
+            for project_name, error in results:
+                if error is not None:
+                    failures.append((project_name, error))
+            pool.close()
+        except:
+            logger.error("Exception: %s" % str(sys.exc_info()))
+            logger.info("Stopping workers")
+            pool.terminate()
+            raise
+        pool.join()
+    else:
+        for project_name in large_projects:
+            project_name, error = parse_project(project_name, page_workers)
+            if error is not None:
+                failures.append((project_name, error))
+        for project_name in project_queue:
+            project_name, error = parse_project(project_name)
+            if error is not None:
+                failures.append((project_name, error))
+
+    logger.info("Parsed %d projects, %d failed" % (
+        len(large_projects) + len(project_queue), len(failures)))
+    for project_name, error in failures:
+        logger.error("Failed: %s" % project_name)
+        logger.error(error)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Command line entry point for the whole pipeline
+#
+# Usage: python pipeline.py <command> [args]
+#   crawl                          crawl every project not crawled yet
+#   parse [first [stop]]           parse every project not parsed yet, from
+#                                  first and stopping before stop if given
+#   status [--json|--tsv]          crawl and parse progress of every project
+#   reset [--crawl] [project ...]  queue projects for parsing, or with
+#                                  --crawl crawling, again, all if none are
+#                                  given
+#   mark-completed (--all | project ...)
+#                                  mark projects parsed, --all for every
+#                                  crawled project
+#   shocks [bin_days]              flag bursts in every project's
+#                                  assessment counts
+#   trajectories [project ...]     build the article trajectory index, for
+#                                  every project if none are given
+#   renames                        load new assessment TSVs into the
+#                                  canonical article ids
+#   gaps [project ...]             write the gaps in each project's log and
+#                                  its repeated events
+#
+# Each command's module is only imported when it runs, so commands that
+# don't parse pages never load the parser's dependencies.
+
+import sys
+
+# Command name to module with a main(args)
+commands = {
+    "crawl": "crawler",
+    "parse": "parser",
+    "status": "status_report",
+    "reset": "reset_parse",
+    "mark-completed": "mark_completed",
+    "shocks": "shocks",
+    "trajectories": "trajectories",
+    "renames": "renames",
+    "gaps": "gaps",
+}
+
+def usage():
+    print "Usage: python pipeline.py <%s> [args]" % "|".join(sorted(commands))
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if len(args) == 0 or args[0] not in commands:
+        usage()
+        return 2
+    module = __import__(commands[args[0]])
+    return module.main(args[1:]) or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
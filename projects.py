@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Project list shared by the crawler, the parser and the status scripts
+#
+# The project TSV is utf-16-le with a header and a name and unique column
+# per line, projects with a unique value seen earlier are duplicates. The
+# parsed list is kept in a JSON sidecar next to the TSV so loading it is one
+# small read. The sidecar is used while the TSV's size and mtime match. If
+# they don't but the TSV's hash is unchanged it is still used, otherwise
+# the TSV is parsed again.
+
+import hashlib
+import json
+import os
+import urllib
+
+# Config
+project_tsv = "data/projects-2016-10-12.utf-16-le.tsv"
+sidecar_file = "%s.index.json"
+
+def parse_project_tsv(data):
+    '''Return the project names in utf-16-le TSV data, ignoring duplicates.'''
+    project_names = []
+    unique_names = set()
+    lines = enumerate(data.decode('utf-16-le').split(u"\n"))
+    lines.next()
+    for i, line in lines:
+        if len(line) == 0:
+            continue
+        name, unique = line.split(u"\t")
+        if unique not in unique_names:
+            unique_names.add(unique)
+            project_names.append(name)
+    return project_names
+
+def read_sidecar(path):
+    try:
+        with open(sidecar_file % path, "rb") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_sidecar(path, index):
+    '''Write the sidecar atomically, skipped if the data dir isn't writable.'''
+    sidecar_path = sidecar_file % path
+    try:
+        with open(sidecar_path + ".tmp", "wb") as f:
+            json.dump(index, f)
+        os.rename(sidecar_path + ".tmp", sidecar_path)
+    except (IOError, OSError):
+        pass
+
+def load_project_names(path=project_tsv):
+    '''Return the project names in the TSV at path, in file order.'''
+    st = os.stat(path)
+    index = read_sidecar(path)
+    if index is not None and index["size"] == st.st_size and index["mtime"] == st.st_mtime:
+        return index["names"]
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    if index is None or index["sha1"] != digest:
+        index = {"sha1": digest, "names": parse_project_tsv(data)}
+    # Touched but unchanged TSVs only need their size and mtime updated
+    index["size"] = st.st_size
+    index["mtime"] = st.st_mtime
+    write_sidecar(path, index)
+    return index["names"]
+
+def clean_name(project_name):
+    '''Name used for the project's directory, log and cache files.'''
+    return project_name.replace("/", "_")
+
+def quoted_name(project_name):
+    '''Name used for the project's assessment files.'''
+    return urllib.quote(project_name.replace(" ", "_").encode('utf-8'), safe="")
+
+def get_index(project_names):
+    '''Return dicts from name to clean_name, clean_name to name and name to quoted_name.'''
+    clean_names = {}
+    names_by_clean = {}
+    quoted_names = {}
+    for project_name in project_names:
+        clean_names[project_name] = clean_name(project_name)
+        names_by_clean[clean_names[project_name]] = project_name
+        quoted_names[project_name] = quoted_name(project_name)
+    return clean_names, names_by_clean, quoted_names
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# Crawl and parse status of every project
+#
+# Replaces the marker files in output/to_crawl, output/to_parse and
+# output/done_parse with one SQLite table, so the status of every project is
+# a single query and workers claim projects in a transaction instead of
+# racing on files. Each project has a row per stage in one of the states
+# below. A project from a tree that still has marker files gets its first
+# rows from them.
+
+from contextlib import contextmanager
+import errno
+import os
+import socket
+import sqlite3
+import time
+
+import projects
+
+# Config
+registry_db = "output/status.sqlite"
+# Seconds to wait for another process holding the write lock
+lock_timeout = 300
+# Claims older than this belong to a worker that died, and can be taken over.
+# Claims of processes on this host that have exited are released at once.
+stale_claim = 2 * 24 * 3600
+# Marker files from before the registry
+output_dir = "output/projects/%s"
+to_crawl = "output/to_crawl/%s"
+done_parse = "output/done_parse/%s"
+
+stages = ["crawl", "parse"]
+# States
+pending = "pending"
+running = "running"
+done = "done"
+failed = "failed"
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS status (
+        Project TEXT NOT NULL,
+        Stage TEXT NOT NULL,
+        State TEXT NOT NULL,
+        Attempts INTEGER NOT NULL DEFAULT 0,
+        Claimed INTEGER,
+        Finished INTEGER,
+        Updated INTEGER NOT NULL,
+        Owner TEXT,
+        Error TEXT,
+        PRIMARY KEY (Project, Stage)
+    )''',
+    "CREATE INDEX IF NOT EXISTS status_state ON status (Stage, State)",
+]
+# Columns added since the table was first created, as (name, type)
+added_columns = [
+    ("Rows", "INTEGER"),
+]
+
+def connect(path=registry_db):
+    '''Open the registry, creating its table if needed.'''
+    conn = sqlite3.connect(path, timeout=lock_timeout, isolation_level=None)
+    # Readers don't block workers updating their projects
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        conn.execute(statement)
+    existing = set(row[1] for row in conn.execute("PRAGMA table_info(status)"))
+    for name, kind in added_columns:
+        if name not in existing:
+            try:
+                conn.execute("ALTER TABLE status ADD COLUMN %s %s" % (name, kind))
+            except sqlite3.OperationalError:
+                # Another process added it first
+                pass
+    return conn
+
+@contextmanager
+def transaction(path=registry_db):
+    '''Connection holding the write lock, committed if the block succeeds.'''
+    conn = connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn
+        conn.execute("COMMIT")
+    finally:
+        # Closing without a commit rolls back
+        conn.close()
+
+def owner():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+def owner_alive(owner_name):
+    '''Return False if owner_name is a process on this host that has exited.'''
+    host, sep, pid = (owner_name or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def release_dead_claims(conn, stage):
+    '''Fail the running claims of a stage whose owner has exited, e.g. a terminated pool worker.'''
+    now = int(time.time())
+    dead = [
+        (project_name, owner_name) for project_name, owner_name in conn.execute(
+            "SELECT Project, Owner FROM status WHERE Stage = ? AND State = ?",
+            (stage, running))
+        if not owner_alive(owner_name)]
+    for project_name, owner_name in dead:
+        conn.execute(
+            "UPDATE status SET State = ?, Updated = ?, Error = ? WHERE Project = ? AND Stage = ?",
+            (failed, now, "Claimed by %s, which exited" % owner_name, project_name, stage))
+
+def list_markers(path):
+    '''Return the names in a marker directory, listed once.'''
+    try:
+        return set(os.listdir(os.path.dirname(path)))
+    except OSError:
+        return set()
+
+def marker_state(clean_name, stage, markers):
+    '''State of a project's stage according to the old marker files.'''
+    if stage == "crawl":
+        # The crawler created to_crawl along with the project dir
+        if clean_name in markers["projects"] and clean_name not in markers["to_crawl"]:
+            return done
+        return pending
+    if clean_name in markers["done_parse"]:
+        return done
+    return pending
+
+def add_rows(conn, project_names):
+    '''Give projects that aren't in the registry yet their first rows.'''
+    now = int(time.time())
+    markers = None
+    for project_name in project_names:
+        known = set(row[0] for row in conn.execute(
+            "SELECT Stage FROM status WHERE Project = ?", (project_name,)))
+        if len(known) == len(stages):
+            continue
+        if markers is None:
+            markers = {
+                "projects": list_markers(output_dir),
+                "to_crawl": list_markers(to_crawl),
+                "done_parse": list_markers(done_parse),
+            }
+        clean_name = projects.clean_name(project_name)
+        for stage in stages:
+            if stage in known:
+                continue
+            conn.execute(
+                "INSERT INTO status (Project, Stage, State, Updated) VALUES (?, ?, ?, ?)",
+                (project_name, stage, marker_state(clean_name, stage, markers), now))
+
+def add_projects(project_names, path=registry_db):
+    '''Register projects, once, importing their state from any marker files.'''
+    with transaction(path) as conn:
+        add_rows(conn, project_names)
+
+def claim(project_name, stage, path=registry_db):
+    '''Claim a project's stage for this process.
+
+    Only pending and failed stages, or ones whose claim went stale or whose
+    owner exited, can be claimed. Returns True if this process got the
+    claim.
+    '''
+    now = int(time.time())
+    with transaction(path) as conn:
+        add_rows(conn, [project_name])
+        release_dead_claims(conn, stage)
+        cursor = conn.execute(
+            "UPDATE status SET State = ?, Attempts = Attempts + 1, Claimed = ?, "
+            "Updated = ?, Owner = ? WHERE Project = ? AND Stage = ? AND "
+            "(State IN (?, ?) OR (State = ? AND Claimed < ?))",
+            (running, now, now, owner(), project_name, stage,
+             pending, failed, running, now - stale_claim))
+        return cursor.rowcount == 1
+
+def claim_next(stage, path=registry_db):
+    '''Claim the first project, by name, whose stage can be claimed, or return None.'''
+    now = int(time.time())
+    with transaction(path) as conn:
+        release_dead_claims(conn, stage)
+        row = conn.execute(
+            "SELECT Project FROM status WHERE Stage = ? AND "
+            "(State IN (?, ?) OR (State = ? AND Claimed < ?)) ORDER BY Project LIMIT 1",
+            (stage, pending, failed, running, now - stale_claim)).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE status SET State = ?, Attempts = Attempts + 1, Claimed = ?, "
+            "Updated = ?, Owner = ? WHERE Project = ? AND Stage = ?",
+            (running, now, now, owner(), row[0], stage))
+        return row[0]
+
+def set_state(project_names, stage, state, error=None, rows=None, path=registry_db):
+    '''Set the state of a stage for each of project_names.
+
+    error and rows replace the last error and the row count if given. A
+    stage that's done has no last error.
+    '''
+    now = int(time.time())
+    if state == done:
+        finished = now
+    else:
+        finished = None
+    updates = ["State = ?", "Finished = ?", "Updated = ?"]
+    values = [state, finished, now]
+    if error is not None:
+        updates.append("Error = ?")
+        values.append(error)
+    elif state == done:
+        updates.append("Error = NULL")
+    if rows is not None:
+        updates.append("Rows = ?")
+        values.append(rows)
+    query = "UPDATE status SET %s WHERE Project = ? AND Stage = ?" % ", ".join(updates)
+    with transaction(path) as conn:
+        add_rows(conn, project_names)
+        for project_name in project_names:
+            conn.execute(query, values + [project_name, stage])
+
+def finish(project_name, stage, rows=None, path=registry_db):
+    '''Mark a stage done, with the number of rows it produced if known.'''
+    set_state([project_name], stage, done, rows=rows, path=path)
+
+def fail(project_name, stage, error, path=registry_db):
+    '''Mark a stage failed, keeping error as the project's last error.'''
+    set_state([project_name], stage, failed, error, path=path)
+
+def reset(project_names, stage, path=registry_db):
+    '''Queue a stage to be run again for each of project_names.'''
+    set_state(project_names, stage, pending, path=path)
+
+def get_state(project_name, stage, path=registry_db):
+    '''Return the state of a project's stage, or None if it isn't registered.'''
+    conn = connect(path)
+    try:
+        row = conn.execute(
+            "SELECT State FROM status WHERE Project = ? AND Stage = ?",
+            (project_name, stage)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return row[0]
+
+def get_states(stage, path=registry_db):
+    '''Return a dict from project name to the state of its stage.'''
+    conn = connect(path)
+    try:
+        return dict(conn.execute(
+            "SELECT Project, State FROM status WHERE Stage = ?", (stage,)))
+    finally:
+        conn.close()
+
+def get_status(path=registry_db):
+    '''Return every row of the registry as a dict, ordered by project and stage.'''
+    conn = connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in conn.execute(
+            "SELECT * FROM status ORDER BY Project, Stage")]
+    finally:
+        conn.close()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# Canonical article ids across renames
+#
+# Every article name gets a permanent id the first time it's seen, and the
+# Renamed rows of every project join names into sets with a union-find kept
+# in SQLite. An article's canonical id is the smallest id in its set, the
+# first of its names to be seen, so ids only change when two sets merge.
+# Each project gets a sidecar with the name id of every row, in TSV order,
+# and readers map those to canonical ids, so projects loaded earlier never
+# need their sidecars rewritten. Sets are never split, a rename dropped by a
+# later parse stays joined. get_row_articles() instead follows one
+# project's renames in time, for replaying its log.
+#
+# parse() loads each project as it finishes when renames_output is set, and
+# running this script loads any TSVs that are newer than the database.
+
+import glob
+import itertools
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import projects
+import store
+
+# Config
+renames_db = "output/renames.sqlite"
+article_ids_file = "output/article_ids/%s.npy"
+assessment_glob = "output/assessments/*.utf8.tsv"
+# Seconds to wait for another process holding the write lock
+lock_timeout = 300
+# Names looked up per query
+lookup_batch = 500
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS names (
+        Id INTEGER PRIMARY KEY,
+        Name TEXT NOT NULL UNIQUE,
+        Parent INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS projects (
+        Project TEXT PRIMARY KEY,
+        Rows INTEGER NOT NULL,
+        SourceMtime REAL,
+        LoadedAt INTEGER NOT NULL
+    )''',
+]
+
+def connect(path=renames_db):
+    '''Open the database, creating its tables if needed.'''
+    conn = sqlite3.connect(path, timeout=lock_timeout, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+def get_ids(conn, names):
+    '''Return a dict from each of names to its id, adding new names in order.'''
+    ids = {}
+    distinct = list(set(names))
+    for i in range(0, len(distinct), lookup_batch):
+        batch = distinct[i:i + lookup_batch]
+        query = "SELECT Name, Id FROM names WHERE Name IN (%s)" % ", ".join(["?"] * len(batch))
+        ids.update(conn.execute(query, batch))
+    next_id = conn.execute("SELECT IFNULL(MAX(Id), 0) + 1 FROM names").fetchone()[0]
+    new_names = []
+    for name in names:
+        if name not in ids:
+            ids[name] = next_id
+            new_names.append((next_id, name, next_id))
+            next_id += 1
+    conn.executemany("INSERT INTO names VALUES (?, ?, ?)", new_names)
+    return ids
+
+def find(conn, name_id, parents):
+    '''Return the root of name_id's set, pointing every id on the way at it.
+
+    parents caches the parents read and changed in this transaction.
+    '''
+    path = []
+    while True:
+        if name_id not in parents:
+            parents[name_id] = conn.execute(
+                "SELECT Parent FROM names WHERE Id = ?", (name_id,)).fetchone()[0]
+        if parents[name_id] == name_id:
+            break
+        path.append(name_id)
+        name_id = parents[name_id]
+    for i in path:
+        parents[i] = name_id
+    return name_id
+
+def union(conn, a, b, parents):
+    '''Join the sets of ids a and b under the smaller root.'''
+    root_a = find(conn, a, parents)
+    root_b = find(conn, b, parents)
+    if root_a != root_b:
+        parents[max(root_a, root_b)] = min(root_a, root_b)
+
+def load_project(conn, project_name, rows, source_mtime=None):
+    '''Add a project's names and renames and write its article id sidecar.
+
+    Names are numbered and renames joined in date order, in one transaction.
+    Returns the number of rows.
+    '''
+    rows = list(rows)
+    by_date = sorted(rows, key=lambda row: int(row[1]))
+    names = []
+    for row in by_date:
+        names.append(row[3])
+        if row[2] == u"Renamed" and row[8]:
+            names.append(row[8])
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        ids = get_ids(conn, names)
+        parents = {}
+        for row in by_date:
+            if row[2] == u"Renamed" and row[8]:
+                union(conn, ids[row[3]], ids[row[8]], parents)
+        conn.executemany(
+            "UPDATE names SET Parent = ? WHERE Id = ?",
+            [(parent, name_id) for name_id, parent in parents.items()])
+        conn.execute(
+            "INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?)",
+            (project_name, len(rows), source_mtime, int(time.time())))
+        conn.execute("COMMIT")
+    except:
+        conn.execute("ROLLBACK")
+        raise
+    # Name ids never change, so the sidecar can be written after the commit
+    write_article_ids(project_name, [ids[row[3]] for row in rows])
+    return len(rows)
+
+def write_article_ids(project_name, name_ids):
+    path = article_ids_file % projects.quoted_name(project_name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # np.save adds .npy to names without it
+    tmp_path = path[:-len(".npy")] + ".tmp.npy"
+    np.save(tmp_path, np.array(name_ids, dtype=np.int32))
+    os.rename(tmp_path, path)
+
+def get_canonical(conn):
+    '''Return an array from name id to canonical id.'''
+    max_id = conn.execute("SELECT IFNULL(MAX(Id), 0) FROM names").fetchone()[0]
+    parents = np.arange(max_id + 1, dtype=np.int32)
+    pairs = np.array(conn.execute("SELECT Id, Parent FROM names").fetchall(), dtype=np.int32)
+    if len(pairs):
+        parents[pairs[:, 0]] = pairs[:, 1]
+    # Point every id at its grandparent until they all point at roots
+    while True:
+        grandparents = parents[parents]
+        if (grandparents == parents).all():
+            return parents
+        parents = grandparents
+
+def read_canonical_ids(project_name, canonical):
+    '''Return the canonical article id of each row of a project's TSV.'''
+    name_ids = np.load(article_ids_file % projects.quoted_name(project_name))
+    return canonical[name_ids]
+
+def resolve(conn, name):
+    '''Return (canonical id, canonical name) for an article name, or None.'''
+    row = conn.execute("SELECT Id FROM names WHERE Name = ?", (name,)).fetchone()
+    if row is None:
+        return None
+    root = find(conn, row[0], {})
+    return root, conn.execute("SELECT Name FROM names WHERE Id = ?", (root,)).fetchone()[0]
+
+def get_row_articles(rows):
+    '''Return the article of each of a project's rows, following renames in time.
+
+    Articles are numbered in the order they're first seen. A Renamed row
+    moves its article to the new name from its date on, so rows under the
+    new name before then and under the old name after that day are other
+    articles. Unlike the sets in the database, a reused name isn't joined.
+    '''
+    articles = [None] * len(rows)
+    current = {}
+    count = itertools.count()
+    order = sorted(range(len(rows)), key=lambda i: int(rows[i][1]))
+    for date, day in itertools.groupby(order, key=lambda i: int(rows[i][1])):
+        day = list(day)
+        # Renames first, so the day's rows under either name are the one
+        # article
+        renamed = {}
+        for i in day:
+            row = rows[i]
+            if row[2] == u"Renamed" and row[8]:
+                if row[3] not in current:
+                    current[row[3]] = next(count)
+                article = current.pop(row[3])
+                renamed[row[3]] = current[row[8]] = articles[i] = article
+        for i in day:
+            if articles[i] is None:
+                name = rows[i][3]
+                if name not in current and name not in renamed:
+                    current[name] = next(count)
+                articles[i] = current.get(name, renamed.get(name))
+    return articles
+
+def consolidate(path=renames_db):
+    '''Load every assessment TSV that changed since it was last loaded.'''
+    conn = connect(path)
+    paths = sorted(glob.glob(assessment_glob))
+    loaded = 0
+    for i, tsv_path in enumerate(paths):
+        mtime = os.path.getmtime(tsv_path)
+        rows = store.read_tsv(tsv_path)
+        # The project name comes from the first row, projects without rows
+        # have no names
+        first = next(rows, None)
+        if first is None:
+            continue
+        project_name = first[0]
+        known = conn.execute(
+            "SELECT SourceMtime FROM projects WHERE Project = ?", (project_name,)).fetchone()
+        if known is not None and known[0] is not None and known[0] >= mtime:
+            continue
+        count = load_project(conn, project_name, itertools.chain([first], rows), mtime)
+        loaded += 1
+        print "%d/%d: %s (%d rows)" % (i + 1, len(paths), tsv_path, count)
+    print "Loaded %d of %d projects" % (loaded, len(paths))
+    conn.close()
+
+def main(args=None):
+    consolidate()
+
+if __name__ == "__main__":
+    main()
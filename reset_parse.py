@@ -4,59 +4,38 @@
 # Affiliation: Industrial and Operations Engineering, University of Michigan, Ann Arbor
 # File Name: crawler
 # Date: 11/10/16
+#
+# Usage: python reset_parse.py [--crawl] [project ...]
+#   --crawl queues the projects for crawling again instead, so the next
+#   crawl fetches their new revisions and queues them for parsing if there
+#   are any
 
-import codecs
-from collections import OrderedDict
-import datetime
-from dateutil.parser import parse
-import logging
-from multiprocessing import Pool, Process, Queue
-import os
-import os.path
-from Queue import Empty
-import re
-import shutil
 import sys
-import subprocess
-import time
-import traceback
 
-from bs4 import BeautifulSoup
-import urllib
+import projects
+import registry
 
-# Config
-num_workers = 25
-project_tsv = "data/projects-2016-10-12.utf-16-le.tsv"
-output_dir = "output/projects/%s"
-project_log = "output/projects/%s/project.log"
-to_crawl = "output/to_crawl/%s"
-to_parse = "output/to_parse/%s"
-cache_dir = "output/projects/%s/cache"
-cache_tar = "output/projects_crawled/%s-cache.tgz"
-base_url = "https://en.wikipedia.org/"
-assessment_history_url = (
-    "https://en.wikipedia.org/w/index.php?title=Wikipedia:Version_1.0_Editorial_Team/%s_articles_by_quality_log&offset=%s&limit=500&action=history"
-)
+def reset_parse(project_names):
+    '''Queue projects for parsing again.'''
+    registry.reset(project_names, "parse")
 
-# Load project names, ignore duplicates
-project_names = []
-unique_names = set()
-with open(project_tsv, "rb") as f:
-    lines = enumerate(f.read().decode('utf-16-le').split(u"\n"))
-    lines.next()
-    for i, line in lines:
-        if len(line) == 0:
-            continue
-        name, unique = line.split(u"\t")
-        if unique not in unique_names:
-            unique_names.add(unique)
-            project_names.append(name)
+def reset_crawl(project_names):
+    '''Queue projects for crawling again.'''
+    registry.reset(project_names, "crawl")
 
-for project_name in sorted(project_names):
-    clean_name = project_name.replace('/', '_')
-    with open(to_parse % clean_name, "wb") as f:
-        f.write(project_name.encode('utf-8'))
-    try:
-        f.close()
-    except:
-        pass
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    reset = reset_parse
+    if args[:1] == ["--crawl"]:
+        reset = reset_crawl
+        args = args[1:]
+    # Queue the projects given as arguments, or every project
+    if args:
+        names = [arg.decode('utf-8') for arg in args]
+    else:
+        names = sorted(projects.load_project_names())
+    reset(names)
+
+if __name__ == "__main__":
+    main()
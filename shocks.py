@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# Shock detection over assessment time series
+#
+# Bins every project's assessment events into count series, one per action
+# and one per quality transition (e.g. "B -> GA"), and flags bins whose
+# count is far above the bins before them. Only the series with events are
+# kept, and they are counted and scored in chunks of chunk_series, each one
+# bincount into an array of shape (series, bins) scored as a whole:
+#   z-score   (count - mean) / std of the z_window bins before
+#   surprise  -log10 P(X >= count) for X Poisson with the same mean
+# Only bins from a series' first event on count as its history, so the
+# start of a series isn't a shock.
+#
+# Events come from a project's columnar table if it has one, otherwise
+# from its assessment TSV.
+#
+# Usage: python shocks.py [bin_days]
+
+import codecs
+import datetime
+import os
+import sys
+
+import numpy as np
+
+import columnar
+import projects
+
+# Config
+assessment_file = "output/assessments/%s.utf8.tsv"
+shocks_file = "output/shocks/shocks-%dd.tsv"
+# Days per bin, 1 for daily and 7 for weekly series
+bin_days = 7
+# Bins start on Mondays, this many seconds after the epoch
+bin_epoch = 4 * 86400
+# Bins of history each bin is compared to
+z_window = 12
+# Bins without this much history aren't scored
+min_history = 4
+# Bins need this many events to be a shock
+min_count = 5
+# Standard deviations are at least this, so a quiet history doesn't turn
+# every event into a shock
+min_std = 1.0
+# Poisson means are at least this
+min_rate = 0.1
+z_threshold = 3.0
+surprise_threshold = 6.0
+# Series counted and scored at once. Memory is a few float64 arrays of
+# chunk_series by the number of bins, about 240 MB each for daily bins
+# over 10 years.
+chunk_series = 8192
+
+kinds = ["action", "transition"]
+
+def transition_label(old_qual, new_qual):
+    return u"%s -> %s" % (old_qual or u"-", new_qual or u"-")
+
+def read_events(project_name):
+    '''Return a project's events as (dates, codes, vocabs).
+
+    codes and vocabs map each kind to an array of codes, one per event, and
+    the labels they index. Events that don't change the quality have -1 as
+    their transition.
+    '''
+    try:
+        meta, columns = columnar.read_columnar(project_name)
+    except (IOError, OSError):
+        return read_tsv_events(project_name)
+    dates = np.asarray(columns["date"], dtype=np.int64)
+    codes = {"action": np.asarray(columns["action"], dtype=np.int64)}
+    vocabs = {"action": meta["action"]}
+    # Label each distinct (old, new) quality pair once
+    qual = meta["qual"]
+    pairs = (np.asarray(columns["old_qual"], dtype=np.int64) * len(qual)
+             + np.asarray(columns["new_qual"], dtype=np.int64))
+    unique, inverse = np.unique(pairs, return_inverse=True)
+    vocabs["transition"] = []
+    lookup = np.empty(len(unique), dtype=np.int64)
+    for i, pair in enumerate(unique):
+        old_qual, new_qual = qual[pair // len(qual)], qual[pair % len(qual)]
+        if old_qual == new_qual:
+            lookup[i] = -1
+        else:
+            lookup[i] = len(vocabs["transition"])
+            vocabs["transition"].append(transition_label(old_qual, new_qual))
+    codes["transition"] = lookup[inverse]
+    return dates, codes, vocabs
+
+def read_tsv_events(project_name):
+    dates = []
+    codes = {"action": [], "transition": []}
+    vocabs = {"action": {}, "transition": {}}
+    path = assessment_file % projects.quoted_name(project_name)
+    with codecs.open(path, "rb", encoding="utf-8") as f:
+        f.readline()
+        for line in f:
+            row = line.rstrip(u"\n").split(u"\t")
+            if len(row) < 6:
+                continue
+            dates.append(int(row[1]))
+            codes["action"].append(
+                vocabs["action"].setdefault(row[2], len(vocabs["action"])))
+            if row[4] == row[5]:
+                codes["transition"].append(-1)
+            else:
+                label = transition_label(row[4], row[5])
+                codes["transition"].append(
+                    vocabs["transition"].setdefault(label, len(vocabs["transition"])))
+    for kind in kinds:
+        codes[kind] = np.array(codes[kind], dtype=np.int64)
+        vocabs[kind] = sorted(vocabs[kind], key=vocabs[kind].get)
+    return np.array(dates, dtype=np.int64), codes, vocabs
+
+def build_series(project_names, bin_seconds):
+    '''Read every project's events into sparse count series.
+
+    Returns (names, labels, start, n_bins, series). labels maps each kind
+    to its series names, start is the time of the first bin and n_bins the
+    number of bins. series maps each kind to (pairs, rows, bins): pairs has
+    the (project, series) indexes of every series with events, sorted, and
+    rows and bins give each event's index into pairs and its bin, sorted by
+    row. Projects without events are left out of names.
+    '''
+    names = []
+    vocabs = dict((kind, {}) for kind in kinds)
+    dates = []
+    codes = dict((kind, []) for kind in kinds)
+    project_ids = []
+    for project_name in project_names:
+        try:
+            project_dates, project_codes, project_vocabs = read_events(project_name)
+        except (IOError, OSError):
+            continue
+        if len(project_dates) == 0:
+            continue
+        project_ids.append(np.full(len(project_dates), len(names), dtype=np.int64))
+        names.append(project_name)
+        dates.append(project_dates)
+        for kind in kinds:
+            # Project codes to shared codes. Blank labels and -1, which
+            # indexes the last entry, map to -1.
+            lookup = [-1] * (len(project_vocabs[kind]) + 1)
+            for i, label in enumerate(project_vocabs[kind]):
+                if label:
+                    lookup[i] = vocabs[kind].setdefault(label, len(vocabs[kind]))
+            lookup = np.array(lookup, dtype=np.int64)
+            codes[kind].append(lookup[project_codes[kind]])
+
+    labels = {}
+    series = {}
+    if not names:
+        empty = np.zeros(0, dtype=np.int64)
+        for kind in kinds:
+            labels[kind] = []
+            series[kind] = (np.zeros((0, 2), dtype=np.int64), empty, empty)
+        return names, labels, None, 0, series
+    dates = np.concatenate(dates)
+    project_ids = np.concatenate(project_ids)
+    bins = (dates - bin_epoch) // bin_seconds
+    first_bin = bins.min()
+    bins -= first_bin
+    n_bins = int(bins.max()) + 1
+    start = int(first_bin * bin_seconds + bin_epoch)
+    for kind in kinds:
+        labels[kind] = sorted(vocabs[kind], key=vocabs[kind].get)
+        kind_codes = np.concatenate(codes[kind])
+        keep = kind_codes >= 0
+        n_series = len(labels[kind])
+        # Only the (project, series) pairs with events get a row
+        keys, rows = np.unique(
+            project_ids[keep] * n_series + kind_codes[keep], return_inverse=True)
+        pairs = np.column_stack([keys // n_series, keys % n_series])
+        order = np.argsort(rows, kind='mergesort')
+        series[kind] = (pairs, rows[order], bins[keep][order])
+    return names, labels, start, n_bins, series
+
+def count_series(rows, bins, first, last, n_bins):
+    '''Return int32 counts of series rows first to last - 1, shape (rows, n_bins).'''
+    lo, hi = np.searchsorted(rows, [first, last])
+    index = (rows[lo:hi] - first) * n_bins + bins[lo:hi]
+    counts = np.bincount(index, minlength=(last - first) * n_bins)
+    return counts.astype(np.int32).reshape(last - first, n_bins)
+
+def rolling_baseline(counts, window):
+    '''Mean and standard deviation of the window bins before each bin.
+
+    Works along the last axis. History starts at each series' first nonzero
+    bin, the bins before it come before the series' log began rather than
+    being quiet. Returns (mean, std, history), history being how many bins
+    each one was taken over, with the same shape as counts.
+    '''
+    x = counts.astype(np.float64)
+    zeros = np.zeros(x.shape[:-1] + (1,))
+    sums = np.concatenate([zeros, np.cumsum(x, axis=-1)], axis=-1)
+    squares = np.concatenate([zeros, np.cumsum(x * x, axis=-1)], axis=-1)
+    end = np.arange(x.shape[-1])
+    first = np.argmax(counts > 0, axis=-1)[..., np.newaxis]
+    begin = np.minimum(np.maximum(end - window, first), end)
+    history = end - begin
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sums[..., end] - np.take_along_axis(sums, begin, axis=-1)) / history
+        var = (squares[..., end] - np.take_along_axis(squares, begin, axis=-1)) / history - mean * mean
+    std = np.sqrt(np.maximum(var, 0))
+    return mean, std, history
+
+def zscore(counts, mean, std, history):
+    '''Standard scores of counts, NaN where there's too little history.'''
+    z = (counts - mean) / np.maximum(std, min_std)
+    z[history < min_history] = np.nan
+    return z
+
+def poisson_surprise(counts, mean, history):
+    '''-log10 P(X >= count) for X Poisson with the mean of the bins before.
+
+    Uses P(X >= x) <= pmf(x) (x + 1) / (x + 1 - mean), which holds for
+    x + 1 > mean, so the surprise is never overstated. Counts at or below
+    the mean score 0 and bins with too little history NaN.
+    '''
+    x = counts.astype(np.float64)
+    rate = np.maximum(np.nan_to_num(mean), min_rate)
+    # log(k!) for every count that occurs
+    max_count = int(counts.max()) if counts.size else 0
+    log_factorial = np.concatenate(
+        [[0.0], np.cumsum(np.log(np.arange(1, max_count + 1)))])
+    log_pmf = x * np.log(rate) - rate - log_factorial[counts]
+    above = x > rate
+    ratio = np.where(above, (x + 1) / np.maximum(x + 1 - rate, 1e-12), 1.0)
+    log_tail = np.minimum(log_pmf + np.log(ratio), 0)
+    surprise = np.where(above, -log_tail / np.log(10), 0.0)
+    surprise[history < min_history] = np.nan
+    return surprise
+
+def find_shocks(counts, window=None):
+    '''Return (index, z, surprise, mean) for the bins flagged as shocks.
+
+    index is a tuple of index arrays into counts.
+    '''
+    if window is None:
+        window = z_window
+    mean, std, history = rolling_baseline(counts, window)
+    z = zscore(counts, mean, std, history)
+    surprise = poisson_surprise(counts, mean, history)
+    with np.errstate(invalid='ignore'):
+        flagged = (counts >= min_count) & (
+            (z >= z_threshold) | (surprise >= surprise_threshold))
+    index = np.nonzero(flagged)
+    return index, z[index], surprise[index], mean[index]
+
+def get_shocks(names, labels, start, n_bins, series, bin_seconds):
+    '''Return a row per shock, counting and scoring chunk_series series at a time.'''
+    rows = []
+    for kind in kinds:
+        pairs, event_rows, event_bins = series[kind]
+        for first in range(0, len(pairs), chunk_series):
+            last = min(first + chunk_series, len(pairs))
+            counts = count_series(event_rows, event_bins, first, last, n_bins)
+            (r, b), z, surprise, mean = find_shocks(counts)
+            for i in range(len(r)):
+                p, s = pairs[first + r[i]]
+                date = datetime.datetime.utcfromtimestamp(start + int(b[i]) * bin_seconds)
+                rows.append([
+                    names[p], kind, labels[kind][s],
+                    date.strftime("%Y-%m-%d"), int(counts[r[i], b[i]]),
+                    "%.2f" % mean[i], "%.2f" % z[i], "%.2f" % surprise[i]])
+    return rows
+
+def write_shocks(path, rows):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + ".tmp", "wb") as f:
+        f.write("Project\tKind\tSeries\tStart\tCount\tMean\tZScore\tSurprise\n")
+        for row in rows:
+            f.write((u"\t".join([unicode(x) for x in row]) + u"\n").encode('utf-8'))
+    os.rename(path + ".tmp", path)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    days = bin_days
+    if len(args) > 0:
+        days = int(args[0])
+    bin_seconds = days * 86400
+    names, labels, start, n_bins, series = build_series(
+        projects.load_project_names(), bin_seconds)
+    rows = get_shocks(names, labels, start, n_bins, series, bin_seconds)
+    path = shocks_file % days
+    write_shocks(path, rows)
+    print "%d shocks in %d projects written to %s" % (len(rows), len(names), path)
+
+if __name__ == "__main__":
+    main()
@@ -4,78 +4,163 @@
 # Affiliation: Industrial and Operations Engineering, University of Michigan, Ann Arbor
 # File Name: crawler
 # Date: 11/10/16
+#
+# Usage: python status_report.py [--json|--tsv]
+#   Prints the projects left to crawl and parse with progress figures, or
+#   one record per project as JSON or TSV.
 
-import codecs
-from collections import OrderedDict
-import datetime
-from dateutil.parser import parse
-import logging
-from multiprocessing import Pool, Process, Queue
+import json
+from multiprocessing.pool import ThreadPool
 import os
-import os.path
-from Queue import Empty
-import re
-import shutil
 import sys
-import subprocess
 import time
-import traceback
 
-from bs4 import BeautifulSoup
-import urllib
+import pagestore
+import projects
+import registry
 
 # Config
-num_workers = 25
-project_tsv = "data/projects-2016-10-12.utf-16-le.tsv"
-output_dir = "output/projects/%s"
-project_log = "output/projects/%s/project.log"
-to_crawl = "output/to_crawl/%s"
-to_parse = "output/to_parse/%s"
-done_parse = "output/done_parse/%s"
-cache_dir = "output/projects/%s/cache"
 cache_tar = "output/projects_crawled/%s-cache.tgz"
-base_url = "https://en.wikipedia.org/"
-assessment_history_url = (
-    "https://en.wikipedia.org/w/index.php?title=Wikipedia:Version_1.0_Editorial_Team/%s_articles_by_quality_log&offset=%s&limit=500&action=history"
-)
-
-# Load project names, ignore duplicates
-project_names = []
-unique_names = set()
-with open(project_tsv, "rb") as f:
-    lines = enumerate(f.read().decode('utf-16-le').split(u"\n"))
-    lines.next()
-    for i, line in lines:
-        if len(line) == 0:
-            continue
-        name, unique = line.split(u"\t")
-        if unique not in unique_names:
-            unique_names.add(unique)
-            project_names.append(name)
+# Directory entries are stat'ed this many at a time, stats on NFS are slow
+# one by one but fine in parallel
+scan_threads = 16
+# Completion rates for the ETA are taken over this many seconds
+eta_window = 3600
 
-report_to_crawl = set()
-report_to_parse = set()
+tsv_columns = [
+    "Project", "Crawl", "Parse", "CrawlAttempts", "ParseAttempts",
+    "CacheBytes", "Rows", "LastError"]
 
-for project_name in sorted(project_names):
-    clean_name = project_name.replace('/', '_')
-    # Try to open file in to_crawl
+def get_file_size(path):
     try:
-        os.stat(to_crawl % clean_name)
-        report_to_crawl.add(project_name)
-        continue
+        return os.stat(path).st_size
     except OSError:
-        # File has been crawled
-        pass
-    # Try to open file in done_parse
+        # Removed since it was listed
+        return None
+
+def get_cache_sizes():
+    '''Return a dict from clean name to cache size, listing the tar dir once.
+
+    A project's size is its cache tar and page store together, the store
+    being in the same directory as the tars.
+    '''
+    tar_dir = os.path.dirname(cache_tar)
+    suffixes = [os.path.basename(cache_tar % ""), os.path.basename(pagestore.store_path(""))]
     try:
-        os.stat(done_parse % clean_name)
+        names = [name for name in os.listdir(tar_dir)
+                 if any(name.endswith(suffix) for suffix in suffixes)]
     except OSError:
-        # File hasn't been parsed yet
-        report_to_parse.add(project_name)
-
-print "To Crawl (%d)" % len(report_to_crawl)
-for p in sorted(list(report_to_crawl)):
-    print "  %s" % p
-print "To Parse (%d)" % len(report_to_parse)
-for p in sorted(list(report_to_parse)):
-    print "  %s" % p
\ No newline at end of file
+        return {}
+    pool = ThreadPool(scan_threads)
+    try:
+        sizes = pool.map(get_file_size, [os.path.join(tar_dir, name) for name in names])
+    finally:
+        pool.close()
+        pool.join()
+    cache_sizes = {}
+    for name, size in zip(names, sizes):
+        if size is None:
+            continue
+        suffix = [suffix for suffix in suffixes if name.endswith(suffix)][0]
+        clean_name = name[:-len(suffix)]
+        cache_sizes[clean_name] = cache_sizes.get(clean_name, 0) + size
+    return cache_sizes
+
+def get_eta(rows, now):
+    '''Seconds until every project's stage is done at the recent rate, or None.'''
+    finished = [r for r in rows if r["State"] == registry.done and r["Finished"] is not None]
+    recent = [r for r in finished if r["Finished"] >= now - eta_window]
+    remaining = len([r for r in rows if r["State"] != registry.done])
+    if remaining == 0:
+        return 0
+    if len(recent) == 0:
+        return None
+    return remaining * float(eta_window) / len(recent)
+
+def get_report(project_names):
+    '''Return (report, summary), report has a dict per project.'''
+    registry.add_projects(project_names)
+    status = {}
+    for row in registry.get_status():
+        status[(row["Project"], row["Stage"])] = row
+    cache_sizes = get_cache_sizes()
+    clean_names = projects.get_index(project_names)[0]
+    now = int(time.time())
+
+    report = []
+    for project_name in sorted(project_names):
+        crawl = status[(project_name, "crawl")]
+        parse = status[(project_name, "parse")]
+        report.append({
+            "Project": project_name,
+            "Crawl": crawl["State"],
+            "Parse": parse["State"],
+            "CrawlAttempts": crawl["Attempts"],
+            "ParseAttempts": parse["Attempts"],
+            "CacheBytes": cache_sizes.get(clean_names[project_name]),
+            "Rows": parse["Rows"],
+            "LastError": parse["Error"] or crawl["Error"],
+        })
+
+    summary = {"projects": len(report), "time": now}
+    for stage in registry.stages:
+        rows = [status[(p["Project"], stage)] for p in report]
+        for state in [registry.pending, registry.running, registry.done, registry.failed]:
+            summary["%s_%s" % (stage, state)] = len([r for r in rows if r["State"] == state])
+        summary["%s_eta" % stage] = get_eta(rows, now)
+    summary["cache_bytes"] = sum(p["CacheBytes"] or 0 for p in report)
+    summary["rows"] = sum(p["Rows"] or 0 for p in report)
+    return report, summary
+
+def format_eta(seconds):
+    if seconds is None:
+        return "unknown"
+    return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+def print_text(report, summary):
+    report_to_crawl = [p["Project"] for p in report if p["Crawl"] != registry.done]
+    report_to_parse = [
+        p["Project"] for p in report
+        if p["Crawl"] == registry.done and p["Parse"] != registry.done]
+    print "To Crawl (%d)" % len(report_to_crawl)
+    for p in report_to_crawl:
+        print "  %s" % p
+    print "To Parse (%d)" % len(report_to_parse)
+    for p in report_to_parse:
+        print "  %s" % p
+    for stage in registry.stages:
+        print "%s: %d done, %d running, %d failed, %d pending of %d, ETA %s" % (
+            stage.capitalize(), summary["%s_done" % stage],
+            summary["%s_running" % stage], summary["%s_failed" % stage],
+            summary["%s_pending" % stage], summary["projects"],
+            format_eta(summary["%s_eta" % stage]))
+    print "Cached: %.1f MB, parsed rows: %d" % (
+        summary["cache_bytes"] / 1024.0 / 1024.0, summary["rows"])
+
+def print_tsv(report):
+    print "\t".join(tsv_columns)
+    for p in report:
+        row = []
+        for column in tsv_columns:
+            value = p[column]
+            if value is None:
+                value = u""
+            elif column == "LastError":
+                # Last line of the traceback, tabs and newlines would break the row
+                value = value.strip().split(u"\n")[-1].replace(u"\t", u" ")
+            row.append(unicode(value))
+        print u"\t".join(row).encode('utf-8')
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    report, summary = get_report(projects.load_project_names())
+    if "--json" in args:
+        print json.dumps({"projects": report, "summary": summary}, sort_keys=True)
+    elif "--tsv" in args:
+        print_tsv(report)
+    else:
+        print_text(report, summary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Consolidated assessment store
+#
+# Keeps the rows of every project's assessment TSV in one SQLite database,
+# indexed for cross-project lookups by article, project, date and action.
+# parse() loads each project as it finishes when store_output is set, and
+# running this script loads any TSVs that are newer than the store.
+
+import codecs
+import glob
+import itertools
+import os
+import sqlite3
+import time
+
+import config
+import projects
+
+# Config
+store_db = "output/assessments.sqlite"
+assessment_glob = "output/assessments/*.utf8.tsv"
+# Seconds to wait for another process holding the write lock
+lock_timeout = 300
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS assessments (
+        Project TEXT NOT NULL,
+        Date INTEGER NOT NULL,
+        Action TEXT NOT NULL,
+        ArticleName TEXT NOT NULL,
+        OldQual TEXT, NewQual TEXT, OldImp TEXT, NewImp TEXT,
+        NewArticleName TEXT, OldArticleLink TEXT, OldTalkLink TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS projects (
+        Project TEXT PRIMARY KEY,
+        Rows INTEGER NOT NULL,
+        SourceMtime REAL,
+        LoadedAt INTEGER NOT NULL
+    )''',
+    "CREATE INDEX IF NOT EXISTS assessments_article ON assessments (ArticleName)",
+    "CREATE INDEX IF NOT EXISTS assessments_project ON assessments (Project, Date)",
+    "CREATE INDEX IF NOT EXISTS assessments_date ON assessments (Date)",
+    "CREATE INDEX IF NOT EXISTS assessments_action ON assessments (Action, Date)",
+]
+
+def connect(path=store_db):
+    '''Open the store, creating its tables and indexes if needed.'''
+    conn = sqlite3.connect(path, timeout=lock_timeout)
+    # Readers don't block the loader and vice versa
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+def load_project(conn, project_name, rows, source_mtime=None):
+    '''Replace a project's rows in the store with rows, in one transaction.'''
+    insert = "INSERT INTO assessments VALUES (%s)" % ", ".join(["?"] * len(config.columns))
+    with conn:
+        conn.execute("DELETE FROM assessments WHERE Project = ?", (project_name,))
+        count = 0
+        for row in rows:
+            conn.execute(insert, [project_name, int(row[1])] + [unicode(x) for x in row[2:]])
+            count += 1
+        conn.execute(
+            "INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?)",
+            (project_name, count, source_mtime, int(time.time())))
+    return count
+
+def read_tsv(path):
+    '''Yield rows from an assessment TSV, skipping the header.'''
+    with codecs.open(path, "rb", encoding="utf-8") as f:
+        f.readline()
+        for line in f:
+            row = line.rstrip(u"\n").split(u"\t")
+            if len(row) == len(config.columns):
+                yield row
+
+def load_tsv(conn, path, project_name=None):
+    '''Load one assessment TSV unless the store already has this version.
+
+    The project name comes from the first row. A TSV without rows can't be
+    loaded unless project_name is given, file names don't keep all of it.
+    Returns the number of rows loaded, or None if nothing was loaded.
+    '''
+    mtime = os.path.getmtime(path)
+    rows = read_tsv(path)
+    try:
+        first = next(rows)
+    except StopIteration:
+        if project_name is None:
+            return None
+        first = None
+    else:
+        project_name = first[0]
+    loaded = conn.execute(
+        "SELECT SourceMtime FROM projects WHERE Project = ?", (project_name,)).fetchone()
+    if loaded is not None and loaded[0] is not None and loaded[0] >= mtime:
+        return None
+    if first is not None:
+        rows = itertools.chain([first], rows)
+    return load_project(conn, project_name, rows, mtime)
+
+def get_names_by_path():
+    '''Return a dict from each listed project's assessment TSV path to its name.'''
+    try:
+        project_names = projects.load_project_names()
+    except (IOError, OSError):
+        return {}
+    clean_names, names_by_clean, quoted_names = projects.get_index(project_names)
+    return dict(
+        (assessment_glob.replace("*", quoted_name), project_name)
+        for project_name, quoted_name in quoted_names.items())
+
+def consolidate(path=store_db):
+    '''Load every assessment TSV that changed since it was last loaded.'''
+    conn = connect(path)
+    paths = sorted(glob.glob(assessment_glob))
+    names_by_path = get_names_by_path()
+    loaded = 0
+    for i, tsv_path in enumerate(paths):
+        count = load_tsv(conn, tsv_path, names_by_path.get(tsv_path))
+        if count is not None:
+            loaded += 1
+            print "%d/%d: %s (%d rows)" % (i + 1, len(paths), tsv_path, count)
+    print "Loaded %d of %d projects" % (loaded, len(paths))
+    conn.close()
+
+# Queries, each returns rows in TSV column order
+
+def article_events(conn, article_name):
+    '''All events for an article across projects, oldest first.'''
+    return conn.execute(
+        "SELECT * FROM assessments WHERE ArticleName = ? ORDER BY Date, Project",
+        (article_name,)).fetchall()
+
+def action_events(conn, action, start, end):
+    '''All events with action in [start, end) UTC timestamps, e.g. one week.'''
+    return conn.execute(
+        "SELECT * FROM assessments WHERE Action = ? AND Date >= ? AND Date < ? "
+        "ORDER BY Date, Project, ArticleName",
+        (action, start, end)).fetchall()
+
+def project_events(conn, project_name, start=None, end=None):
+    '''Events for a project, optionally limited to [start, end).'''
+    query = "SELECT * FROM assessments WHERE Project = ?"
+    args = [project_name]
+    if start is not None:
+        query += " AND Date >= ?"
+        args.append(start)
+    if end is not None:
+        query += " AND Date < ?"
+        args.append(end)
+    return conn.execute(query + " ORDER BY Date, ArticleName", args).fetchall()
+
+if __name__ == "__main__":
+    consolidate()
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# Checks crawler.py's fetching against a local stub HTTP server
+#
+# Usage: python -m unittest discover tests
+
+import BaseHTTPServer
+import calendar
+import gzip
+import json
+import logging
+import os
+import random
+import shutil
+import SocketServer
+import sqlite3
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+import urlparse
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import benchmark
+import crawler
+import parser
+import registry
+
+fixture_dir = os.path.join(repo_dir, "tests", "fixtures")
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        # (client port, path, headers) of every request
+        self.requests = []
+        # Path to (status, body, extra headers), other paths are given to
+        # route if it's set, or get a page naming them
+        self.responses = {}
+        self.route = None
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+    def connections(self):
+        return len(set(port for port, path, headers in self.requests))
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive unless a response says otherwise
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(
+                (self.client_address[1], self.path, dict(self.headers)))
+        if self.path in self.server.responses:
+            status, body, headers = self.server.responses[self.path]
+        elif self.server.route is not None:
+            status, body, headers = self.server.route(self.path)
+        else:
+            status, body, headers = 200, "<html>%s</html>" % self.path, {}
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+                f.write(body)
+            body = buf.getvalue()
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path.startswith("/drop"):
+            # Close without saying so, like a keep-alive timeout
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServerTest(unittest.TestCase):
+    '''Runs a stub server for each test, with fetch() rate limits off.'''
+
+    def setUp(self):
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.max_request_rate = crawler.max_request_rate
+        crawler.max_request_rate = 0
+        crawler.connections.pool = {}
+        self.logger = logging.getLogger("test_crawler")
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+
+    def tearDown(self):
+        crawler.max_request_rate = self.max_request_rate
+        for conn in crawler.connections.pool.values():
+            conn.close()
+        crawler.connections.pool = {}
+        self.server.shutdown()
+        self.server.server_close()
+
+class FetchTest(StubServerTest):
+
+    def test_keep_alive(self):
+        for i in range(5):
+            status, body = crawler.fetch(self.server.url("/page?oldid=%d" % i))
+            self.assertEqual((status, body), (200, "<html>/page?oldid=%d</html>" % i))
+        self.assertEqual(self.server.connections(), 1)
+        for port, path, headers in self.server.requests:
+            self.assertEqual(headers["user-agent"], crawler.user_agent)
+            self.assertEqual(headers["accept-encoding"], "gzip")
+
+    def test_gzip(self):
+        body = "<html>%s</html>" % ("gzipped " * 1000)
+        self.server.responses["/big"] = (200, body, {})
+        self.assertEqual(crawler.fetch(self.server.url("/big")), (200, body))
+
+    def test_not_found(self):
+        self.server.responses["/missing?oldid=5"] = (404, "Not found", {})
+        self.assertEqual(crawler.fetch(self.server.url("/missing?oldid=5")), (404, "Not found"))
+        # The connection is still good after an error status
+        self.assertEqual(crawler.fetch(self.server.url("/ok"))[0], 200)
+        self.assertEqual(self.server.connections(), 1)
+        self.assertEqual(
+            crawler.crawl_revision(self.server.url("/missing?oldid=5"), "cache", self.logger), None)
+
+    def test_connection_close(self):
+        self.server.responses["/closing"] = (200, "bye", {"Connection": "close"})
+        self.assertEqual(crawler.fetch(self.server.url("/closing")), (200, "bye"))
+        self.assertEqual(crawler.fetch(self.server.url("/after")), (200, "<html>/after</html>"))
+        self.assertEqual(self.server.connections(), 2)
+
+    def test_retry_closed_connection(self):
+        # The server drops the connection after this one, the next request
+        # fails on it and is retried on a new one
+        self.assertEqual(crawler.fetch(self.server.url("/drop")), (200, "<html>/drop</html>"))
+        self.assertEqual(crawler.fetch(self.server.url("/after")), (200, "<html>/after</html>"))
+        self.assertEqual(self.server.connections(), 2)
+
+    def test_crawl_revisions(self):
+        root = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(root)
+            os.makedirs(crawler.output_dir % u"Test")
+            oldids = range(100, 140)
+            urls = [self.server.url("/w/index.php?oldid=%d" % oldid) for oldid in oldids]
+            stats = {}
+            crawler.crawl_revisions(u"Test", urls, self.logger, stats)
+            self.assertEqual((stats["pages_fetched"], stats["pages_failed"]), (40, 0))
+            for oldid in oldids:
+                with open(os.path.join(crawler.cache_dir % u"Test", "oldid=%d.html" % oldid), "rb") as f:
+                    self.assertEqual(f.read(), "<html>/w/index.php?oldid=%d</html>" % oldid)
+            # One connection for each fetching thread at most
+            self.assertTrue(self.server.connections() <= crawler.fetch_threads)
+            # Any page that can't be fetched fails the crawl
+            self.server.responses["/w/index.php?oldid=200"] = (503, "Busy", {})
+            urls.append(self.server.url("/w/index.php?oldid=200"))
+            self.assertRaises(IOError, crawler.crawl_revisions, u"Test", urls, self.logger, stats)
+            self.assertEqual((stats["pages_fetched"], stats["pages_failed"]), (40, 1))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root)
+
+def read_fixture(name):
+    with open(os.path.join(fixture_dir, name), "rb") as f:
+        return f.read()
+
+class ApiRevisionsTest(StubServerTest):
+    '''Replays the revisions query responses in tests/fixtures through get_api_revisions().'''
+
+    project_name = u"Chess"
+    # The fixtures list 4 revisions per response
+    batch_size = 4
+
+    def setUp(self):
+        StubServerTest.setUp(self)
+        self.config = dict(
+            (name, getattr(crawler, name))
+            for name in ["assessment_api_url", "api_batch_size", "revision_dump"])
+        crawler.assessment_api_url = self.server.url(
+            "/w/api.php?action=query&format=json&formatversion=2&prop=revisions"
+            "&rvprop=ids&titles=Wikipedia:Version_1.0_Editorial_Team/%s_articles_by_quality_log"
+            "&rvlimit=%d")
+        crawler.api_batch_size = self.batch_size
+        self.root = tempfile.mkdtemp()
+        crawler.revision_dump = os.path.join(self.root, "%s.jsonl")
+        self.responses = read_fixture("api_revisions.jsonl").splitlines()
+        self.server.route = self.route_api
+
+    def tearDown(self):
+        for name, value in self.config.items():
+            setattr(crawler, name, value)
+        shutil.rmtree(self.root)
+        StubServerTest.tearDown(self)
+
+    def route_api(self, path):
+        '''Answer a revisions query with the response its continue token asks for.'''
+        query = urlparse.parse_qs(urlparse.urlsplit(path).query, keep_blank_values=True)
+        if query["rvlimit"] != [str(self.batch_size)] or query["titles"] != [
+            "Wikipedia:Version_1.0_Editorial_Team/Chess_articles_by_quality_log"
+        ]:
+            return 400, "Bad query", {}
+        if "rvcontinue" not in query:
+            return 200, self.responses[0], {}
+        for i, line in enumerate(self.responses[:-1]):
+            token = json.loads(line)["continue"]
+            if query["rvcontinue"] == [token["rvcontinue"]] and query["continue"] == [token["continue"]]:
+                return 200, self.responses[i + 1], {}
+        return 400, "Unknown rvcontinue", {}
+
+    def get_urls(self, stop_oldid=None):
+        return crawler.get_api_revisions(
+            self.project_name, logging.getLogger("test_crawler"), stop_oldid)
+
+    def get_revids(self, stop_oldid=None):
+        return [int(crawler.oldid_re.search(url).group(1)) for url in self.get_urls(stop_oldid)]
+
+    def expected_revids(self):
+        revids = []
+        for line in self.responses:
+            for page in json.loads(line)["query"]["pages"]:
+                revids.extend(rev["revid"] for rev in page["revisions"])
+        return revids
+
+    def test_continuation(self):
+        revids = self.expected_revids()
+        self.assertEqual(len(revids), 10)
+        urls = self.get_urls()
+        self.assertEqual(urls, [
+            crawler.assessment_revision_url % (self.project_name, revid) for revid in revids])
+        # One request per recorded response
+        self.assertEqual(len(self.server.requests), len(self.responses))
+
+    def test_stop_oldid(self):
+        revids = self.expected_revids()
+        # Listing stops after the response that reaches a cached revision
+        self.assertEqual(self.get_revids(stop_oldid=revids[5]), revids[:8])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_dump(self):
+        with open(crawler.revision_dump % self.project_name, "wb") as f:
+            f.write(read_fixture("api_revisions.jsonl"))
+        self.assertEqual(self.get_revids(), self.expected_revids())
+        self.assertEqual(self.server.requests, [])
+
+    def test_formatversion_1(self):
+        self.server.route = lambda path: (200, read_fixture("api_revisions_v1.json"), {})
+        self.assertEqual(self.get_revids(), self.expected_revids()[:3])
+
+    def test_errors(self):
+        self.server.route = lambda path: (200, read_fixture("api_error.json"), {})
+        self.assertRaises(IOError, self.get_revids)
+        self.server.route = lambda path: (503, "Service unavailable", {})
+        self.assertRaises(IOError, self.get_revids)
+        self.server.route = lambda path: (200, "<html>Not JSON</html>", {})
+        self.assertRaises(IOError, self.get_revids)
+
+class CrawlParseTest(ApiRevisionsTest):
+    '''Crawls the fixtures' revisions into a page store and parses them.'''
+
+    def setUp(self):
+        ApiRevisionsTest.setUp(self)
+        self.config.update(
+            (name, getattr(crawler, name))
+            for name in ["revision_backend", "assessment_revision_url"])
+        crawler.revision_backend = "api"
+        crawler.assessment_revision_url = self.server.url("/w/index.php?title=%s&oldid=%d")
+        self.cwd = os.getcwd()
+        self.workspace = benchmark.make_workspace()
+        os.chdir(self.workspace)
+        # A page of its own day for each revision, newest first
+        rng = random.Random(0)
+        kinds = sorted(benchmark.format_mix)
+        day = calendar.timegm((2015, 11, 30, 0, 0, 0))
+        self.pages = {}
+        for i, revid in enumerate(self.expected_revids()):
+            self.pages[revid] = benchmark.make_page([day - 86400 * i], 3, False, False, rng, kinds)
+        self.busy = set()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workspace)
+        ApiRevisionsTest.tearDown(self)
+
+    def route_api(self, path):
+        if not path.startswith("/w/index.php"):
+            return ApiRevisionsTest.route_api(self, path)
+        revid = int(crawler.oldid_re.search(path).group(1))
+        if revid in self.busy:
+            return 503, "Busy", {}
+        return 200, self.pages[revid], {}
+
+    def parse_rows(self):
+        '''Run a parse, returning the project's rows or None if it has no TSV.'''
+        parser.parse_project(self.project_name)
+        path = parser.assessment_file % parser.projects.quoted_name(self.project_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read().splitlines()[1:]
+
+    def test_parse_waits_for_crawl(self):
+        revids = self.expected_revids()
+        self.busy = set(revids[::2])
+        self.assertEqual(crawler.crawl(self.project_name), "failed")
+        # Half the pages are stored, but not parsed until the crawl is done
+        self.assertEqual(self.parse_rows(), None)
+        self.assertEqual(registry.get_state(self.project_name, "parse"), registry.pending)
+        self.busy = set()
+        self.assertEqual(crawler.crawl(self.project_name), "complete")
+        rows = self.parse_rows()
+        self.assertEqual(registry.get_state(self.project_name, "parse"), registry.done)
+        self.assertEqual(len(set(row.split("\t")[1] for row in rows)), len(revids))
+
+    def test_closes_log_and_store(self):
+        conns = []
+        connect = crawler.pagestore.connect
+        def record(clean_name):
+            conns.append(connect(clean_name))
+            return conns[-1]
+        crawler.pagestore.connect = record
+        try:
+            self.busy = set(self.expected_revids()[:1])
+            self.assertEqual(crawler.crawl(self.project_name), "failed")
+            self.busy = set()
+            self.assertEqual(crawler.crawl(self.project_name), "complete")
+        finally:
+            crawler.pagestore.connect = connect
+        self.assertEqual(len(conns), 2)
+        for conn in conns:
+            self.assertRaises(sqlite3.ProgrammingError, conn.execute, "SELECT 1")
+        self.assertEqual(logging.getLogger(self.project_name).handlers, [])
+
+    def test_tar_in_page_order(self):
+        self.config["cache_store"] = crawler.cache_store
+        crawler.cache_store = False
+        tar_buffer_size = parser.tar_buffer_size
+        parser.tar_buffer_size = 0
+        try:
+            self.assertEqual(crawler.crawl(self.project_name), "complete")
+            clean_name = parser.projects.clean_name(self.project_name)
+            page_ids, read_page = parser.open_cache_tar(clean_name)
+            self.assertEqual(sorted(page_ids, reverse=True), page_ids)
+            self.assertEqual(sorted(page_ids), sorted(self.pages))
+            for page_id in page_ids:
+                self.assertEqual(read_page(page_id), self.pages[page_id])
+                # Each page is the next member, none are deferred
+                self.assertFalse(os.path.exists(parser.tar_spill_dir % clean_name))
+        finally:
+            parser.tar_buffer_size = tar_buffer_size
+
+    def test_unchanged_crawl_keeps_parse(self):
+        self.assertEqual(crawler.crawl(self.project_name), "complete")
+        self.assertNotEqual(self.parse_rows(), None)
+        self.assertEqual(registry.get_state(self.project_name, "parse"), registry.done)
+        # Nothing new to fetch, so nothing new to parse
+        registry.reset([self.project_name], "crawl")
+        self.assertEqual(crawler.crawl(self.project_name), "unchanged")
+        self.assertEqual(registry.get_state(self.project_name, "parse"), registry.done)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Checks gaps.py's repeated events
+#
+# Usage: python -m unittest discover tests
+
+import codecs
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import config
+import gaps
+import projects
+
+day = 86400
+
+class RepeatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def write_tsv(self, project_name, events):
+        path = gaps.assessment_file % projects.quoted_name(project_name)
+        os.makedirs(os.path.dirname(path))
+        with codecs.open(path, "wb", encoding="utf-8") as f:
+            f.write(u"\t".join(config.columns) + u"\n")
+            for article, days in events:
+                f.write(u"\t".join([
+                    project_name, unicode(days * day), u"Assessed", article,
+                    u"", u"B-Class", u"", u"Low-Class", u"", u"", u""]) + u"\n")
+
+    def test_first_date_of_chain(self):
+        self.write_tsv(u"Test", [
+            (u"A", 0), (u"A", 3), (u"A", 6), (u"A", 6), (u"A", 9),
+            (u"B", 3), (u"B", 5), (u"A", 20), (u"A", 22)])
+        repeats = [
+            (row[3], int(row[1]) // day, first_date // day)
+            for row, first_date in gaps.find_repeats(u"Test")]
+        # The second A on day 6 is the same entry, not a repeat, and
+        # doesn't break the chain. Day 20 is too late for it.
+        self.assertEqual(sorted(repeats), [
+            (u"A", 3, 0), (u"A", 6, 0), (u"A", 9, 0), (u"A", 22, 20), (u"B", 5, 3)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# Checks that parser.py's faster paths give the same entries as the plain ones
+#
+# Usage: python -m unittest discover tests
+
+import calendar
+import os
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import benchmark
+import parser
+
+test_project = "Split Test"
+
+def make_pages(count, seed=0):
+    '''Return (oldid, html) pairs, newest first, mixing the kinds of page split_pages() sees.
+
+    Besides pages with their own date headers there are continuation pages,
+    huge logs and pages with no header but a date anchor in their table of
+    contents, each before a continuation page so a chunk wrongly started on
+    it loses the continued day.
+    '''
+    rng = random.Random(seed)
+    kinds = []
+    for kind, weight in sorted(benchmark.format_mix.items()):
+        kinds.extend([kind] * weight)
+    day = calendar.timegm((2015, 11, 30, 0, 0, 0))
+    oldid = 700000000
+    pages = []
+    for i in range(count):
+        days = [day - 86400 * d for d in range(2)]
+        if i % 5 == 1:
+            # Header only in the table of contents
+            html = benchmark.make_page([], 3, False, False, rng, kinds)
+            html = html.replace('href="#x"', 'href="#%s"' % benchmark.date_header(day).split('"')[3])
+        else:
+            contd = i % 5 == 2
+            html = benchmark.make_page(days, 3, contd, i % 7 == 3, rng, kinds)
+            if contd:
+                # The continued list has to be the page's first
+                html = re.sub(r'<div id="toc">.*?</div>', "", html)
+            day -= 86400 * 2
+        pages.append((oldid, html))
+        oldid -= rng.randint(1, 1000)
+    return pages
+
+class WorkspaceTest(unittest.TestCase):
+    '''Runs each test in a scratch workspace with parser's config restored after.'''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = benchmark.make_workspace()
+        os.chdir(self.root)
+        self.config = dict(
+            (name, getattr(parser, name))
+            for name in ["split_chunk_size", "split_read_ahead", "page_backend", "stream_tar"])
+
+    def tearDown(self):
+        for name, value in self.config.items():
+            setattr(parser, name, value)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def write_cache(self, project_name, pages):
+        '''Write pages to a project's cache dir and cache tar.
+
+        The tar is in directory order, like the ones crawled before the
+        crawler wrote them in page order, so reading it defers pages.
+        '''
+        cache = parser.cache_dir % parser.projects.clean_name(project_name)
+        os.makedirs(cache)
+        for oldid, html in pages:
+            with open(os.path.join(cache, "oldid=%d.html" % oldid), "wb") as f:
+                f.write(html)
+        subprocess.check_call(
+            ["tar", "-czf", parser.cache_tar % parser.projects.clean_name(project_name), cache])
+
+    def parse_tsv(self, project_name, page_workers):
+        parser.parse(project_name, from_tar=True, page_workers=page_workers)
+        path = parser.assessment_file % parser.projects.quoted_name(project_name)
+        with open(path, "rb") as f:
+            tsv = f.read()
+        os.remove(path)
+        return tsv
+
+class SplitPagesTest(WorkspaceTest):
+
+    def test_chunks_start_on_date_headers(self):
+        pages = make_pages(40)
+        for backend in sorted(parser.page_backends):
+            parser.page_backend = backend
+            chunks = list(parser.split_pages(pages, 1))
+            self.assertEqual([pair for chunk in chunks for pair in chunk], pages)
+            for chunk in chunks[1:]:
+                contd, blocks, huge = parser.page_backends[backend](chunk[0][1])
+                self.assertFalse(contd)
+                self.assertTrue(any(kind == "date" for kind, value in blocks))
+            # Pages 1, 6, ... only have a header in the table of contents
+            # and pages 2, 7, ... continue the page before
+            starts = set(chunk[0][0] for chunk in chunks)
+            for i, (oldid, html) in enumerate(pages):
+                self.assertEqual(oldid in starts, i == 0 or i % 5 not in (1, 2))
+
+    def test_pages_read_as_chunks_fill(self):
+        pages = make_pages(40)
+        taken = []
+        def take():
+            for pair in pages:
+                taken.append(pair[0])
+                yield pair
+        chunks = parser.split_pages(take(), 7)
+        first = next(chunks)
+        # Only the pages of the first chunk and the one that starts the next
+        self.assertEqual(taken, [oldid for oldid, html in pages[:len(first) + 1]])
+        self.assertEqual([first] + list(chunks), list(parser.split_pages(pages, 7)))
+
+    def test_split_parse_matches_serial(self):
+        self.write_cache(test_project, make_pages(60, seed=1))
+        serial = self.parse_tsv(test_project, 1)
+        self.assertTrue(len(serial.split("\n")) > 100)
+        for chunk_size, read_ahead in [(1, 1), (7, 2)]:
+            parser.split_chunk_size = chunk_size
+            parser.split_read_ahead = read_ahead
+            self.assertEqual(self.parse_tsv(test_project, 3), serial)
+
+    def test_page_store(self):
+        pages = make_pages(30, seed=2)
+        self.write_cache(test_project, pages)
+        from_tar = self.parse_tsv(test_project, 1)
+        clean_name = parser.projects.clean_name(test_project)
+        conn = parser.pagestore.connect(clean_name)
+        for oldid, html in pages:
+            parser.pagestore.put_page(conn, oldid, html)
+        conn.close()
+        page_ids, read_page = parser.pagestore.open_store(clean_name)
+        self.assertEqual([(page_id, read_page(page_id)) for page_id in page_ids], pages)
+        # Closed once every page is read, before any pool is forked
+        self.assertRaises(sqlite3.ProgrammingError, read_page, page_ids[0])
+        self.assertEqual(self.parse_tsv(test_project, 1), from_tar)
+        self.assertEqual(self.parse_tsv(test_project, 3), from_tar)
+
+# Lines for each log format, and ones that fall through or match none
+format_lines = [
+    (u"Foo (talk) reassessed. Quality rating changed from Start-Class to B-Class (rev \xb7 t).",
+     [u"Foo", u"talk", u"rev", u"t"]),
+    (u"Foo reassessed. Importance rating changed from Low-Class to Mid-Class (rev \xb7 t).",
+     [u"Foo", u"rev", u"t"]),
+    (u"Foo reassessed from Start-Class (Low-Class) to B-Class (Mid-Class)", [u"Foo"]),
+    (u"Foo (talk) assessed. Quality assessed as B-Class (rev \xb7 t). Importance assessed as Low-Class (rev \xb7 t).",
+     [u"Foo", u"talk", u"rev", u"t", u"rev", u"t"]),
+    (u"Foo (talk) assessed. Quality assessed as B-Class (rev \xb7 t).", []),
+    (u"Foo assessed. Quality assessed as B-Class (rev).", [u"Foo", u"rev"]),
+    (u"Foo (talk) B-Class (Low-Class) renamed to Bar.", [u"Foo", u"talk", u"Bar"]),
+    (u"Foo (Talk) B-Class (Low-Class) renamed to Bar", [u"Foo", u"Talk", u"Bar"]),
+    (u"Foo (discuss) B-Class (Low-Class) renamed to Bar", [u"Foo", u"discuss", u"Bar"]),
+    (u"Foo (discuss) B-Class (Low-Class) renamed to Bar", [u"Foo", u"discuss", u"talk"]),
+    (u"Foo (talk) renamed to Bar (talk)", [u"Foo", u"talk", u"Bar", u"talk"]),
+    (u"Foo renamed to Bar.", [u"Foo", u"Bar"]),
+    (u"Foo talk moved to Bar talk", [u"Foo", u"Bar"]),
+    (u"Foo (x (y) talk) B-Class (Low-Class) added", [u"Foo"]),
+    (u"[[Foo]] (x (y) Talk) B-Class (Low-Class) added", [u"Foo"]),
+    (u"Foo (talk) added", [u"Foo", u"talk"]),
+    (u"Foo (Talk) Created", [u"Foo", u"Talk"]),
+    (u"Foo (talk) Stub-Class recreated", [u"Foo", u"talk"]),
+    (u"Foo (talk) removed", [u"Foo", u"talk"]),
+    (u"Foo (talk) Stub-Class (Low-Class) removed", [u"Foo", u"talk"]),
+    (u" (talk) Stub-Class (Low-Class) removed", [u"talk"]),
+    (u"Foo Stub-Class (Low-Class) removed.", [u"Foo"]),
+    (u"Foo (a (b) talk) removed", [u"Foo"]),
+    (u"Foo removed.", [u"Foo"]),
+    (u"Foo Removed per talk page discussion", [u"Foo"]),
+    (u"Foo moved from B-Class (Low-Class) to A-Class (Mid-Class)", [u"Foo"]),
+    (u"Foo moved from B-Class to A-Class", [u"Foo"]),
+    (u"Foo upgraded to good article status", [u"Foo"]),
+    (u"Temp bot test", []),
+    (u"Foo (talk) B-Class (Low-Class)", [u"Foo", u"talk"]),
+    (u"(talk)", [u"talk"]),
+    (u"(No changes today)", []),
+    (u"^Foo", []),
+    (u"Statelessness (talk) Unassessed added", [u"Statelessness", u"talk"]),
+    (u"Foo", [u"Foo"]),
+    (u"Foo was looked at", [u"Foo"]),
+]
+# Pieces of lines, joined at random into lines that mix the formats
+line_parts = [
+    u"Foo", u"Bar (film)", u"(talk)", u"(Talk)", u"(x (y) talk)", u"talk",
+    u"assessed.", u" assessed.", u"reassessed.", u"reassessed from", u"Quality assessed as B-Class (rev).",
+    u"Quality rating changed from C-Class to B-Class", u"Importance rating changed from Low-Class to Mid-Class",
+    u"Stub-Class", u"(Low-Class)", u"B-Class (Mid-Class)", u"renamed to", u"moved to", u"moved from",
+    u"to", u"added", u") added", u"Created", u"recreated", u"removed", u"removed.", u"Removed per talk page discussion",
+    u"upgraded to good article status", u"Temp bot", u"(No changes today)", u"(", u")", u".", u"",
+]
+
+def get_outcome(text, links):
+    '''Return what get_entry() does with a line, an entry or an exception name.'''
+    try:
+        return parser.get_entry(u"Test", 0, text, links, parser.logging.getLogger("test"))
+    except Exception as e:
+        return type(e).__name__
+
+class GetEntryTest(unittest.TestCase):
+
+    def setUp(self):
+        parser.logging.getLogger("test").addHandler(parser.logging.NullHandler())
+        parser.logging.getLogger("test").propagate = False
+        self.get_entry_candidates = parser.get_entry_candidates
+
+    def tearDown(self):
+        parser.get_entry_candidates = self.get_entry_candidates
+
+    def get_lines(self):
+        rng = random.Random(5)
+        lines = list(format_lines)
+        for i in range(20000):
+            parts = [rng.choice(line_parts) for j in range(rng.randint(1, 8))]
+            text = u" ".join(parts).strip() or u"x"
+            links = [part for part in parts if part and rng.random() < 0.3]
+            lines.append((text, links))
+        return lines
+
+    def test_keywords_match_regex_only(self):
+        lines = self.get_lines()
+        dispatched = [get_outcome(text, links) for text, links in lines]
+        # Every line tried against every format, in order
+        parser.get_entry_candidates = lambda text: parser.entry_formats
+        regex_only = [get_outcome(text, links) for text, links in lines]
+        for line, a, b in zip(lines, dispatched, regex_only):
+            self.assertEqual(a, b, line)
+        # Both the entries and the fallbacks are exercised
+        self.assertEqual(
+            set(type(outcome) for outcome in dispatched), set([parser.Entry, str]))
+        self.assertTrue(set(["StopIteration", "ValueError"]) <= set(dispatched))
+
+    def test_keywords_in_every_match(self):
+        matched = set()
+        for text, links in self.get_lines():
+            for i, (keyword, pattern, handler) in enumerate(parser.entry_formats):
+                if pattern.match(text):
+                    self.assertIn(keyword, text)
+                    matched.add(i)
+        self.assertEqual(matched, set(range(len(parser.entry_formats))))
+
+if __name__ == "__main__":
+    unittest.main()
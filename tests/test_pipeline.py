@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Checks that the pipeline's modules import cleanly and pipeline.py dispatches
+#
+# Usage: python -m unittest discover tests
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import pipeline
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def test_imports_have_no_side_effects(self):
+        # In a fresh interpreter, so nothing is imported yet
+        modules = sorted(set(pipeline.commands.values()))
+        code = "import sys; sys.path.insert(0, %r)\n%s" % (
+            repo_dir, "".join(
+                "import %s; assert callable(%s.main)\n" % (m, m) for m in modules))
+        subprocess.check_call([sys.executable, "-c", code])
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_usage(self):
+        with open(os.devnull, "wb") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                self.assertEqual(pipeline.main([]), 2)
+                self.assertEqual(pipeline.main(["unknown"]), 2)
+                # Marking projects parsed needs names or --all
+                self.assertEqual(pipeline.main(["mark-completed"]), 2)
+            finally:
+                sys.stdout = stdout
+        self.assertEqual(os.listdir(self.root), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Checks registry.py's claims
+#
+# Usage: python -m unittest discover tests
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import registry
+
+class ClaimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "status.sqlite")
+        registry.add_projects([u"Alpha", u"Beta"], self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def set_owner(self, project_name, owner_name):
+        with registry.transaction(self.path) as conn:
+            conn.execute(
+                "UPDATE status SET Owner = ? WHERE Project = ? AND Stage = ?",
+                (owner_name, project_name, "parse"))
+
+    def exited_owner(self):
+        p = subprocess.Popen([sys.executable, "-c", "pass"])
+        p.wait()
+        return "%s:%d" % (registry.socket.gethostname(), p.pid)
+
+    def test_live_claim_is_kept(self):
+        self.assertTrue(registry.claim(u"Alpha", "parse", self.path))
+        self.assertFalse(registry.claim(u"Alpha", "parse", self.path))
+        # Claims from other hosts can't be checked, they wait to go stale
+        self.set_owner(u"Alpha", "elsewhere:1")
+        self.assertFalse(registry.claim(u"Alpha", "parse", self.path))
+
+    def test_exited_owner_is_released(self):
+        self.assertTrue(registry.claim(u"Alpha", "parse", self.path))
+        self.assertTrue(registry.claim(u"Beta", "parse", self.path))
+        self.set_owner(u"Alpha", self.exited_owner())
+        self.set_owner(u"Beta", self.exited_owner())
+        self.assertTrue(registry.claim(u"Alpha", "parse", self.path))
+        # Released claims are failed, with the owner as the error
+        self.assertEqual(registry.get_state(u"Beta", "parse", self.path), registry.failed)
+        self.assertEqual(registry.claim_next("parse", self.path), u"Beta")
+        self.assertEqual(registry.claim_next("parse", self.path), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Checks shocks.py's scoring
+#
+# Usage: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import shocks
+
+class FindShocksTest(unittest.TestCase):
+
+    def test_series_start_is_not_a_shock(self):
+        counts = np.zeros((3, 60), dtype=np.int32)
+        # A steady series from bin 20, another from the start, and one with
+        # a burst at bin 40
+        counts[0, 20:] = 6
+        counts[1, :] = 6
+        counts[2, 10:] = 1
+        counts[2, 40] = 30
+        (r, b), z, surprise, mean = shocks.find_shocks(counts)
+        self.assertEqual(list(zip(r, b)), [(2, 40)])
+
+    def test_history_from_first_event(self):
+        counts = np.zeros((1, 30), dtype=np.int32)
+        counts[0, 10:] = 2
+        mean, std, history = shocks.rolling_baseline(counts, 12)
+        self.assertEqual(history.shape, counts.shape)
+        self.assertEqual(list(history[0, :12]), [0] * 11 + [1])
+        self.assertEqual(list(history[0, 20:24]), [10, 11, 12, 12])
+        self.assertEqual(list(mean[0, 12:]), [2.0] * 18)
+
+if __name__ == "__main__":
+    unittest.main()
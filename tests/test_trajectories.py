@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Checks that trajectories.py applies renames from their dates on
+#
+# Usage: python -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import renames
+import trajectories
+
+day = 86400
+
+def row(date, action, name, new_qual=u"", new_name=u""):
+    return [u"Test", date * day, action, name, u"", new_qual, u"", u"", new_name, u"", u""]
+
+# Old is renamed to New on day 5. New was another article before then, and
+# Old is a new article reusing the title from day 10.
+rows = [
+    row(1, u"Assessed", u"New", u"Stub"),
+    row(0, u"Assessed", u"Old", u"Start"),
+    row(5, u"Renamed", u"Old", new_name=u"New"),
+    row(5, u"Reassessed", u"Old", u"C"),
+    row(6, u"Reassessed", u"New", u"B"),
+    row(10, u"Assessed", u"Old", u"GA"),
+    # A chain, Mid is renamed on
+    row(2, u"Assessed", u"First", u"Start"),
+    row(3, u"Renamed", u"First", new_name=u"Mid"),
+    row(4, u"Renamed", u"Mid", new_name=u"Last"),
+    row(7, u"Reassessed", u"Last", u"B"),
+]
+
+class TrajectoriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def test_row_articles(self):
+        articles = renames.get_row_articles(rows)
+        # The rename, and the rows on its day under either name, are Old's
+        self.assertEqual(len(set(articles[1:5])), 1)
+        self.assertEqual(len(set(articles[6:])), 1)
+        self.assertEqual(len(set([articles[0], articles[1], articles[5], articles[6]])), 4)
+
+    def test_renames_in_time(self):
+        trajectories.write_trajectories(u"Test", rows)
+        meta, columns = trajectories.read_trajectories(u"Test")
+        def qual(name, date):
+            state = trajectories.lookup(meta, columns, name, date * day)
+            return state and state[0]
+        # Names look up their last article, so New has Old's history from
+        # before the rename, and the new Old doesn't
+        self.assertEqual(qual(u"New", 2), u"Start")
+        self.assertEqual(qual(u"Old", 3), None)
+        self.assertEqual(qual(u"New", 5), u"C")
+        self.assertEqual(qual(u"New", 6), u"B")
+        self.assertEqual(qual(u"Old", 10), u"GA")
+        # Names in a chain look up the same article
+        for name in [u"First", u"Mid", u"Last"]:
+            self.assertEqual(qual(name, 2), u"Start")
+            self.assertEqual(qual(name, 7), u"B")
+        # Every article present is under the name it had at the time
+        self.assertEqual(trajectories.snapshot(meta, columns, 2 * day), {
+            u"Old": (u"Start", u""), u"New": (u"Stub", u""), u"First": (u"Start", u"")})
+        self.assertEqual(sorted(trajectories.snapshot(meta, columns, 3 * day)), [u"Mid", u"New", u"Old"])
+        snapshot = trajectories.snapshot(meta, columns, 10 * day)
+        self.assertEqual(
+            sorted((name, state[0]) for name, state in snapshot.items()),
+            [(u"Last", u"B"), (u"New", u"B"), (u"Old", u"GA")])
+        # The article that was New leaves the project at the rename
+        stub, = [
+            i for i, name in enumerate(meta["articles"])
+            if name == u"New" and i != meta["ids"][u"New"]]
+        qual_codes, imp_codes = trajectories.snapshot_codes(columns, 4 * day)
+        self.assertEqual(meta["qual"][qual_codes[stub]], u"Stub")
+        qual_codes, imp_codes = trajectories.snapshot_codes(columns, 5 * day)
+        self.assertEqual(qual_codes[stub], trajectories.absent)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Quality and importance trajectory of every article in a project
+#
+# Replays a project's Assessed, Reassessed, Renamed and Removed rows once
+# and keeps only the points where an article's assessment changed, so the
+# assessment at any time is a binary search instead of a replay of the log.
+# Each project gets a directory of .npy files:
+#   offsets.npy               int64, article i's changes are the rows
+#                             offsets[i]:offsets[i + 1] of the arrays below
+#   time.npy                  int32 UTC timestamps, ascending per article
+#   qual.npy, imp.npy         int16 codes into meta["qual"] and meta["imp"],
+#                             -1 while the article isn't in the project
+#   meta.json                 project name, article names by id, other
+#                             names that look one up, the earlier names of
+#                             renamed articles and code vocabularies
+# A rename moves an article's trajectory to its new name from the rename's
+# date on, see renames.get_row_articles(). Articles are kept under their
+# last name, and every name looks up the last article that had it.
+#
+# Usage: python trajectories.py [project ...]
+
+import codecs
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+import columnar
+import projects
+import renames
+
+# Config
+trajectory_dir = "output/trajectories/%s"
+assessment_file = "output/assessments/%s.utf8.tsv"
+
+# Code for an article that isn't in the project
+absent = -1
+
+def project_path(project_name):
+    return trajectory_dir % projects.quoted_name(project_name)
+
+def read_rows(project_name):
+    '''Return a project's rows, from its columnar table if it has one.'''
+    if os.path.exists(columnar.project_path(project_name)):
+        return list(columnar.iter_rows(project_name))
+    rows = []
+    path = assessment_file % projects.quoted_name(project_name)
+    with codecs.open(path, "rb", encoding="utf-8") as f:
+        f.readline()
+        for line in f:
+            row = line.rstrip(u"\n").split(u"\t")
+            if len(row) == 11:
+                row[1] = int(row[1])
+                rows.append(row)
+    return rows
+
+def replay(rows):
+    '''Return (changes, names, holders) for a project's rows.
+
+    Articles are numbered by renames.get_row_articles(). changes maps each
+    article to its (time, qual, imp) change points in order, qual and imp
+    being None while it's out of the project. names maps each article to
+    its (time, name) pairs, the first name and each one it's renamed to, and
+    holders each name to the last article that had it.
+    '''
+    articles = renames.get_row_articles(rows)
+    states = {}
+    changes = {}
+    names = {}
+    holders = {}
+    # Rows are in log order, which is only roughly by date
+    for i in sorted(range(len(rows)), key=lambda i: rows[i][1]):
+        row = rows[i]
+        action = row[2]
+        article = articles[i]
+        holders[row[3]] = article
+        names.setdefault(article, [(int(row[1]), row[3])])
+        qual, imp = states.get(article, (None, None))
+        if action == u"Assessed":
+            qual, imp = row[5], row[7]
+        elif action == u"Reassessed":
+            # Reassessments of one of the two keep the other
+            qual = row[5] or qual or u""
+            imp = row[7] or imp or u""
+        elif action == u"Removed":
+            qual = imp = None
+        else:
+            # Renames move the whole trajectory to the new name
+            if action == u"Renamed" and row[8]:
+                # An article that had the new name leaves the project
+                other = holders.get(row[8], article)
+                if other != article and states.get(other, (None, None)) != (None, None):
+                    states[other] = (None, None)
+                    changes[other].append((row[1], None, None))
+                names[article].append((int(row[1]), row[8]))
+                holders[row[8]] = article
+            continue
+        if (qual, imp) != states.get(article, (None, None)):
+            states[article] = (qual, imp)
+            changes.setdefault(article, []).append((row[1], qual, imp))
+    return changes, names, holders
+
+def write_trajectories(project_name, rows):
+    '''Write the trajectory index for a project's rows, returning its path.
+
+    Written to a temporary directory and moved into place, like
+    columnar.write_columnar().
+    '''
+    changes, names, holders = replay(rows)
+    articles = sorted(changes, key=lambda article: (names[article][-1][1], article))
+    ids = dict((article, i) for i, article in enumerate(articles))
+    article_names = [names[article][-1][1] for article in articles]
+    by_name = dict((name, i) for i, name in enumerate(article_names))
+    vocabs = {"qual": {u"": 0}, "imp": {u"": 0}}
+    offsets = np.zeros(len(articles) + 1, dtype=np.int64)
+    times = []
+    codes = {"qual": [], "imp": []}
+    for i, article in enumerate(articles):
+        for t, qual, imp in changes[article]:
+            times.append(t)
+            for vocab, value in [("qual", qual), ("imp", imp)]:
+                if value is None:
+                    codes[vocab].append(absent)
+                else:
+                    codes[vocab].append(vocabs[vocab].setdefault(value, len(vocabs[vocab])))
+        offsets[i + 1] = len(times)
+
+    path = project_path(project_name)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp_path, "time.npy"), np.array(times, dtype=np.int32))
+    for vocab in ["qual", "imp"]:
+        np.save(os.path.join(tmp_path, "%s.npy" % vocab), np.array(codes[vocab], dtype=np.int16))
+    meta = {
+        "project": project_name,
+        "articles": article_names,
+        # Old names, and any name whose last article isn't the one named
+        # after it, see read_trajectories()
+        "aliases": dict(
+            (name, ids[article]) for name, article in holders.items()
+            if article in ids and by_name.get(name) != ids[article]),
+        # Renamed articles' (time, name) pairs by id, see name_at()
+        "renamed": dict(
+            (str(ids[article]), names[article]) for article in articles
+            if len(names[article]) > 1),
+    }
+    for vocab, values in vocabs.items():
+        meta[vocab] = sorted(values, key=values.get)
+    with open(os.path.join(tmp_path, "meta.json"), "wb") as f:
+        json.dump(meta, f, sort_keys=True)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return path
+
+def build_project(project_name):
+    return write_trajectories(project_name, read_rows(project_name))
+
+def read_trajectories(project_name, mmap_mode='r'):
+    '''Return (meta, columns) for a project's trajectory index.
+
+    meta["ids"] maps every article name, old names included, to its id.
+    Arrays are memory-mapped read-only unless mmap_mode is None.
+    '''
+    path = project_path(project_name)
+    with open(os.path.join(path, "meta.json"), "rb") as f:
+        meta = json.load(f)
+    meta["ids"] = dict((article, i) for i, article in enumerate(meta["articles"]))
+    meta["ids"].update(meta["aliases"])
+    meta["renamed"] = dict((int(i), pairs) for i, pairs in meta["renamed"].items())
+    columns = {}
+    for name in ["offsets", "time", "qual", "imp"]:
+        column_path = os.path.join(path, "%s.npy" % name)
+        try:
+            columns[name] = np.load(column_path, mmap_mode=mmap_mode)
+        except ValueError:
+            # Empty arrays can't be memory-mapped
+            columns[name] = np.load(column_path)
+    return meta, columns
+
+def lookup(meta, columns, article_name, t):
+    '''Return an article's (qual, imp) at time t, or None if it wasn't in the project.'''
+    try:
+        i = meta["ids"][article_name]
+    except KeyError:
+        return None
+    start, end = columns["offsets"][i], columns["offsets"][i + 1]
+    j = start + np.searchsorted(columns["time"][start:end], t, side='right') - 1
+    if j < start or columns["qual"][j] == absent:
+        return None
+    return meta["qual"][columns["qual"][j]], meta["imp"][columns["imp"][j]]
+
+def snapshot_codes(columns, t):
+    '''Return (qual, imp) code arrays by article id at time t, absent if not in the project.'''
+    offsets = columns["offsets"]
+    n_articles = len(offsets) - 1
+    qual = np.full(n_articles, absent, dtype=np.int16)
+    imp = np.full(n_articles, absent, dtype=np.int16)
+    if n_articles == 0:
+        return qual, imp
+    # Every article has at least one change, so no segment is empty
+    seen = np.add.reduceat((columns["time"] <= t).astype(np.int64), offsets[:-1])
+    has_state = seen > 0
+    last = (offsets[:-1] + seen - 1)[has_state]
+    qual[has_state] = columns["qual"][last]
+    imp[has_state] = columns["imp"][last]
+    return qual, imp
+
+def name_at(meta, i, t):
+    '''Return the name article i had at time t, its first name before it was seen.'''
+    pairs = meta["renamed"].get(i)
+    if pairs is None:
+        return meta["articles"][i]
+    name = pairs[0][1]
+    for renamed_at, new_name in pairs[1:]:
+        if renamed_at > t:
+            break
+        name = new_name
+    return name
+
+def snapshot(meta, columns, t):
+    '''Return a dict from article name to (qual, imp) for every article in the project at time t.
+
+    Articles are under the name they had at time t, which no other article
+    in the project had then.
+    '''
+    qual, imp = snapshot_codes(columns, t)
+    present = np.nonzero(qual != absent)[0]
+    return dict(
+        (name_at(meta, i, t), (meta["qual"][qual[i]], meta["imp"][imp[i]]))
+        for i in present)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    project_names = args or projects.load_project_names()
+    for i, project_name in enumerate(project_names):
+        if not isinstance(project_name, unicode):
+            project_name = project_name.decode('utf-8')
+        try:
+            path = build_project(project_name)
+        except (IOError, OSError):
+            print "%d/%d: %s (no assessments)" % (i + 1, len(project_names), project_name)
+            continue
+        print "%d/%d: %s" % (i + 1, len(project_names), path)
+
+if __name__ == "__main__":
+    main()